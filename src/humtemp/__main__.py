@@ -0,0 +1,40 @@
+"""
+Starts humtemp with multiple gunicorn worker processes (see "humtemp_workers" and "humtemp_bind").
+
+The application is imported in every worker after the fork, and every worker creates its own redis connection
+pools, summary cache and write-behind buffer in the startup hook. Nothing is shared between the worker processes.
+"""
+from typing import *
+
+from gunicorn.app.base import BaseApplication
+
+from humtemp.configuration import get_settings
+
+
+class HumtempApplication(BaseApplication):
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self) -> Callable:
+        from humtemp.main import app
+        return app
+
+
+def main() -> None:
+    settings = get_settings()
+
+    HumtempApplication({
+        'bind': settings.humtemp_bind,
+        'workers': settings.workers,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        'preload_app': False,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Per-worker admission control (see "humtemp_admission_max_concurrent").
+
+At most "max_concurrent" requests are handled at once. Further requests wait in a bounded queue, and are shed
+right away with 429 once the queue is full, or with 503 if they couldn't be admitted within "queue_timeout"
+seconds. Rejections are cheap and carry a Retry-After header, so gateways back off instead of piling up requests
+whose latency grows without bound.
+
+"reserved" of the slots are only available to /summary requests, so summaries (and health checks using them) stay
+responsive while the worker is saturated with observations.
+"""
+import asyncio
+from collections import deque
+from typing import *
+
+from starlette.responses import JSONResponse
+
+from humtemp.metrics import ADMISSION_ACTIVE, ADMISSION_QUEUED, REQUESTS_SHED
+
+PRIORITY_PATH = '/summary'
+# never shed, so the shedding stays observable
+EXEMPT_PATHS = ('/metrics',)
+
+controller: Optional['AdmissionController'] = None
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+class AdmissionController:
+    def __init__(self,
+                 max_concurrent: int,
+                 max_queue: int = 100,
+                 queue_timeout: float = 1.0,
+                 reserved: int = 0,
+                 retry_after: int = 1):
+        if not 0 <= reserved < max_concurrent:
+            raise ValueError('the reserved slots must be fewer than "max_concurrent"')
+
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.reserved = reserved
+        # seconds shed requests are asked to wait before retrying
+        self.retry_after = retry_after
+
+        self.active = 0
+        # waiting requests in arrival order: the future resolved once a slot was handed over, and the priority
+        self._waiters: Deque[Tuple[asyncio.Future, bool]] = deque()
+
+    def _limit(self, priority: bool) -> int:
+        return self.max_concurrent if priority else self.max_concurrent - self.reserved
+
+    async def acquire(self, priority: bool = False) -> None:
+        """
+        Waits for a slot, which must be given back with release(). Raises Rejected if the request is shed.
+        """
+        # requests without priority queue up behind each other, requests with priority may use the reserved slots
+        if self.active < self._limit(priority) and (priority or not self._waiters):
+            self._admit()
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            raise Rejected(429, 'queue_full')
+
+        waiter = (asyncio.get_running_loop().create_future(), priority)
+        self._waiters.append(waiter)
+        ADMISSION_QUEUED.set(len(self._waiters))
+
+        try:
+            await asyncio.wait_for(waiter[0], self.queue_timeout)
+        except asyncio.TimeoutError:
+            # the slot may have been handed over right before the timeout
+            self._release_if_admitted(waiter[0])
+            raise Rejected(503, 'queue_timeout')
+        except asyncio.CancelledError:
+            self._release_if_admitted(waiter[0])
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                ADMISSION_QUEUED.set(len(self._waiters))
+
+    def release(self) -> None:
+        self.active -= 1
+        ADMISSION_ACTIVE.set(self.active)
+
+        # hands the free slots over to the oldest waiters which may use them
+        for waiter in list(self._waiters):
+            future, priority = waiter
+            if future.done():
+                continue
+            if self.active < self._limit(priority):
+                self._waiters.remove(waiter)
+                self._admit()
+                future.set_result(None)
+
+        ADMISSION_QUEUED.set(len(self._waiters))
+
+    def _release_if_admitted(self, future: asyncio.Future) -> None:
+        # a request which gives up waiting after it has been handed a slot must give it back
+        if future.done() and not future.cancelled():
+            self.release()
+
+    def _admit(self) -> None:
+        self.active += 1
+        ADMISSION_ACTIVE.set(self.active)
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the admission control of the worker, if enabled.
+    """
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        current = controller
+        if current is None or scope['type'] != 'http' or scope['path'] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await current.acquire(priority=scope['path'].startswith(PRIORITY_PATH))
+        except Rejected as e:
+            REQUESTS_SHED.inc(e.reason)
+            response = JSONResponse(
+                {'detail': 'the server is overloaded, retry later'},
+                status_code=e.status_code,
+                headers={'Retry-After': str(current.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current.release()
@@ -0,0 +1,235 @@
+"""
+Long-term archive of completed buckets on local disk (see "humtemp_archive_path").
+
+Every completed bucket is written to its own file, with the same column-wise layout as the memory storage:
+the lab ids, followed by one array per aggregate field. Reading a bucket memory-maps the file and copies
+the columns in bulk, without parsing anything per lab.
+
+A bucket can still receive late observations for "max_lateness" seconds after it completed, so its file is rewritten
+on every compaction, and a final time once no more observations can be accepted for it. Buckets in the archive outlive
+"humtemp_bucket_retention".
+"""
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+import uuid
+from typing import *
+
+from redis.asyncio import Redis as AsyncRedis
+
+from humtemp.memory import MemoryBucket
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_MAGIC = b'HUMARCH1'
+# bucket start, bucket duration
+ARCHIVE_HEADER = struct.Struct('<qq')
+# file in the archive directory containing its identity
+IDENTITY_FILE = '.archive-id'
+
+
+class Archive:
+    """
+    Directory containing one file per archived bucket, named after the bucket start.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+        self._identity: Optional[str] = None
+
+    def identity(self) -> str:
+        """
+        Random id of the directory, created by the first worker using it: workers sharing the directory
+        get the same id, workers with a directory of their own (e.g. on a local disk) a different one.
+        """
+        if self._identity is None:
+            os.makedirs(self.path, exist_ok=True)
+
+            path = os.path.join(self.path, IDENTITY_FILE)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(uuid.uuid4().hex)
+
+            # linking fails if another worker has created the file before, so all of them read the same id
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+
+            with open(path) as f:
+                self._identity = f.read()
+
+        return self._identity
+
+    def file_of(self, bucket_start: int) -> str:
+        return os.path.join(self.path, f'{bucket_start}.bucket')
+
+    def archived_at(self, bucket_start: int) -> Optional[float]:
+        """
+        When the bucket has last been written to the archive, or None if it hasn't been archived.
+        """
+        try:
+            return os.stat(self.file_of(bucket_start)).st_mtime
+        except FileNotFoundError:
+            return
+
+    def write(self, bucket_start: int, bucket_duration: int, bucket: MemoryBucket) -> None:
+        """
+        Writes the file of the bucket. The file is written under a temporary name first and then renamed,
+        so readers (and other workers writing the same bucket) never see a partially written file.
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        path = self.file_of(bucket_start)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(ARCHIVE_MAGIC)
+            f.write(ARCHIVE_HEADER.pack(bucket_start, bucket_duration))
+            bucket.write(f)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    def read(self, bucket_start: int) -> Optional[MemoryBucket]:
+        """
+        Reads an archived bucket, or returns None if it hasn't been archived.
+        """
+        path = self.file_of(bucket_start)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(ARCHIVE_MAGIC)] != ARCHIVE_MAGIC:
+                raise ValueError(f'{path} is not a humtemp archive file')
+
+            # archived buckets never expire
+            bucket, _ = MemoryBucket.read(data, len(ARCHIVE_MAGIC) + ARCHIVE_HEADER.size, expires_at=0)
+
+        return bucket
+
+
+class ArchiveCompactor:
+    """
+    Periodically writes all completed, still retained buckets of the repository to the archive. Buckets which
+    were archived after the last moment they could receive observations are final and skipped. Compactions
+    are aligned to multiples of the interval, with an additional one "delay" seconds after a bucket stopped
+    accepting observations. This requires a "max_lateness" shorter than the retention of completed buckets:
+    otherwise they accept observations until they expire, and those of the last interval are lost.
+
+    If "redis" is given, a lock per archive directory and compaction makes sure only one of the workers sharing
+    the directory compacts the buckets.
+    """
+    LOCK_KEY: ClassVar[str] = 'archive-lock'
+
+    def __init__(self,
+                 repository: Any,
+                 archive: Archive,
+                 interval: float = 300.0,
+                 max_lateness: int = 0,
+                 delay: float = 10.0,
+                 redis: Optional[AsyncRedis] = None):
+        self.repository = repository
+        self.archive = archive
+        self.interval = interval
+        self.max_lateness = max_lateness
+        self.delay = delay
+        self.redis = redis
+
+        self._task: Optional[asyncio.Task] = None
+
+    def last_write_of(self, bucket_start: int, bucket_end: int) -> int:
+        """
+        The time after which no more observations are accepted for the bucket.
+        """
+        expiry = self.repository.bucket_expiry(bucket_start)
+        if not self.max_lateness:
+            return expiry
+
+        return min(expiry, bucket_end + self.max_lateness)
+
+    def next_run(self, now: float) -> float:
+        """
+        The time of the next compaction after "now": the next multiple of the interval, or the final compaction
+        of a bucket if that comes first.
+        """
+        run_at = (now // self.interval + 1) * self.interval
+        if not self.max_lateness:
+            return run_at
+
+        # buckets stop accepting observations in the order they end, the earliest one still to come is the next one
+        offset = 1
+        while self.repository.bucket_start_for_offset(offset) + self.max_lateness + self.delay > now:
+            run_at = min(run_at, self.repository.bucket_start_for_offset(offset) + self.max_lateness + self.delay)
+            offset -= 1
+
+        return run_at
+
+    async def compact(self, run_at: Optional[float] = None) -> List[int]:
+        """
+        Archives all completed buckets which aren't final yet, unless another worker sharing the archive directory
+        has already done the compaction scheduled at "run_at" (default: the start of the current interval).
+        Returns the starts of the archived buckets.
+        """
+        now = time.time()
+        if run_at is None:
+            run_at = now // self.interval * self.interval
+
+        # all workers schedule the same compactions, the lock expires long after they started them
+        lock_key = f'{self.LOCK_KEY}:{self.archive.identity()}:{int(run_at)}'
+        interval_ms = int(self.interval * 1000)
+        if self.redis is not None and not await self.redis.set(lock_key, 1, nx=True, px=interval_ms):
+            return []
+
+        archived = []
+
+        offset = -1
+        bucket_end = self.repository.bucket_start_for_offset(0)
+        bucket_start = self.repository.bucket_start_for_offset(offset)
+
+        while self.repository.bucket_expiry(bucket_start) > now:
+            archived_at = self.archive.archived_at(bucket_start)
+            if archived_at is None or archived_at <= self.last_write_of(bucket_start, bucket_end):
+                bucket = MemoryBucket(expires_at=0)
+                async for entity in self.repository.get_many(await self.repository.find_in_bucket(offset)):
+                    bucket.add(entity.lab_id, entity)
+
+                self.archive.write(bucket_start, bucket_end - bucket_start, bucket)
+                archived.append(bucket_start)
+
+            offset -= 1
+            bucket_end, bucket_start = bucket_start, self.repository.bucket_start_for_offset(offset)
+
+        return archived
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        run_at = None
+        while True:
+            try:
+                await self.compact(run_at)
+            except Exception:
+                logger.exception('compacting buckets into the archive failed, retrying with the next compaction')
+
+            run_at = self.next_run(time.time())
+            await asyncio.sleep(max(0.0, run_at - time.time()))
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from typing import *
+
+from humtemp.database import AggregatesNotWritten
+from humtemp.dto.observation import Observation
+from humtemp.entities import BucketEntity, BucketKey
+from humtemp.metrics import OBSERVATIONS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+
+class ObservationBuffer:
+    """
+    In-process write-behind buffer for observations.
+
+    Observations are summed up per bucket key in memory and written to the repository with a single pipeline
+    every "flush_interval" seconds - or earlier, as soon as "max_keys" different buckets are pending.
+    This way, Redis load depends on the number of active labs instead of the number of pushed observations.
+
+    Buffered observations are not yet visible in summaries. If a worker dies without shutting down cleanly,
+    at most the observations of the last "flush_interval" seconds that this worker received are lost.
+    """
+    def __init__(self,
+                 repository: Any,
+                 flush_interval: float = 1.0,
+                 max_keys: int = 10000,
+                 on_flush: Optional[Callable[[Set[int]], Awaitable[None]]] = None):
+        self.repository = repository
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        # called with the starts of all buckets that were written by a flush
+        self.on_flush = on_flush
+
+        self._aggregates: Dict[BucketKey, BucketEntity] = {}
+        self._flush_requested = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._aggregates)
+
+    def add(self, observations: Iterable[Observation]) -> None:
+        self.repository.aggregate(observations, self._aggregates)
+
+        if len(self._aggregates) >= self.max_keys:
+            self._flush_requested.set()
+
+    async def flush(self) -> int:
+        """
+        Writes all pending aggregates to the repository. Aggregates which could not be written for transient reasons
+        are kept for the next flush, aggregates which redis rejected are dropped.
+        """
+        aggregates, self._aggregates = self._aggregates, {}
+        if not aggregates:
+            return 0
+
+        try:
+            written = await self.repository.add_aggregates(aggregates.values())
+        except AggregatesNotWritten as e:
+            # the other aggregates have been written, sending them again would count them twice
+            self._requeue(e.retryable)
+            if e.rejected:
+                OBSERVATIONS_DROPPED.inc(amount=sum(entity.num_observations for entity in e.rejected))
+                logger.error('dropped %d aggregates rejected by redis: %s', len(e.rejected), e.cause)
+
+            failed = {id(entity) for entity in e.retryable + e.rejected}
+            await self._notify([entity for entity in aggregates.values() if id(entity) not in failed])
+            raise
+        except Exception:
+            self._requeue(aggregates.values())
+            raise
+
+        await self._notify(aggregates.values())
+        return written
+
+    def _requeue(self, aggregates: Iterable[BucketEntity]) -> None:
+        for entity in aggregates:
+            pending = self._aggregates.get(entity.key)
+            if pending is None:
+                self._aggregates[entity.key] = entity
+            else:
+                pending.merge(entity)
+
+    async def _notify(self, written: Iterable[BucketEntity]) -> None:
+        bucket_starts = {entity.bucket_start for entity in written}
+        if self.on_flush is not None and bucket_starts:
+            await self.on_flush(bucket_starts)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic flushing and writes all remaining observations.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('flushing the observation buffer failed, retrying with the next flush')
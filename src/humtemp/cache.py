@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import *
+
+from redis.asyncio import Redis as AsyncRedis
+
+logger = logging.getLogger(__name__)
+
+
+class CachedSummary(NamedTuple):
+    body: bytes
+    etag: str
+    expires_at: float
+
+    @classmethod
+    def create(cls, body: bytes, expires_at: float) -> 'CachedSummary':
+        return cls(body=body, etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', expires_at=expires_at)
+
+    @property
+    def max_age(self) -> int:
+        return max(0, int(self.expires_at - time.time()))
+
+
+class SummaryCache:
+    """
+    Caches the encoded summary of every bucket, keyed by the bucket start.
+
+    The caller decides how long an entry stays valid: summaries of completed buckets until the bucket expires,
+    the summary of the current bucket (and of buckets which still accept late observations) only for a few seconds.
+    Entries are kept in-process and, if "redis" is given, additionally shared with all other workers.
+    """
+    KEY_PREFIX: ClassVar[str] = 'summary-cache'
+
+    def __init__(self, redis: Optional[AsyncRedis] = None, max_entries: int = 64):
+        self.redis = redis
+        self.max_entries = max_entries
+
+        self._entries: Dict[int, CachedSummary] = {}
+
+    async def get(self, bucket_start: int) -> Optional[CachedSummary]:
+        entry = self._entries.get(bucket_start)
+        if entry is not None and entry.expires_at > time.time():
+            return entry
+
+        if self.redis is None:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self._key(bucket_start))
+        pipe.pttl(self._key(bucket_start))
+        body, ttl_ms = await pipe.execute()
+
+        if body is None or ttl_ms <= 0:
+            return
+
+        entry = CachedSummary.create(body, time.time() + ttl_ms / 1000)
+        self._store(bucket_start, entry)
+        return entry
+
+    async def set(self, bucket_start: int, body: bytes, expires_at: float) -> CachedSummary:
+        entry = CachedSummary.create(body, expires_at)
+        self._store(bucket_start, entry)
+
+        if self.redis is not None:
+            ttl_ms = int((expires_at - time.time()) * 1000)
+            if ttl_ms > 0:
+                await self.redis.set(self._key(bucket_start), body, px=ttl_ms)
+
+        return entry
+
+    async def invalidate(self, bucket_starts: Iterable[int]) -> None:
+        """
+        Drops the entries of the buckets, in-process and shared. The in-process entries of other workers run into
+        their TTL.
+        """
+        bucket_starts = list(bucket_starts)
+        for bucket_start in bucket_starts:
+            self._entries.pop(bucket_start, None)
+
+        if self.redis is not None and bucket_starts:
+            await self.redis.delete(*map(self._key, bucket_starts))
+
+    def _store(self, bucket_start: int, entry: CachedSummary) -> None:
+        if len(self._entries) >= self.max_entries and bucket_start not in self._entries:
+            now = time.time()
+            for key in [key for key, cached in self._entries.items() if cached.expires_at <= now]:
+                del self._entries[key]
+
+            if len(self._entries) >= self.max_entries:
+                del self._entries[min(self._entries)]
+
+        self._entries[bucket_start] = entry
+
+    @classmethod
+    def _key(cls, bucket_start: int) -> str:
+        return f'{cls.KEY_PREFIX}:{bucket_start}'
+
+
+class SummaryMaterializer:
+    """
+    Writes the summary of every bucket into the summary cache once the bucket is final, i.e. "max_lateness" seconds
+    after it completed, when it stops accepting late observations (plus "delay" seconds for writes still in flight).
+    No request has to compute it from then on. With redis, a lock makes sure only one of all workers computes the
+    summary, and the summary is shared with all others.
+
+    Buckets accepting late observations until they expire never become final, so "max_lateness" must end before.
+    """
+    LOCK_PREFIX: ClassVar[str] = 'summary-lock'
+
+    def __init__(self,
+                 repository: Any,
+                 summary_cache: SummaryCache,
+                 render: Callable[[int], Awaitable[bytes]],
+                 delay: float = 10.0,
+                 max_lateness: int = 0,
+                 lock_timeout: float = 60.0,
+                 retry_interval: float = 5.0):
+        self.repository = repository
+        self.summary_cache = summary_cache
+        # encodes the summary of the bucket at the given offset
+        self.render = render
+        self.delay = delay
+        self.max_lateness = max_lateness
+        # if the worker holding the lock dies, another worker can materialize the summary after this many seconds
+        self.lock_timeout = lock_timeout
+        # seconds after which a failed materialization is tried again
+        self.retry_interval = retry_interval
+
+        self._task: Optional[asyncio.Task] = None
+
+    def final_at(self, bucket_start: int, bucket_end: int) -> Optional[int]:
+        """
+        The time from which no more observations are accepted for the bucket, None if that's only once it expired.
+        """
+        final_at = bucket_end + self.max_lateness
+        if not self.max_lateness or final_at >= self.repository.bucket_expiry(bucket_start):
+            return
+
+        return final_at
+
+    async def materialize(self) -> bool:
+        """
+        Materializes the summary of the last completed bucket if it is final, unless it has already been materialized
+        or another worker is doing so. Returns whether this worker has materialized it.
+        """
+        bucket_start = self.repository.bucket_start_for_offset(-1)
+        final_at = self.final_at(bucket_start, self.repository.bucket_start_for_offset(0))
+        if final_at is None or time.time() < final_at:
+            return False
+
+        expires_at = self.repository.bucket_expiry(bucket_start)
+        redis = self.summary_cache.redis
+
+        # requests may have cached a summary of the bucket before, which must be replaced anyway. So the lock, not the
+        # cached summary, tells whether the summary has been materialized.
+        lock_key = f'{self.LOCK_PREFIX}:{bucket_start}'
+        if redis is not None and not await redis.set(lock_key, 1, nx=True, px=int(self.lock_timeout * 1000)):
+            return False
+
+        try:
+            body = await self.render(-1)
+            await self.summary_cache.set(bucket_start, body, expires_at)
+        except Exception:
+            # another attempt (by any worker) doesn't have to wait for the lock to time out
+            if redis is not None:
+                await redis.delete(lock_key)
+            raise
+
+        if redis is not None:
+            # the bucket doesn't change anymore, so the lock is kept until it expires
+            await redis.expireat(lock_key, int(expires_at))
+
+        return True
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _next_run(self) -> float:
+        # the last completed bucket becomes final "max_lateness" seconds after the current bucket started
+        next_run = self.repository.bucket_start_for_offset(0) + self.max_lateness + self.delay
+        if next_run <= time.time():
+            next_run = self.repository.bucket_start_for_offset(1) + self.max_lateness + self.delay
+
+        return next_run
+
+    async def _run(self) -> None:
+        # right after a (re)start, the last completed bucket may not have been materialized yet
+        while True:
+            try:
+                await self.materialize()
+            except Exception:
+                logger.exception('materializing the summary of the last completed bucket failed, retrying')
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            await asyncio.sleep(max(0.0, self._next_run() - time.time()))
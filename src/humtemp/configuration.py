@@ -1,13 +1,47 @@
+import os
 from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import *
 
 from pydantic import BaseSettings
 
 
 class Settings(BaseSettings):
+    # address the server started with "python -m humtemp" listens on
+    humtemp_bind: str = '0.0.0.0:8000'
+    # number of worker processes started by "python -m humtemp". 0 starts one worker per available CPU core.
+    humtemp_workers: int = 0
+
+    # where the buckets are stored: "redis", or "memory" for a single process without redis
+    humtemp_storage: Literal['redis', 'memory'] = 'redis'
+    # with humtemp_storage "memory": optional file the buckets are periodically saved to, and restored from on startup
+    humtemp_snapshot_path: Optional[str] = None
+    # with humtemp_storage "memory": seconds between two sweeps of expired buckets (and snapshots)
+    humtemp_snapshot_interval: float = 60.0
+
     # redis database connection parameters
     humtemp_redis_host: str = 'localhost'
     humtemp_redis_port: int = 6379
     humtemp_redis_db: int = 0
+    # maximum number of concurrent redis connections per application worker (and per shard)
+    humtemp_redis_pool_size: int = 50
+    # optional list of "host:port" entries of independent redis instances. If given, labs are distributed
+    # to these shards using consistent hashing - and humtemp_redis_host / humtemp_redis_port are ignored.
+    humtemp_redis_shards: List[str] = []
+    # store all labs of a bucket as fields of a single hash, with the aggregates packed into one value per lab.
+    # Needs much less redis memory than one hash per lab and bucket. See humtemp.migrate for switching over.
+    humtemp_redis_compact_layout: bool = False
+
+    # per-worker admission control: maximum number of requests handled concurrently, 0 disables it
+    humtemp_admission_max_concurrent: int = 0
+    # number of requests waiting for a slot, beyond which requests are rejected with 429 right away
+    humtemp_admission_max_queue: int = 100
+    # seconds a request waits for a slot before it is rejected with 503
+    humtemp_admission_queue_timeout: float = 1.0
+    # slots only available to /summary requests, so health checks stay responsive under load
+    humtemp_admission_summary_reserved: int = 4
+    # value of the Retry-After header of rejected requests, in seconds
+    humtemp_admission_retry_after: int = 1
 
     # humtemp divides the time into buckets. Bucket boundaries will be aligned to this offset
     humtemp_bucket_offset: str = '1970-01-01T00:00:00+00:00'
@@ -17,6 +51,73 @@ class Settings(BaseSettings):
     # how many old buckets should be kept in the database. This number includes the "current" bucket.
     # Example "2": Keeps the currently active bucket, as well as 1 bucket in the past.
     humtemp_bucket_retention: int = 2
+    # observations older than this many seconds are rejected, 0 only rejects observations for expired buckets.
+    # Accepted observations for already completed buckets are counted as late.
+    humtemp_max_lateness: int = 0
+
+    # optionally aggregate observations in memory and write them to redis periodically ("write-behind").
+    # At most "flush_interval" seconds of observations per worker are lost if a worker crashes.
+    humtemp_buffer_enabled: bool = False
+    # seconds between two flushes of the in-memory buffer
+    humtemp_buffer_flush_interval: float = 1.0
+    # number of pending buckets which triggers a flush before the interval elapsed
+    humtemp_buffer_max_keys: int = 10000
+
+    # only append observations to a redis stream, from which they are applied by "python -m humtemp.consumer"
+    humtemp_stream_enabled: bool = False
+    # redis key of the stream, and name of the consumer group applying it
+    humtemp_stream_key: str = 'observation-stream'
+    humtemp_stream_group: str = 'humtemp'
+    # maximum number of stream entries (one per request) a consumer applies at once
+    humtemp_stream_batch_size: int = 1000
+    # approximate maximum number of stream entries. Beyond it, the oldest entries are trimmed even if they haven't been
+    # applied yet. 0 doesn't bound the stream.
+    humtemp_stream_max_length: int = 100000
+    # entries a consumer hasn't acknowledged for this many seconds are taken over by another consumer
+    humtemp_stream_claim_idle: float = 60.0
+
+    # seconds for which the summary of the current bucket, and of completed buckets which still accept late
+    # observations, is cached. Other summaries are cached until the bucket expires.
+    humtemp_summary_cache_ttl: float = 5.0
+    # additionally share cached summaries between all workers via redis
+    humtemp_summary_cache_shared: bool = False
+    # compute the summary of every bucket once (by a single worker), "delay" seconds after the bucket stopped
+    # accepting late observations. Requires humtemp_max_lateness to end before the bucket expires.
+    # The summaries are shared between all workers via redis.
+    humtemp_summary_materialize: bool = False
+    humtemp_summary_materialize_delay: float = 10.0
+
+    # optional duration (in seconds) of sub-buckets ("rollups") within every bucket, 0 disables rollups.
+    # Must divide humtemp_bucket_duration without remainder. Summaries over arbitrary time ranges are merged from them.
+    humtemp_rollup_duration: int = 0
+
+    # optional directory completed buckets are archived to, served by /archive/summary beyond humtemp_bucket_retention
+    humtemp_archive_path: Optional[str] = None
+    # seconds between two compactions of completed buckets into the archive
+    humtemp_archive_interval: float = 300.0
+
+    # maintain mergeable sketches per lab and bucket, for the median / 95th percentile of the temperature and the
+    # number of distinct sensors ("sensor_id") in summaries. Not supported by humtemp_storage "memory".
+    humtemp_sketches_enabled: bool = False
+    # maximum relative error of the estimated temperature percentiles
+    humtemp_sketch_relative_accuracy: float = 0.01
+
+    # how many buckets are fetched from redis in a single pipelined round trip when building summaries
+    humtemp_fetch_chunk_size: int = 1000
+
+    @property
+    def workers(self) -> int:
+        # the memory storage is private to its process
+        if self.humtemp_storage == 'memory':
+            return 1
+        if self.humtemp_workers > 0:
+            return self.humtemp_workers
+
+        try:
+            # respects CPU affinity restrictions, e.g. of container runtimes
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return os.cpu_count() or 1
 
     @property
     def bucket_offset(self) -> datetime:
@@ -26,8 +127,14 @@ class Settings(BaseSettings):
     def bucket_duration(self):
         return timedelta(seconds=self.humtemp_bucket_duration)
 
+    @property
+    def rollup_duration(self):
+        return timedelta(seconds=self.humtemp_rollup_duration)
 
-settings = Settings()
 
-print('Running with Settings:')
-print(settings.json(indent=2))
+@lru_cache()
+def get_settings() -> Settings:
+    """
+    The settings are read from the environment on first use, not when this module is imported.
+    """
+    return Settings()
@@ -0,0 +1,71 @@
+"""
+Starts a consumer of the ingestion stream (see "humtemp_stream_enabled"), independently of the API workers.
+
+Run as many consumers as needed to keep the stream length (metric "humtemp_stream_length") low.
+Every consumer applies one batch of observations at a time, and finishes it before exiting on SIGINT / SIGTERM.
+"""
+import asyncio
+import os
+import signal
+import socket
+
+from humtemp import database, sharding
+from humtemp.configuration import get_settings
+from humtemp.database import AsyncBucketRepository, connect_async, disconnect_async, load_scripts
+from humtemp.stream import StreamConsumer
+
+
+async def consume() -> None:
+    settings = get_settings()
+
+    if settings.humtemp_redis_shards:
+        sharding.connect_shards(
+            settings.humtemp_redis_shards,
+            db=settings.humtemp_redis_db,
+            pool_size=settings.humtemp_redis_pool_size
+        )
+        connections = list(sharding.shard_connections.values())
+        repository = sharding.ShardedBucketRepository({
+            node: AsyncBucketRepository(redis=redis) for node, redis in sharding.shard_connections.items()
+        }, ring=sharding.ring)
+    else:
+        connect_async(
+            host=settings.humtemp_redis_host,
+            port=settings.humtemp_redis_port,
+            db=settings.humtemp_redis_db,
+            pool_size=settings.humtemp_redis_pool_size
+        )
+        connections = [database.async_connection]
+        repository = AsyncBucketRepository()
+
+    for redis in connections:
+        await load_scripts(redis)
+
+    # like the API, the stream lives on the first shard
+    consumer = StreamConsumer(
+        connections[0],
+        repository,
+        name=f'{socket.gethostname()}-{os.getpid()}',
+        stream=settings.humtemp_stream_key,
+        group=settings.humtemp_stream_group,
+        batch_size=settings.humtemp_stream_batch_size,
+        claim_idle=settings.humtemp_stream_claim_idle
+    )
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, consumer.stop)
+
+    try:
+        await consumer.run()
+    finally:
+        await disconnect_async()
+        await sharding.disconnect_shards()
+
+
+def main() -> None:
+    asyncio.run(consume())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,145 @@
+import hashlib
+import time
+from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
+from itertools import islice
 from typing import *
 
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis, BlockingConnectionPool
+from redis.client import Pipeline
+from redis.exceptions import (BusyLoadingError, MasterDownError, NoScriptError, OutOfMemoryError, ReadOnlyError,
+                              TryAgainError)
 
-from humtemp.configuration import settings
-from humtemp.dto.observation import Observation
-from humtemp.entities import BucketEntity, BucketKey
+from humtemp import sketch
+from humtemp.configuration import get_settings
+from humtemp.dto.observation import LabId, Observation
+from humtemp.entities import BucketEntity, BucketKey, RollupEntity
+from humtemp.metrics import BUCKET_KEYS_EXAMINED, OBSERVATIONS_INGESTED, OBSERVATIONS_LATE, REDIS_DURATION
+
+# Adds aggregated observations to a bucket and registers the lab in the bucket index - atomically, in one command.
+# KEYS: bucket key, bucket index key
+# ARGV: lab id, expiry timestamp, number of observations, sum of temperatures, sum of humidities,
+#       sum of squared temperatures, sum of squared humidities, min/max temperature, min/max humidity,
+#       number of late observations
+INCREMENT_SCRIPT = """
+local function update_extreme(field, value, is_min)
+    local current = tonumber(redis.call('HGET', KEYS[1], field))
+    local candidate = tonumber(value)
+    if current == nil or (is_min and candidate < current) or (not is_min and candidate > current) then
+        redis.call('HSET', KEYS[1], field, value)
+    end
+end
+
+-- scripts aren't rolled back if a command fails, so the bucket is indexed and expires before anything can fail
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIREAT', KEYS[2], ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'num_observations', ARGV[3])
+redis.call('EXPIREAT', KEYS[1], ARGV[2])
+
+redis.call('HINCRBY', KEYS[1], 'num_late', ARGV[12])
+redis.call('HINCRBYFLOAT', KEYS[1], 'sum_temp', ARGV[4])
+redis.call('HINCRBYFLOAT', KEYS[1], 'sum_humidity', ARGV[5])
+redis.call('HINCRBYFLOAT', KEYS[1], 'sumsq_temp', ARGV[6])
+redis.call('HINCRBYFLOAT', KEYS[1], 'sumsq_humidity', ARGV[7])
+update_extreme('min_temp', ARGV[8], true)
+update_extreme('max_temp', ARGV[9], false)
+update_extreme('min_humidity', ARGV[10], true)
+update_extreme('max_humidity', ARGV[11], false)
+"""
+INCREMENT_SCRIPT_SHA = hashlib.sha1(INCREMENT_SCRIPT.encode('utf8')).hexdigest()
+
+# Fields of the compact layout, in the order they are packed into a single comma-separated value per lab.
+# Unknown minimum / maximum values are empty.
+COMPACT_FIELDS = ('num_observations', 'num_late', 'sum_temp', 'sum_humidity', 'sumsq_temp', 'sumsq_humidity',
+                  'min_temp', 'max_temp', 'min_humidity', 'max_humidity')
+
+# Merges aggregates given in the order of COMPACT_FIELDS into the packed value of a lab in a compact bucket hash.
+# Floats are formatted with 17 significant digits, so they survive the round trip without losing precision.
+COMPACT_MERGE_FUNCTION = """
+local function merge(key, lab_id, increments)
+    local values = {}
+    local current = redis.call('HGET', key, lab_id)
+    if current then
+        local start = 1
+        for i = 1, 10 do
+            local stop = string.find(current, ',', start, true) or (#current + 1)
+            values[i] = tonumber(string.sub(current, start, stop - 1))
+            start = stop + 1
+        end
+    end
+
+    local packed = {}
+    for i = 1, 10 do
+        local value = values[i]
+        local increment = tonumber(increments[i])
+        if i <= 6 then
+            value = (value or 0) + (increment or 0)
+        elseif increment ~= nil and (value == nil or (i % 2 == 1 and increment < value)
+                                                  or (i % 2 == 0 and increment > value)) then
+            value = increment
+        end
+
+        if value == nil then
+            packed[i] = ''
+        elseif i <= 2 then
+            packed[i] = string.format('%d', value)
+        else
+            packed[i] = string.format('%.17g', value)
+        end
+    end
+
+    redis.call('HSET', key, lab_id, table.concat(packed, ','))
+end
+"""
+
+# INCREMENT_SCRIPT for the compact layout, the hash of the bucket is its own index.
+# KEYS: compact bucket key
+# ARGV: lab id, expiry timestamp, aggregates in the order of COMPACT_FIELDS
+COMPACT_INCREMENT_SCRIPT = COMPACT_MERGE_FUNCTION + """
+merge(KEYS[1], ARGV[1], {unpack(ARGV, 3, 12)})
+redis.call('EXPIREAT', KEYS[1], ARGV[2])
+"""
+COMPACT_INCREMENT_SCRIPT_SHA = hashlib.sha1(COMPACT_INCREMENT_SCRIPT.encode('utf8')).hexdigest()
+
+# Moves a bucket of the original layout into the compact bucket hash, merging it with what is already there.
+# The bucket is removed from its index, so running the migration again doesn't count anything twice.
+# KEYS: bucket key, bucket index key, compact bucket key
+# ARGV: lab id, expiry timestamp
+MIGRATE_SCRIPT = COMPACT_MERGE_FUNCTION + """
+local fields = {""" + ', '.join(f"'{field}'" for field in COMPACT_FIELDS) + """}
+local data = redis.call('HGETALL', KEYS[1])
+if #data > 0 then
+    local hash = {}
+    for i = 1, #data, 2 do
+        hash[data[i]] = data[i + 1]
+    end
+
+    local increments = {}
+    for i, field in ipairs(fields) do
+        increments[i] = hash[field] or ''
+    end
+
+    merge(KEYS[3], ARGV[1], increments)
+    redis.call('EXPIREAT', KEYS[3], ARGV[2])
+end
+
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[1])
+return #data > 0 and 1 or 0
+"""
+
+# name, encoded name and type of every field of the bucket hash. The type is used to convert the raw values directly,
+# without validating them again.
+ENTITY_FIELDS = [(name, name.encode('utf8'), BucketEntity.__fields__[name].type_) for name in COMPACT_FIELDS]
+COMPACT_FIELD_TYPES = [BucketEntity.__fields__[name].type_ for name in COMPACT_FIELDS]
+
+# errors of single commands which go away by themselves, so the command can be sent again later
+TRANSIENT_ERRORS = (BusyLoadingError, MasterDownError, OutOfMemoryError, ReadOnlyError, TryAgainError)
+TRANSIENT_ERROR_PREFIXES = ('BUSY ',)
 
 connection: Optional[Redis] = None
+async_connection: Optional[AsyncRedis] = None
 
 
 def connect(host: str = 'localhost', port: int = 6379, db: int = 0) -> None:
@@ -15,21 +147,98 @@ def connect(host: str = 'localhost', port: int = 6379, db: int = 0) -> None:
     connection = Redis(host=host, port=port, db=db, encoding='utf8')
 
 
-class BucketRepository:
+def connect_async(host: str = 'localhost', port: int = 6379, db: int = 0, pool_size: int = 50) -> None:
+    """
+    Creates the asyncio connection pool. Connections are opened lazily, so this must be called
+    from within the event loop that will use them (e.g. in an application startup hook).
+    If all "pool_size" connections are in use, further commands wait for a connection to be released.
+    """
+    global async_connection
+    pool = BlockingConnectionPool(host=host, port=port, db=db, encoding='utf8', max_connections=pool_size)
+    async_connection = AsyncRedis(connection_pool=pool)
+
+
+async def load_scripts(redis: AsyncRedis) -> None:
+    """
+    Preloads the Lua scripts, so that they can be called by their SHA1 right from the start.
+    """
+    await redis.script_load(INCREMENT_SCRIPT)
+    await redis.script_load(COMPACT_INCREMENT_SCRIPT)
+
+
+async def disconnect_async() -> None:
+    global async_connection
+    if async_connection is None:
+        return
+
+    await async_connection.close()
+    await async_connection.connection_pool.disconnect()
+    async_connection = None
+
+
+class AggregatesNotWritten(Exception):
+    """
+    Raised by add_aggregates() if some of the aggregates could not be written. All others have been written.
+
+    "retryable" failed for transient reasons and may be written again later, redis rejected "rejected" for good.
+    """
     def __init__(self,
-                 bucket_offset: datetime = settings.bucket_offset,
-                 bucket_duration: timedelta = settings.bucket_duration,
-                 bucket_retention: int = settings.humtemp_bucket_retention,
+                 retryable: Sequence[BucketEntity] = (),
+                 rejected: Sequence[BucketEntity] = (),
+                 cause: Optional[Exception] = None):
+        super().__init__(f'{len(retryable)} aggregates not written, {len(rejected)} aggregates rejected: {cause}')
+        self.retryable = list(retryable)
+        self.rejected = list(rejected)
+        self.cause = cause
+
+
+class _BucketRepositoryBase(ABC):
+    """
+    Bucket arithmetic, key handling and command construction shared by the blocking and the asyncio repository.
+    """
+    def __init__(self,
+                 bucket_offset: Optional[datetime] = None,
+                 bucket_duration: Optional[timedelta] = None,
+                 bucket_retention: Optional[int] = None,
+                 fetch_chunk_size: Optional[int] = None,
+                 rollup_duration: Optional[timedelta] = None,
+                 max_lateness: Optional[int] = None,
+                 compact_layout: Optional[bool] = None,
+                 sketches: Optional[bool] = None,
+                 sketch_accuracy: Optional[float] = None,
+
+                 redis: Optional[Any] = None):
+        """
+        All bucket parameters default to the application settings.
+        """
+        settings = get_settings()
+        if bucket_offset is None:
+            bucket_offset = settings.bucket_offset
+        if bucket_duration is None:
+            bucket_duration = settings.bucket_duration
+        if bucket_retention is None:
+            bucket_retention = settings.humtemp_bucket_retention
+        if fetch_chunk_size is None:
+            fetch_chunk_size = settings.humtemp_fetch_chunk_size
+        if rollup_duration is None:
+            rollup_duration = settings.rollup_duration
+        if max_lateness is None:
+            max_lateness = settings.humtemp_max_lateness
+        if compact_layout is None:
+            compact_layout = settings.humtemp_redis_compact_layout
+        if sketches is None:
+            sketches = settings.humtemp_sketches_enabled
+        if sketch_accuracy is None:
+            sketch_accuracy = settings.humtemp_sketch_relative_accuracy
 
-                 redis: Optional[Redis] = None):
         self.prefix = 'bucket'
 
         if redis is None:
-            redis = connection
+            redis = self._default_connection()
         if redis is None:
             raise ValueError('connection to redis is not yet initialized')
 
-        self.connection: Redis = redis
+        self.connection = redis
 
         if bucket_offset.utcoffset() is None:
             raise ValueError('"bucket_offset" must be given a timezone-aware datetime object')
@@ -37,53 +246,637 @@ class BucketRepository:
         self.bucket_offset = int(bucket_offset.timestamp())
         self.bucket_duration = int(bucket_duration.total_seconds())
         self.bucket_retention = bucket_retention
+        self.fetch_chunk_size = fetch_chunk_size
 
-    def add_observation(self, observation: Observation) -> None:
-        observation_bucket_start = self._get_bucket_start(observation.timestamp)
-        key = BucketEntity.construct_key(observation.lab_id, observation_bucket_start)
+        self.rollup_duration = int(rollup_duration.total_seconds())
+        if self.rollup_duration and self.bucket_duration % self.rollup_duration != 0:
+            raise ValueError('"rollup_duration" must divide "bucket_duration" without remainder')
 
-        pipe = self.connection.pipeline()
+        self.max_lateness = max_lateness
+        self.compact_layout = compact_layout
+        self.sketch_mapping = sketch.get_mapping(sketch_accuracy) if sketches else None
 
-        pipe.hincrby(key, 'num_observations', 1)
-        pipe.hincrbyfloat(key, 'sum_temp', observation.temp)
-        pipe.hincrbyfloat(key, 'sum_humidity', observation.humidity)
+    @staticmethod
+    @abstractmethod
+    def _default_connection() -> Optional[Any]:
+        """
+        The connection used if none is given, None if it hasn't been initialized yet.
+        """
 
-        pipe.expireat(key, observation_bucket_start + self.bucket_retention * self.bucket_duration)
+    def aggregate(self,
+                  observations: Iterable[Observation],
+                  aggregates: Optional[Dict[BucketKey, BucketEntity]] = None,
+                  ingested_at: Optional[int] = None) -> Dict[BucketKey, BucketEntity]:
+        """
+        Sums up the observations per bucket key, optionally into an existing dict of aggregates.
+        Observations are late if their bucket had been completed when they were received ("ingested_at", default: now).
+        """
+        if aggregates is None:
+            aggregates = {}
 
-        pipe.execute()
+        current_bucket_start = self._get_bucket_start(ingested_at)
 
-    def find_in_bucket(self, offset: int = 0) -> Iterable[BucketKey]:
-        keys = self.connection.scan_iter(match=f'{self.prefix}:*')
-        deconstructed_keys = map(BucketEntity.deconstruct_key, keys)
-        deconstructed_keys = filter(lambda x: self._timestamp_is_in_bucket(x[1], offset), deconstructed_keys)
-        keys = map(lambda x: BucketEntity.construct_key(*x), deconstructed_keys)
+        for observation in observations:
+            observation_bucket_start = self._get_bucket_start(observation.timestamp)
+            # observations for already completed buckets are tagged as late
+            late = observation_bucket_start < current_bucket_start
+            self._aggregate_into(aggregates, BucketEntity, observation, observation_bucket_start, late)
 
-        return keys
+            if self.rollup_duration:
+                rollup_start = self._get_bucket_start(observation.timestamp, self.rollup_duration)
+                self._aggregate_into(aggregates, RollupEntity, observation, rollup_start, late)
 
-    def get(self, key: BucketKey) -> Optional[BucketEntity]:
-        data = self.connection.hgetall(key)
+        return aggregates
+
+    def _aggregate_into(self,
+                        aggregates: Dict[BucketKey, BucketEntity],
+                        entity_type: Type[BucketEntity],
+                        observation: Observation,
+                        bucket_start: int,
+                        late: bool) -> None:
+        key = entity_type.construct_key(observation.lab_id, bucket_start)
+
+        entity = aggregates.get(key)
+        if entity is None:
+            entity = aggregates[key] = entity_type(key=key)
+
+        entity.add(observation.temp, observation.humidity, late)
+
+        if self.sketch_mapping is not None:
+            sketch_key = self.sketch_mapping.key(observation.temp)
+            entity.temp_sketch[sketch_key] = entity.temp_sketch.get(sketch_key, 0) + 1
+            if observation.sensor_id:
+                entity.sensor_ids.add(observation.sensor_id)
+
+    def earliest_accepted_timestamp(self) -> int:
+        """
+        Observations older than this must be rejected: their bucket has already expired,
+        or they are older than "max_lateness" seconds.
+        """
+        earliest = self.bucket_start_for_offset(1 - self.bucket_retention)
+        if self.max_lateness:
+            earliest = max(earliest, int(time.time()) - self.max_lateness)
+
+        return earliest
 
-        if data is None:
+    def _chunks(self, keys: Iterable[BucketKey]) -> Iterator[List[BucketKey]]:
+        keys = iter(keys)
+
+        while True:
+            chunk = list(islice(keys, self.fetch_chunk_size))
+            if not chunk:
+                return
+
+            yield chunk
+
+    @staticmethod
+    def _keys_from_index(bucket_start: int,
+                         lab_ids: Iterable[bytes],
+                         entity_type: Type[BucketEntity] = BucketEntity) -> List[BucketKey]:
+        return [entity_type.construct_key(lab_id.decode('utf8'), bucket_start) for lab_id in lab_ids]
+
+    @staticmethod
+    def _parse_cursor(cursor: Optional[str]) -> int:
+        if cursor is None:
+            return 0
+
+        if not cursor.isdigit():
+            raise ValueError(f'invalid cursor "{cursor}"')
+
+        return int(cursor)
+
+    # The following commands depend on the layout. They can be sent directly (returning the result, or an awaitable
+    # with asyncio) or queued on a pipeline.
+
+    def _read_index(self, redis: Any, bucket_start: int, entity_type: Type[BucketEntity] = BucketEntity) -> Any:
+        """
+        Reads the lab ids of a bucket: the members of its index, or the fields of its compact hash.
+        """
+        if self.compact_layout:
+            return redis.hkeys(entity_type.construct_compact_key(bucket_start))
+
+        return redis.smembers(entity_type.construct_index_key(bucket_start))
+
+    def _scan_index(self, redis: Any, bucket_start: int, cursor: Optional[str], count: Optional[int]) -> Any:
+        """
+        Returns the next cursor and the lab ids (with the compact layout: a dict of lab ids and unused values).
+        """
+        cursor, count = self._parse_cursor(cursor), count or self.fetch_chunk_size
+        if self.compact_layout:
+            return redis.hscan(BucketEntity.construct_compact_key(bucket_start), cursor=cursor, count=count)
+
+        return redis.sscan(BucketEntity.construct_index_key(bucket_start), cursor=cursor, count=count)
+
+    def _read_entity(self, redis: Any, key: BucketKey, entity_type: Type[BucketEntity] = BucketEntity) -> Any:
+        """
+        Reads the data of a bucket, to be decoded with _decode_entity().
+        """
+        if self.compact_layout:
+            lab_id, bucket_start = entity_type.deconstruct_key(key)
+            return redis.hget(entity_type.construct_compact_key(bucket_start), lab_id)
+
+        return redis.hgetall(key)
+
+    def _read_sketches(self, pipe: Pipeline, key: BucketKey, entity_type: Type[BucketEntity] = BucketEntity) -> None:
+        """
+        Queues reading the temperature sketch and counting the distinct sensors of a bucket, see _decode_entities().
+        """
+        lab_id, bucket_start = entity_type.deconstruct_key(key)
+        pipe.hgetall(entity_type.construct_sketch_key(lab_id, bucket_start))
+        pipe.pfcount(entity_type.construct_sensors_key(lab_id, bucket_start))
+
+    def _queue_reads(self, pipe: Pipeline, keys: Iterable[BucketKey], entity_type: Type[BucketEntity]) -> None:
+        for key in keys:
+            self._read_entity(pipe, key, entity_type)
+            if self.sketch_mapping is not None:
+                self._read_sketches(pipe, key, entity_type)
+
+    def _decode_entities(self,
+                         keys: List[BucketKey],
+                         results: List[Any],
+                         entity_type: Type[BucketEntity]) -> Iterator[BucketEntity]:
+        """
+        Decodes the results of a pipeline filled by _queue_reads(), skipping keys that don't exist (anymore).
+        """
+        stride = 1 if self.sketch_mapping is None else 3
+        for key, offset in zip(keys, range(0, len(results), stride)):
+            entity = self._decode_entity(key, results[offset], entity_type)
+            if entity is None:
+                continue
+
+            if stride > 1:
+                entity.temp_sketch = {field.decode('ascii'): int(count) for field, count in results[offset + 1].items()}
+                entity.num_sensors = results[offset + 2]
+
+            yield entity
+
+    def _queue_sensor_counts(self,
+                             pipe: Pipeline,
+                             keys: Iterable[BucketKey],
+                             entity_type: Type[BucketEntity]) -> List[LabId]:
+        """
+        Queues one PFCOUNT per lab over the sensors of all its given buckets, which estimates the number of distinct
+        sensors within their union. Returns the lab ids in the order of the queued commands.
+        """
+        sensor_keys: Dict[LabId, List[str]] = {}
+        for key in keys:
+            lab_id, bucket_start = entity_type.deconstruct_key(key)
+            sensor_keys.setdefault(lab_id, []).append(entity_type.construct_sensors_key(lab_id, bucket_start))
+
+        for lab_sensor_keys in sensor_keys.values():
+            pipe.pfcount(*lab_sensor_keys)
+
+        return list(sensor_keys)
+
+    @staticmethod
+    def _decode_entity(key: BucketKey,
+                       data: Union[Dict[bytes, bytes], bytes, None],
+                       entity_type: Type[BucketEntity] = BucketEntity) -> Optional[BucketEntity]:
+        """
+        Builds the entity without validation: the data has been written by the repository, and converting
+        the raw values directly is several times faster.
+        """
+        if not data:
             return
 
-        return BucketEntity(
-            key=key,
-            num_observations=data[b'num_observations'],
-            sum_temp=data[b'sum_temp'],
-            sum_humidity=data[b'sum_humidity']
-        )
+        if isinstance(data, bytes):
+            # packed value of the compact layout
+            return entity_type.construct(key=key, **{
+                field: type_(value)
+                for field, type_, value in zip(COMPACT_FIELDS, COMPACT_FIELD_TYPES, data.split(b',')) if value
+            })
 
-    def _timestamp_is_in_bucket(self, timestamp, offset: int = 0):
-        current_bucket_start = self._get_bucket_start()
+        # buckets written by older versions don't contain all fields
+        return entity_type.construct(key=key, **{
+            field: type_(data[encoded_field]) for field, encoded_field, type_ in ENTITY_FIELDS if encoded_field in data
+        })
+
+    @classmethod
+    def _check_written(cls, aggregates: Sequence[BucketEntity], results: Sequence[Any]) -> int:
+        """
+        Counts the aggregates whose INCREMENT_SCRIPT call succeeded, given the results of the calls in the same order.
+        Raises AggregatesNotWritten for the others.
+        """
+        written, retryable, rejected = [], [], []
+        cause = None
+        for entity, result in zip(aggregates, results):
+            if not isinstance(result, Exception):
+                written.append(entity)
+                continue
+
+            cause = result
+            if isinstance(result, TRANSIENT_ERRORS) or str(result).startswith(TRANSIENT_ERROR_PREFIXES):
+                retryable.append(entity)
+            else:
+                rejected.append(entity)
+
+        cls._count_ingested(written)
+        if retryable or rejected:
+            raise AggregatesNotWritten(retryable, rejected, cause)
+
+        return len(written)
+
+    @staticmethod
+    def _count_ingested(aggregates: Iterable[BucketEntity]) -> None:
+        for entity in aggregates:
+            # rollups contain the same observations again
+            if type(entity) is BucketEntity:
+                OBSERVATIONS_INGESTED.inc(entity.bucket_start, amount=entity.num_observations)
+                if entity.num_late:
+                    OBSERVATIONS_LATE.inc(amount=entity.num_late)
+
+    def _rollup_starts(self, start: int, end: int) -> List[int]:
+        """
+        Starts of all sub-buckets overlapping the time range [start, end), limited to the retained buckets.
+        """
+        if not self.rollup_duration:
+            raise ValueError('rollups are not enabled')
+
+        oldest_retained = self.bucket_start_for_offset(1 - self.bucket_retention)
+        start = max(self._get_bucket_start(start, self.rollup_duration), oldest_retained)
+
+        return list(range(start, end, self.rollup_duration))
+
+    def _bucket_starts(self, from_offset: int, to_offset: int) -> List[int]:
+        """
+        Starts of the buckets from "from_offset" to "to_offset" (inclusive), limited to the retained buckets.
+        """
+        current = self.bucket_start_for_offset(0)
+        from_offset = max(from_offset, 1 - self.bucket_retention)
+        to_offset = min(to_offset, 0)
+
+        return [current + offset * self.bucket_duration for offset in range(from_offset, to_offset + 1)]
+
+    def _queue_increments(self, pipe: Pipeline, aggregates: Iterable[BucketEntity], preloaded: bool = True) -> None:
+        """
+        Queues one INCREMENT_SCRIPT call per aggregate. Usually, the script is referenced by its SHA1.
+        If Redis doesn't know the script (yet), the pipeline is retried with "preloaded=False", sending the script body.
+        """
+        for entity in aggregates:
+            lab_id, bucket_start = type(entity).deconstruct_key(entity.key)
+
+            # the index of labs per bucket allows finding all keys of a bucket without scanning the keyspace.
+            # Rollups expire together with the bucket they are part of.
+            expiry = self.bucket_expiry(self._get_bucket_start(bucket_start))
+
+            if self.compact_layout:
+                keys = (type(entity).construct_compact_key(bucket_start),)
+                args = (lab_id, expiry, *('' if value is None else value
+                                          for value in (getattr(entity, field) for field in COMPACT_FIELDS)))
+                script, script_sha = COMPACT_INCREMENT_SCRIPT, COMPACT_INCREMENT_SCRIPT_SHA
+            else:
+                keys = (entity.key, type(entity).construct_index_key(bucket_start))
+                args = (lab_id, expiry,
+                        entity.num_observations, entity.sum_temp, entity.sum_humidity,
+                        entity.sumsq_temp, entity.sumsq_humidity,
+                        entity.min_temp, entity.max_temp, entity.min_humidity, entity.max_humidity,
+                        entity.num_late)
+                script, script_sha = INCREMENT_SCRIPT, INCREMENT_SCRIPT_SHA
 
-        bucket_start = current_bucket_start + offset * self.bucket_duration
+            if preloaded:
+                pipe.evalsha(script_sha, len(keys), *keys, *args)
+            else:
+                pipe.eval(script, len(keys), *keys, *args)
+
+    def _queue_sketch_updates(self, pipe: Pipeline, aggregates: Iterable[BucketEntity]) -> None:
+        """
+        Queues adding the sketches of the aggregates to the sketches stored next to their buckets. Unlike the scripts,
+        these commands must not be sent again when retrying after a NoScriptError.
+        """
+        for entity in aggregates:
+            if not entity.temp_sketch and not entity.sensor_ids:
+                continue
+
+            lab_id, bucket_start = type(entity).deconstruct_key(entity.key)
+            expiry = self.bucket_expiry(self._get_bucket_start(bucket_start))
+
+            if entity.temp_sketch:
+                sketch_key = type(entity).construct_sketch_key(lab_id, bucket_start)
+                for field, count in entity.temp_sketch.items():
+                    pipe.hincrby(sketch_key, field, count)
+                pipe.expireat(sketch_key, expiry)
+
+            if entity.sensor_ids:
+                sensors_key = type(entity).construct_sensors_key(lab_id, bucket_start)
+                pipe.pfadd(sensors_key, *entity.sensor_ids)
+                pipe.expireat(sensors_key, expiry)
+
+    def _timestamp_is_in_bucket(self, timestamp, offset: int = 0):
+        bucket_start = self.bucket_start_for_offset(offset)
         bucket_end = bucket_start + self.bucket_duration
 
         return bucket_start <= timestamp < bucket_end
 
-    def _get_bucket_start(self, timestamp: Optional[int] = None) -> int:
+    def bucket_start_of(self, timestamp: int) -> int:
+        return self._get_bucket_start(timestamp)
+
+    def bucket_start_for_offset(self, offset: int = 0) -> int:
+        """
+        Start of the bucket "offset" buckets away from the current one (-1: the last completed bucket).
+        """
+        return self._get_bucket_start() + offset * self.bucket_duration
+
+    def bucket_expiry(self, bucket_start: int) -> int:
+        return bucket_start + self.bucket_retention * self.bucket_duration
+
+    def _get_bucket_start(self, timestamp: Optional[int] = None, duration: Optional[int] = None) -> int:
         if timestamp is None:
             timestamp = int(datetime.now().timestamp())
+        if duration is None:
+            duration = self.bucket_duration
 
-        start_from_offset = ((timestamp - self.bucket_offset) // self.bucket_duration) * self.bucket_duration
+        start_from_offset = ((timestamp - self.bucket_offset) // duration) * duration
         return self.bucket_offset + start_from_offset
+
+
+class BucketRepository(_BucketRepositoryBase):
+    connection: Redis
+
+    @staticmethod
+    def _default_connection() -> Optional[Redis]:
+        return connection
+
+    def add_observation(self, observation: Observation) -> None:
+        self.add_observations((observation,))
+
+    def add_observations(self, observations: Iterable[Observation]) -> int:
+        """
+        Adds a batch of observations. Observations are first summed up per bucket key, so every bucket
+        touched by the batch costs exactly one increment sequence - sent to Redis in a single pipeline.
+
+        Returns the number of buckets that were written.
+        """
+        return self.add_aggregates(self.aggregate(observations).values())
+
+    def add_aggregates(self, aggregates: Collection[BucketEntity]) -> int:
+        """
+        Adds already aggregated observations to their buckets, using a single pipeline.
+        """
+        if not aggregates:
+            return 0
+
+        aggregates = list(aggregates)
+
+        # every script call is atomic on its own, so there is no need for a MULTI transaction. Without one, the other
+        # commands are executed even if some of them fail, so the results are checked per command.
+        with REDIS_DURATION.time('add_observation'):
+            pipe = self.connection.pipeline(transaction=False)
+            self._queue_increments(pipe, aggregates)
+            self._queue_sketch_updates(pipe, aggregates)
+            results = pipe.execute(raise_on_error=False)[:len(aggregates)]
+
+            # scripts redis doesn't know (yet) are sent again with their body, all other commands have been executed
+            unknown = [i for i, result in enumerate(results) if isinstance(result, NoScriptError)]
+            if unknown:
+                pipe = self.connection.pipeline(transaction=False)
+                self._queue_increments(pipe, [aggregates[i] for i in unknown], preloaded=False)
+                for i, result in zip(unknown, pipe.execute(raise_on_error=False)):
+                    results[i] = result
+
+        return self._check_written(aggregates, results)
+
+    def find_in_bucket(self, offset: int = 0) -> Iterable[BucketKey]:
+        bucket_start = self.bucket_start_for_offset(offset)
+        with REDIS_DURATION.time('find_in_bucket'):
+            lab_ids = self._read_index(self.connection, bucket_start)
+
+        BUCKET_KEYS_EXAMINED.inc(amount=len(lab_ids))
+        return self._keys_from_index(bucket_start, lab_ids)
+
+    def scan_bucket(self,
+                    offset: int = 0,
+                    cursor: Optional[str] = None,
+                    count: Optional[int] = None) -> Tuple[Optional[str], List[BucketKey]]:
+        """
+        Incrementally iterates the keys of a bucket with SSCAN (HSCAN with the compact layout). Returns the cursor
+        to continue with (None once the iteration is complete) and roughly "count" keys, but possibly fewer or more.
+        """
+        bucket_start = self.bucket_start_for_offset(offset)
+        with REDIS_DURATION.time('scan_bucket'):
+            next_cursor, lab_ids = self._scan_index(self.connection, bucket_start, cursor, count)
+
+        BUCKET_KEYS_EXAMINED.inc(amount=len(lab_ids))
+        return str(next_cursor) if next_cursor else None, self._keys_from_index(bucket_start, lab_ids)
+
+    def find_in_buckets(self,
+                        from_offset: int,
+                        to_offset: int,
+                        lab_id: Optional[LabId] = None) -> List[BucketKey]:
+        """
+        Keys of all buckets from "from_offset" to "to_offset" (inclusive), read from their indexes in a single
+        round trip. With "lab_id", the keys of that lab are returned without reading the indexes.
+        """
+        bucket_starts = self._bucket_starts(from_offset, to_offset)
+        if lab_id is not None:
+            return [BucketEntity.construct_key(lab_id, bucket_start) for bucket_start in bucket_starts]
+
+        return self._find_in_indexes(bucket_starts, BucketEntity, 'find_in_buckets')
+
+    def find_in_rollups(self, start: int, end: int) -> List[BucketKey]:
+        """
+        Keys of all rollups overlapping the time range [start, end), read from their indexes in a single round trip.
+        """
+        return self._find_in_indexes(self._rollup_starts(start, end), RollupEntity, 'find_in_rollups')
+
+    def _find_in_indexes(self,
+                         bucket_starts: List[int],
+                         entity_type: Type[BucketEntity],
+                         operation: str) -> List[BucketKey]:
+        pipe = self.connection.pipeline(transaction=False)
+        for bucket_start in bucket_starts:
+            self._read_index(pipe, bucket_start, entity_type)
+
+        with REDIS_DURATION.time(operation):
+            results = pipe.execute()
+
+        BUCKET_KEYS_EXAMINED.inc(amount=sum(len(lab_ids) for lab_ids in results))
+        return [
+            key
+            for bucket_start, lab_ids in zip(bucket_starts, results)
+            for key in self._keys_from_index(bucket_start, lab_ids, entity_type)
+        ]
+
+    def get(self, key: BucketKey) -> Optional[BucketEntity]:
+        with REDIS_DURATION.time('get'):
+            data = self._read_entity(self.connection, key)
+
+        return self._decode_entity(key, data)
+
+    def get_many(self,
+                 keys: Iterable[BucketKey],
+                 entity_type: Type[BucketEntity] = BucketEntity) -> Iterator[BucketEntity]:
+        """
+        Fetches the buckets for all given keys, using one pipelined round trip per chunk of "fetch_chunk_size" keys.
+        Entities are yielded as soon as their chunk arrived. Keys that don't exist (anymore) are skipped.
+        """
+        for chunk in self._chunks(keys):
+            pipe = self.connection.pipeline(transaction=False)
+            self._queue_reads(pipe, chunk, entity_type)
+
+            with REDIS_DURATION.time('get_many'):
+                results = pipe.execute()
+
+            for entity in self._decode_entities(chunk, results, entity_type):
+                yield entity
+
+    def count_sensors(self,
+                      keys: Iterable[BucketKey],
+                      entity_type: Type[BucketEntity] = BucketEntity) -> Dict[LabId, int]:
+        """
+        Estimated number of distinct sensors per lab within all given buckets, e.g. after merging them.
+        """
+        pipe = self.connection.pipeline(transaction=False)
+        lab_ids = self._queue_sensor_counts(pipe, keys, entity_type)
+        if not lab_ids:
+            return {}
+
+        with REDIS_DURATION.time('count_sensors'):
+            return dict(zip(lab_ids, pipe.execute()))
+
+    def migrate_to_compact_layout(self) -> int:
+        """
+        Moves all retained buckets and rollups of the original layout into the compact layout. Every lab is moved
+        atomically, so observations written with the compact layout in the meantime aren't lost, and the migration
+        can be interrupted and run again. Returns the number of moved buckets.
+        """
+        bucket_starts = self._bucket_starts(1 - self.bucket_retention, 0)
+        rollup_starts = [
+            rollup_start
+            for bucket_start in bucket_starts
+            for rollup_start in range(bucket_start, bucket_start + self.bucket_duration, self.rollup_duration)
+        ] if self.rollup_duration else []
+
+        moved = 0
+        for entity_type, starts in ((BucketEntity, bucket_starts), (RollupEntity, rollup_starts)):
+            for start in starts:
+                index_key = entity_type.construct_index_key(start)
+                compact_key = entity_type.construct_compact_key(start)
+                expiry = self.bucket_expiry(self._get_bucket_start(start))
+
+                for chunk in self._chunks(self.connection.smembers(index_key)):
+                    pipe = self.connection.pipeline(transaction=False)
+                    for lab_id in chunk:
+                        key = entity_type.construct_key(lab_id.decode('utf8'), start)
+                        pipe.eval(MIGRATE_SCRIPT, 3, key, index_key, compact_key, lab_id, expiry)
+
+                    moved += sum(pipe.execute())
+
+        return moved
+
+
+class AsyncBucketRepository(_BucketRepositoryBase):
+    """
+    asyncio variant of the BucketRepository, which doesn't block the event loop while waiting for Redis.
+    """
+    connection: AsyncRedis
+
+    @staticmethod
+    def _default_connection() -> Optional[AsyncRedis]:
+        return async_connection
+
+    async def add_observation(self, observation: Observation) -> None:
+        await self.add_observations((observation,))
+
+    async def add_observations(self, observations: Iterable[Observation]) -> int:
+        return await self.add_aggregates(self.aggregate(observations).values())
+
+    async def add_aggregates(self, aggregates: Collection[BucketEntity]) -> int:
+        if not aggregates:
+            return 0
+
+        aggregates = list(aggregates)
+
+        with REDIS_DURATION.time('add_observation'):
+            pipe = self.connection.pipeline(transaction=False)
+            self._queue_increments(pipe, aggregates)
+            self._queue_sketch_updates(pipe, aggregates)
+            results = (await pipe.execute(raise_on_error=False))[:len(aggregates)]
+
+            unknown = [i for i, result in enumerate(results) if isinstance(result, NoScriptError)]
+            if unknown:
+                pipe = self.connection.pipeline(transaction=False)
+                self._queue_increments(pipe, [aggregates[i] for i in unknown], preloaded=False)
+                for i, result in zip(unknown, await pipe.execute(raise_on_error=False)):
+                    results[i] = result
+
+        return self._check_written(aggregates, results)
+
+    async def find_in_bucket(self, offset: int = 0) -> Iterable[BucketKey]:
+        bucket_start = self.bucket_start_for_offset(offset)
+        with REDIS_DURATION.time('find_in_bucket'):
+            lab_ids = await self._read_index(self.connection, bucket_start)
+
+        BUCKET_KEYS_EXAMINED.inc(amount=len(lab_ids))
+        return self._keys_from_index(bucket_start, lab_ids)
+
+    async def scan_bucket(self,
+                          offset: int = 0,
+                          cursor: Optional[str] = None,
+                          count: Optional[int] = None) -> Tuple[Optional[str], List[BucketKey]]:
+        bucket_start = self.bucket_start_for_offset(offset)
+        with REDIS_DURATION.time('scan_bucket'):
+            next_cursor, lab_ids = await self._scan_index(self.connection, bucket_start, cursor, count)
+
+        BUCKET_KEYS_EXAMINED.inc(amount=len(lab_ids))
+        return str(next_cursor) if next_cursor else None, self._keys_from_index(bucket_start, lab_ids)
+
+    async def find_in_buckets(self,
+                              from_offset: int,
+                              to_offset: int,
+                              lab_id: Optional[LabId] = None) -> List[BucketKey]:
+        bucket_starts = self._bucket_starts(from_offset, to_offset)
+        if lab_id is not None:
+            return [BucketEntity.construct_key(lab_id, bucket_start) for bucket_start in bucket_starts]
+
+        return await self._find_in_indexes(bucket_starts, BucketEntity, 'find_in_buckets')
+
+    async def find_in_rollups(self, start: int, end: int) -> List[BucketKey]:
+        return await self._find_in_indexes(self._rollup_starts(start, end), RollupEntity, 'find_in_rollups')
+
+    async def _find_in_indexes(self,
+                               bucket_starts: List[int],
+                               entity_type: Type[BucketEntity],
+                               operation: str) -> List[BucketKey]:
+        pipe = self.connection.pipeline(transaction=False)
+        for bucket_start in bucket_starts:
+            self._read_index(pipe, bucket_start, entity_type)
+
+        with REDIS_DURATION.time(operation):
+            results = await pipe.execute()
+
+        BUCKET_KEYS_EXAMINED.inc(amount=sum(len(lab_ids) for lab_ids in results))
+        return [
+            key
+            for bucket_start, lab_ids in zip(bucket_starts, results)
+            for key in self._keys_from_index(bucket_start, lab_ids, entity_type)
+        ]
+
+    async def get(self, key: BucketKey) -> Optional[BucketEntity]:
+        with REDIS_DURATION.time('get'):
+            data = await self._read_entity(self.connection, key)
+
+        return self._decode_entity(key, data)
+
+    async def get_many(self,
+                       keys: Iterable[BucketKey],
+                       entity_type: Type[BucketEntity] = BucketEntity) -> AsyncIterator[BucketEntity]:
+        for chunk in self._chunks(keys):
+            pipe = self.connection.pipeline(transaction=False)
+            self._queue_reads(pipe, chunk, entity_type)
+
+            with REDIS_DURATION.time('get_many'):
+                results = await pipe.execute()
+
+            for entity in self._decode_entities(chunk, results, entity_type):
+                yield entity
+
+    async def count_sensors(self,
+                            keys: Iterable[BucketKey],
+                            entity_type: Type[BucketEntity] = BucketEntity) -> Dict[LabId, int]:
+        pipe = self.connection.pipeline(transaction=False)
+        lab_ids = self._queue_sensor_counts(pipe, keys, entity_type)
+        if not lab_ids:
+            return {}
+
+        with REDIS_DURATION.time('count_sensors'):
+            return dict(zip(lab_ids, await pipe.execute()))
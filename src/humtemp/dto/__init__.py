@@ -1,4 +1,6 @@
+from .batch import BatchError, BatchResult
 from .observation import Observation
-from .summary import Summary
+from .record import ObservationRecord
+from .summary import BucketSummary, Summary
 
-__all__ = ['Observation', 'Summary']
+__all__ = ['BatchError', 'BatchResult', 'BucketSummary', 'Observation', 'ObservationRecord', 'Summary']
@@ -0,0 +1,24 @@
+from typing import *
+
+from pydantic import BaseModel
+
+
+class BatchError(BaseModel):
+    index: int
+    errors: List[Dict[str, Any]]
+
+
+class BatchResult(BaseModel):
+    accepted: int
+    rejected: List[BatchError]
+
+
+def too_old_error(earliest_timestamp: int) -> Dict[str, Any]:
+    """
+    Error of an observation older than the buckets (or the lateness window) accepting observations.
+    """
+    return {
+        'loc': ['timestamp'],
+        'msg': f'observation is too old. Earliest accepted timestamp: {earliest_timestamp}',
+        'type': 'value_error.too_old',
+    }
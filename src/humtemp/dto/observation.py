@@ -1,10 +1,24 @@
 import re
-from datetime import datetime, timezone, timedelta
+import string
+import time
+from datetime import datetime, timezone
 from typing import *
 
 from pydantic import BaseModel, validator
 
-ALLOWED_LABID_REGEX = re.compile(r'[a-zA-Z0-9/_\-.]*')
+ALLOWED_LABID_CHARACTERS = string.ascii_letters + string.digits + '/_-.'
+LABID_MAX_LENGTH = 50
+# the same constraints for lab ids given as query parameters
+LABID_REGEX = f'^[{re.escape(ALLOWED_LABID_CHARACTERS)}]+$'
+
+# the earliest timestamp which can be represented as a datetime in every timezone
+MIN_TIMESTAMP = int(datetime(1, 1, 2, tzinfo=timezone.utc).timestamp())
+# seconds an observation may be ahead of the server clock
+FUTURE_TOLERANCE = 60
+# largest accepted absolute temperature and humidity. Keeps the sums of squares of a bucket far from overflowing.
+MAX_MEASUREMENT = 1e6
+
+_ALLOWED_LABID_CHARACTER_SET = frozenset(ALLOWED_LABID_CHARACTERS)
 LabId = NewType('LabId', str)
 
 
@@ -13,30 +27,45 @@ class Observation(BaseModel):
     timestamp: int
     temp: float
     humidity: float
+    # optional id of the reporting device, counted per lab with "humtemp_sketches_enabled"
+    sensor_id: Optional[str] = None
 
-    @validator('lab_id')
-    def lab_id_valid(cls, v: LabId) -> LabId:
+    @validator('lab_id', 'sensor_id')
+    def lab_id_valid(cls, v: str) -> str:
         if len(v) == 0:
             raise ValueError('must not be empty')
-        if len(v) > 50:
-            raise ValueError('must not be longer than 50 characters')
+        if len(v) > LABID_MAX_LENGTH:
+            raise ValueError(f'must not be longer than {LABID_MAX_LENGTH} characters')
 
-        if not ALLOWED_LABID_REGEX.fullmatch(v):
+        if not _ALLOWED_LABID_CHARACTER_SET.issuperset(v):
             raise ValueError('must only contain alphanumeric characters (or / . - _)')
 
         return v
 
+    @validator('temp', 'humidity')
+    def measurement_valid(cls, v: float) -> float:
+        # also rejects NaN, which pydantic accepts as a float
+        if not -MAX_MEASUREMENT <= v <= MAX_MEASUREMENT:
+            raise ValueError(f'must be a finite number between {-MAX_MEASUREMENT:g} and {MAX_MEASUREMENT:g}')
+
+        return v
+
     @validator('timestamp')
     def timestamp_valid(cls, v: int) -> int:
-        try:
-            dt = datetime.fromtimestamp(v, timezone.utc)
-            timestamp = int(dt.timestamp())
-        except Exception:
+        if v < MIN_TIMESTAMP:
             raise ValueError('not a valid timestamp')
 
-        now = int((datetime.now() + timedelta(minutes=1)).timestamp())
-        if timestamp > now:
+        horizon = latest_valid_timestamp()
+        if v > horizon:
             raise ValueError(f'observations from the future are not allowed. '
-                             f'Observation timestamp: {timestamp}. Current timestamp: {now}')
+                             f'Observation timestamp: {v}. Current timestamp: {horizon}')
+
+        return v
+
 
-        return timestamp
+def latest_valid_timestamp() -> int:
+    """
+    The newest accepted observation timestamp. A single clock read and integer arithmetic are cheaper
+    than caching the value per second.
+    """
+    return int(time.time()) + FUTURE_TOLERANCE
@@ -0,0 +1,135 @@
+"""
+Fixed-layout binary encoding of observations, for sensor gateways which can't afford to produce JSON.
+
+Every record is 74 bytes, little-endian, without any padding between the fields:
+  * lab_id: 50 bytes ASCII, padded with NUL bytes
+  * timestamp: signed 64-bit integer (unix timestamp in seconds)
+  * temp: 64-bit float
+  * humidity: 64-bit float
+
+A request body is a plain concatenation of records. The records are decoded in bulk with struct, and validated
+per column for the whole batch at once. Only if that fails, the records are checked one by one to report the errors.
+"""
+import math
+import struct
+from typing import *
+
+from humtemp.dto.batch import BatchError, too_old_error
+from humtemp.dto.observation import (
+    ALLOWED_LABID_CHARACTERS, LABID_MAX_LENGTH, MAX_MEASUREMENT, MIN_TIMESTAMP, LabId, latest_valid_timestamp
+)
+
+RECORD_CONTENT_TYPE = 'application/vnd.humtemp.observation'
+RECORD = struct.Struct(f'<{LABID_MAX_LENGTH}sqdd')
+
+_ALLOWED_LABID_BYTES = ALLOWED_LABID_CHARACTERS.encode('ascii')
+
+
+class ObservationRecord(NamedTuple):
+    """
+    A validated observation. Can be used wherever the repositories expect an Observation.
+    """
+    lab_id: LabId
+    timestamp: int
+    temp: float
+    humidity: float
+    # binary records don't carry sensor ids
+    sensor_id: Optional[str] = None
+
+
+def encode_records(observations: Iterable[Tuple[str, int, float, float]]) -> bytes:
+    records = []
+    for lab_id, timestamp, temp, humidity in observations:
+        encoded_lab_id = lab_id.encode('ascii')
+        # struct would silently truncate longer lab ids
+        if len(encoded_lab_id) > LABID_MAX_LENGTH:
+            raise ValueError(f'lab id must not be longer than {LABID_MAX_LENGTH} characters')
+
+        records.append(RECORD.pack(encoded_lab_id, timestamp, temp, humidity))
+
+    return b''.join(records)
+
+
+def decode_records(body: bytes,
+                   earliest_timestamp: int = MIN_TIMESTAMP) -> Tuple[List[ObservationRecord], List[BatchError]]:
+    """
+    Decodes and validates a body of concatenated records. Records older than "earliest_timestamp" are rejected.
+    Raises a ValueError if the body isn't a whole number of records.
+    """
+    if len(body) % RECORD.size != 0:
+        raise ValueError(f'request body must consist of records of {RECORD.size} bytes')
+    if not body:
+        return [], []
+
+    raw_lab_ids, timestamps, temps, humidities = zip(*RECORD.iter_unpack(body))
+    lab_ids = [raw_lab_id.rstrip(b'\0') for raw_lab_id in raw_lab_ids]
+    horizon = latest_valid_timestamp()
+
+    if (all(lab_ids)
+            and not b''.join(lab_ids).translate(None, _ALLOWED_LABID_BYTES)
+            and min(timestamps) >= max(earliest_timestamp, MIN_TIMESTAMP)
+            and max(timestamps) <= horizon
+            and _measurements_valid(temps)
+            and _measurements_valid(humidities)):
+        return list(map(ObservationRecord, map(bytes.decode, lab_ids), timestamps, temps, humidities)), []
+
+    valid = []
+    rejected = []
+    for index, record in enumerate(zip(lab_ids, timestamps, temps, humidities)):
+        errors = _validate(*record, earliest=earliest_timestamp, horizon=horizon)
+        if errors:
+            rejected.append(BatchError(index=index, errors=errors))
+        else:
+            lab_id, timestamp, temp, humidity = record
+            valid.append(ObservationRecord(LabId(lab_id.decode('ascii')), timestamp, temp, humidity))
+
+    return valid, rejected
+
+
+def unpack_records(body: bytes) -> List[ObservationRecord]:
+    """
+    Decodes records without validating them again, e.g. records which were queued after being validated.
+    """
+    return [
+        ObservationRecord(LabId(lab_id.rstrip(b'\0').decode('ascii')), timestamp, temp, humidity)
+        for lab_id, timestamp, temp, humidity in RECORD.iter_unpack(body)
+    ]
+
+
+def _validate(lab_id: bytes,
+              timestamp: int,
+              temp: float,
+              humidity: float,
+              earliest: int,
+              horizon: int) -> List[Dict[str, Any]]:
+    errors = []
+
+    if not lab_id:
+        errors.append(_error('lab_id', 'must not be empty'))
+    elif lab_id.translate(None, _ALLOWED_LABID_BYTES):
+        errors.append(_error('lab_id', 'must only contain alphanumeric characters (or / . - _)'))
+
+    if timestamp < MIN_TIMESTAMP:
+        errors.append(_error('timestamp', 'not a valid timestamp'))
+    elif timestamp < earliest:
+        errors.append(too_old_error(earliest))
+    elif timestamp > horizon:
+        errors.append(_error('timestamp', f'observations from the future are not allowed. '
+                                          f'Observation timestamp: {timestamp}. Current timestamp: {horizon}'))
+
+    for field, value in (('temp', temp), ('humidity', humidity)):
+        if not -MAX_MEASUREMENT <= value <= MAX_MEASUREMENT:
+            errors.append(_error(field, f'must be a finite number between {-MAX_MEASUREMENT:g} '
+                                        f'and {MAX_MEASUREMENT:g}'))
+
+    return errors
+
+
+def _measurements_valid(values: Sequence[float]) -> bool:
+    # NaN compares false to everything, so min() and max() can only be trusted if the sum isn't NaN.
+    # Infinite values either make the sum NaN or exceed the limits.
+    return not math.isnan(sum(values)) and min(values) >= -MAX_MEASUREMENT and max(values) <= MAX_MEASUREMENT
+
+
+def _error(field: str, msg: str) -> Dict[str, Any]:
+    return {'loc': [field], 'msg': msg, 'type': 'value_error'}
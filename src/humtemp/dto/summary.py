@@ -1,3 +1,5 @@
+from typing import *
+
 from pydantic import BaseModel
 
 from humtemp.dto.observation import LabId
@@ -7,3 +9,25 @@ class Summary(BaseModel):
     lab_id: LabId
     avg_temp: float
     avg_humidity: float
+
+    # population standard deviation
+    std_temp: float = 0.0
+    std_humidity: float = 0.0
+
+    # observations which arrived after their bucket was completed
+    num_late: int = 0
+
+    # not available for buckets written before these statistics were introduced
+    min_temp: Optional[float] = None
+    max_temp: Optional[float] = None
+    min_humidity: Optional[float] = None
+    max_humidity: Optional[float] = None
+
+    # estimates from the sketches, only with "humtemp_sketches_enabled"
+    median_temp: Optional[float] = None
+    p95_temp: Optional[float] = None
+    num_sensors: Optional[int] = None
+
+
+class BucketSummary(Summary):
+    bucket_start: int
@@ -1,7 +1,9 @@
+import math
 from typing import *
 
 from pydantic import BaseModel
 
+from humtemp import sketch
 from humtemp.dto.observation import LabId
 
 BucketKey = NewType('BucketKey', str)
@@ -9,13 +11,38 @@ BucketKey = NewType('BucketKey', str)
 
 class BucketEntity(BaseModel):
     KEY_PREFIX: ClassVar[str] = 'bucket'
+    INDEX_PREFIX: ClassVar[str] = 'bucket-index'
+    # with the compact layout, all labs of a bucket are fields of a single hash
+    COMPACT_PREFIX: ClassVar[str] = 'bucket-compact'
+    # with sketches, the temperature sketch (a hash) and the distinct sensors (a HyperLogLog) of every bucket
+    SKETCH_PREFIX: ClassVar[str] = 'bucket-sketch'
+    SENSORS_PREFIX: ClassVar[str] = 'bucket-sensors'
 
     key: BucketKey
 
     num_observations: int = 0
+    # observations which arrived after their bucket was completed
+    num_late: int = 0
     sum_temp: float = 0.0
     sum_humidity: float = 0.0
 
+    # sums of squares allow computing the variance incrementally
+    sumsq_temp: float = 0.0
+    sumsq_humidity: float = 0.0
+
+    # not available for buckets written before these statistics were introduced
+    min_temp: Optional[float] = None
+    max_temp: Optional[float] = None
+    min_humidity: Optional[float] = None
+    max_humidity: Optional[float] = None
+
+    # only with sketches (see humtemp.sketch), stored next to the bucket hash: counts per sketch key,
+    # the sensors of the aggregated observations (when writing) and the estimated number of distinct sensors (when
+    # reading, unknown after merging)
+    temp_sketch: Dict[str, int] = {}
+    sensor_ids: Set[str] = set()
+    num_sensors: Optional[int] = None
+
     @property
     def avg_temp(self):
         if self.num_observations == 0:
@@ -30,14 +57,94 @@ class BucketEntity(BaseModel):
         else:
             return self.sum_humidity / self.num_observations
 
+    @property
+    def std_temp(self) -> float:
+        return self._std(self.sum_temp, self.sumsq_temp)
+
+    @property
+    def std_humidity(self) -> float:
+        return self._std(self.sum_humidity, self.sumsq_humidity)
+
+    def _std(self, sum_: float, sumsq: float) -> float:
+        if self.num_observations == 0:
+            return 0
+
+        mean = sum_ / self.num_observations
+        # guard against small negative values caused by floating point errors
+        return math.sqrt(max(0.0, sumsq / self.num_observations - mean * mean))
+
+    def add(self, temp: float, humidity: float, late: bool = False) -> None:
+        """
+        Adds a single observation to this entity.
+        """
+        self.num_observations += 1
+        if late:
+            self.num_late += 1
+        self.sum_temp += temp
+        self.sum_humidity += humidity
+        self.sumsq_temp += temp * temp
+        self.sumsq_humidity += humidity * humidity
+
+        if self.min_temp is None or temp < self.min_temp:
+            self.min_temp = temp
+        if self.max_temp is None or temp > self.max_temp:
+            self.max_temp = temp
+        if self.min_humidity is None or humidity < self.min_humidity:
+            self.min_humidity = humidity
+        if self.max_humidity is None or humidity > self.max_humidity:
+            self.max_humidity = humidity
+
+    def merge(self, other: 'BucketEntity') -> None:
+        """
+        Adds the observations aggregated in "other" to this entity.
+        """
+        self.num_observations += other.num_observations
+        self.num_late += other.num_late
+        self.sum_temp += other.sum_temp
+        self.sum_humidity += other.sum_humidity
+        self.sumsq_temp += other.sumsq_temp
+        self.sumsq_humidity += other.sumsq_humidity
+
+        self.min_temp = _merge_extreme(min, self.min_temp, other.min_temp)
+        self.max_temp = _merge_extreme(max, self.max_temp, other.max_temp)
+        self.min_humidity = _merge_extreme(min, self.min_humidity, other.min_humidity)
+        self.max_humidity = _merge_extreme(max, self.max_humidity, other.max_humidity)
+
+        if other.temp_sketch:
+            self.temp_sketch = sketch.merge(self.temp_sketch, other.temp_sketch)
+        if other.sensor_ids:
+            self.sensor_ids = self.sensor_ids | other.sensor_ids
+        # HyperLogLogs can only be merged by redis
+        self.num_sensors = None
+
     @property
     def lab_id(self) -> LabId:
-        return BucketEntity.deconstruct_key(self.key)[0]
+        return type(self).deconstruct_key(self.key)[0]
+
+    @property
+    def bucket_start(self) -> int:
+        return type(self).deconstruct_key(self.key)[1]
 
     @classmethod
     def construct_key(cls, lab_id: LabId, bucket_start: int) -> BucketKey:
         return BucketKey(f'{cls.KEY_PREFIX}:{lab_id}:{bucket_start}')
 
+    @classmethod
+    def construct_index_key(cls, bucket_start: int) -> str:
+        return f'{cls.INDEX_PREFIX}:{bucket_start}'
+
+    @classmethod
+    def construct_compact_key(cls, bucket_start: int) -> str:
+        return f'{cls.COMPACT_PREFIX}:{bucket_start}'
+
+    @classmethod
+    def construct_sketch_key(cls, lab_id: LabId, bucket_start: int) -> str:
+        return f'{cls.SKETCH_PREFIX}:{lab_id}:{bucket_start}'
+
+    @classmethod
+    def construct_sensors_key(cls, lab_id: LabId, bucket_start: int) -> str:
+        return f'{cls.SENSORS_PREFIX}:{lab_id}:{bucket_start}'
+
     @classmethod
     def deconstruct_key(cls, key: Union[str, bytes]) -> Tuple[LabId, int]:
         if isinstance(key, bytes):
@@ -48,3 +155,23 @@ class BucketEntity(BaseModel):
             raise ValueError(f'the provided key {key} is not of the correct type')
 
         return LabId(lab_id), int(timestamp)
+
+
+class RollupEntity(BucketEntity):
+    """
+    Partial aggregate of a lab's observations within a sub-bucket ("rollup") of a bucket.
+    Rollups can be merged to summaries over arbitrary ranges of sub-buckets.
+    """
+    KEY_PREFIX: ClassVar[str] = 'rollup'
+    INDEX_PREFIX: ClassVar[str] = 'rollup-index'
+    COMPACT_PREFIX: ClassVar[str] = 'rollup-compact'
+    SKETCH_PREFIX: ClassVar[str] = 'rollup-sketch'
+    SENSORS_PREFIX: ClassVar[str] = 'rollup-sensors'
+
+
+def _merge_extreme(func: Callable[[float, float], float], a: Optional[float], b: Optional[float]) -> Optional[float]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return func(a, b)
@@ -1,48 +1,714 @@
+import json
+import os
+import time
 from typing import *
 
-from fastapi import FastAPI, Depends
+import orjson
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from redis.asyncio import Redis as AsyncRedis
 
-from humtemp.configuration import settings
-from humtemp.database import BucketRepository, connect
-from humtemp.dto import Observation, Summary
+from humtemp import admission
+from humtemp import sharding
+from humtemp import database
+from humtemp import memory
+from humtemp import metrics
+from humtemp import sketch
+from humtemp.archive import Archive, ArchiveCompactor
+from humtemp.buffer import ObservationBuffer
+from humtemp.cache import CachedSummary, SummaryCache, SummaryMaterializer
+from humtemp.configuration import get_settings
+from humtemp.database import AsyncBucketRepository, connect_async, disconnect_async, load_scripts
+from humtemp.dto import BatchError, BatchResult, BucketSummary, Observation, ObservationRecord, Summary
+from humtemp.dto.batch import too_old_error
+from humtemp.dto.observation import LABID_MAX_LENGTH, LABID_REGEX, LabId
+from humtemp.dto.record import RECORD_CONTENT_TYPE, decode_records
+from humtemp.entities import BucketEntity, BucketKey, RollupEntity
+from humtemp.metrics import MetricsMiddleware, OBSERVATIONS_REJECTED, VALIDATION_DURATION
+from humtemp.stream import ObservationStream
+
+Repository = Union[AsyncBucketRepository, sharding.ShardedBucketRepository, memory.MemoryBucketRepository]
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson')
 
 
-connect(
-    host=settings.humtemp_redis_host,
-    port=settings.humtemp_redis_port,
-    db=settings.humtemp_redis_db
-)
 app = FastAPI()
+# the metrics middleware is the outermost one, so it also measures shed requests
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+observation_buffer: Optional[ObservationBuffer] = None
+summary_cache: Optional[SummaryCache] = None
+memory_maintenance: Optional[memory.MemoryMaintenance] = None
+archive_compactor: Optional[ArchiveCompactor] = None
+observation_stream: Optional[ObservationStream] = None
+summary_materializer: Optional[SummaryMaterializer] = None
+
+
+@app.on_event('startup')
+async def startup() -> None:
+    settings = get_settings()
+    print('Running with Settings:')
+    print(settings.json(indent=2))
+
+    # materialized summaries and the archive are final once completed buckets stop accepting late observations,
+    # which must happen before they expire
+    completed_retention = (settings.humtemp_bucket_retention - 1) * settings.humtemp_bucket_duration
+    buckets_become_final = 0 < settings.humtemp_max_lateness < completed_retention
+
+    if settings.humtemp_summary_materialize and not buckets_become_final:
+        raise ValueError('humtemp_summary_materialize requires a humtemp_max_lateness shorter than the retention '
+                         'of completed buckets')
+    if settings.humtemp_archive_path and not buckets_become_final:
+        raise ValueError('humtemp_archive_path requires a humtemp_max_lateness shorter than the retention '
+                         'of completed buckets')
+
+    if settings.humtemp_storage == 'memory':
+        _open_memory_store()
+    elif settings.humtemp_redis_shards:
+        sharding.connect_shards(
+            settings.humtemp_redis_shards,
+            db=settings.humtemp_redis_db,
+            pool_size=settings.humtemp_redis_pool_size
+        )
+    else:
+        connect_async(
+            host=settings.humtemp_redis_host,
+            port=settings.humtemp_redis_port,
+            db=settings.humtemp_redis_db,
+            pool_size=settings.humtemp_redis_pool_size
+        )
+
+    for redis in _all_connections():
+        await load_scripts(redis)
+
+    if settings.humtemp_admission_max_concurrent:
+        admission.controller = admission.AdmissionController(
+            settings.humtemp_admission_max_concurrent,
+            max_queue=settings.humtemp_admission_max_queue,
+            queue_timeout=settings.humtemp_admission_queue_timeout,
+            reserved=settings.humtemp_admission_summary_reserved,
+            retry_after=settings.humtemp_admission_retry_after
+        )
+
+    if settings.humtemp_stream_enabled:
+        if settings.humtemp_storage == 'memory':
+            raise ValueError('the ingestion stream requires humtemp_storage "redis"')
+
+        global observation_stream
+        observation_stream = ObservationStream(
+            _shared_connection(),
+            stream=settings.humtemp_stream_key,
+            group=settings.humtemp_stream_group,
+            max_length=settings.humtemp_stream_max_length
+        )
+
+    # materialized summaries are computed by a single worker, and shared with all others
+    shared = settings.humtemp_summary_cache_shared or settings.humtemp_summary_materialize
+
+    global summary_cache
+    summary_cache = SummaryCache(redis=_shared_connection() if shared else None)
+
+    if settings.humtemp_summary_materialize:
+        repo = await _get_repository()
+
+        global summary_materializer
+        summary_materializer = SummaryMaterializer(
+            repo,
+            summary_cache,
+            render=lambda offset: _render_summary(repo, offset),
+            delay=settings.humtemp_summary_materialize_delay,
+            max_lateness=settings.humtemp_max_lateness
+        )
+        summary_materializer.start()
+
+    if settings.humtemp_buffer_enabled:
+        global observation_buffer
+        observation_buffer = ObservationBuffer(
+            await _get_repository(),
+            flush_interval=settings.humtemp_buffer_flush_interval,
+            max_keys=settings.humtemp_buffer_max_keys,
+            on_flush=_invalidate_summaries
+        )
+        observation_buffer.start()
+
+    if settings.humtemp_archive_path:
+        global archive_compactor
+        archive_compactor = ArchiveCompactor(
+            await _get_repository(),
+            Archive(settings.humtemp_archive_path),
+            interval=settings.humtemp_archive_interval,
+            max_lateness=settings.humtemp_max_lateness,
+            redis=_shared_connection()
+        )
+        archive_compactor.start()
 
 
-async def _get_repository() -> BucketRepository:
-    return BucketRepository(
-        bucket_offset=settings.bucket_offset,
-        bucket_duration=settings.bucket_duration
+@app.on_event('shutdown')
+async def shutdown() -> None:
+    admission.controller = None
+
+    global observation_stream
+    observation_stream = None
+
+    global summary_materializer
+    if summary_materializer is not None:
+        await summary_materializer.stop()
+        summary_materializer = None
+
+    global archive_compactor
+    if archive_compactor is not None:
+        await archive_compactor.stop()
+        archive_compactor = None
+
+    global observation_buffer
+    if observation_buffer is not None:
+        await observation_buffer.stop()
+        observation_buffer = None
+
+    global memory_maintenance
+    if memory_maintenance is not None:
+        await memory_maintenance.stop()
+        memory_maintenance = None
+
+    await disconnect_async()
+    await sharding.disconnect_shards()
+
+
+def _open_memory_store() -> None:
+    """
+    Creates the in-process store, restored from the last snapshot if there is one.
+    """
+    settings = get_settings()
+    snapshot_path = settings.humtemp_snapshot_path
+
+    if snapshot_path and os.path.exists(snapshot_path):
+        memory.store = memory.MemoryStore.load(snapshot_path)
+    else:
+        memory.store = memory.MemoryStore()
+
+    global memory_maintenance
+    memory_maintenance = memory.MemoryMaintenance(
+        memory.store,
+        interval=settings.humtemp_snapshot_interval,
+        snapshot_path=snapshot_path
     )
+    memory_maintenance.start()
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError) -> Response:
+    if request.url.path == '/observation':
+        _count_rejected(exc.errors())
+
+    return await request_validation_exception_handler(request, exc)
+
+
+@app.get('/metrics')
+async def get_metrics() -> Response:
+    if observation_stream is not None:
+        await observation_stream.update_metrics()
+
+    return Response(content=metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+async def _get_repository() -> Repository:
+    settings = get_settings()
+    if settings.humtemp_storage == 'memory':
+        return memory.MemoryBucketRepository()
 
+    if settings.humtemp_redis_shards:
+        return sharding.ShardedBucketRepository({
+            node: _create_repository(redis) for node, redis in sharding.shard_connections.items()
+        }, ring=sharding.ring)
 
-@app.post('/observation')
+    return _create_repository()
+
+
+def _all_connections() -> List[AsyncRedis]:
+    if sharding.shard_connections:
+        return list(sharding.shard_connections.values())
+    if database.async_connection is None:
+        return []
+
+    return [database.async_connection]
+
+
+def _shared_connection() -> Optional[AsyncRedis]:
+    """
+    Connection for data which isn't sharded by lab. With multiple shards, the first one is used.
+    Without redis (humtemp_storage "memory"), there is no shared connection.
+    """
+    if sharding.shard_connections:
+        return next(iter(sharding.shard_connections.values()))
+
+    return database.async_connection
+
+
+def _create_repository(redis: Optional[AsyncRedis] = None) -> AsyncBucketRepository:
+    # all bucket parameters default to the settings
+    return AsyncBucketRepository(redis=redis)
+
+
+@app.post('/observation', openapi_extra={'requestBody': {'required': True, 'content': {
+    'application/json': {'schema': Observation.schema()},
+    RECORD_CONTENT_TYPE: {'schema': {'type': 'string', 'format': 'binary'}},
+}}})
 async def observation(
-        data: Observation,
-        repo: BucketRepository = Depends(_get_repository)):
-    repo.add_observation(data)
+        request: Request,
+        repo: Repository = Depends(_get_repository)):
+    """
+    Adds a single observation, given either as JSON or as a binary record
+    (Content-Type: application/vnd.humtemp.observation).
+    """
+    body = await request.body()
+
+    with VALIDATION_DURATION.time('observation'):
+        if _content_type(request) == RECORD_CONTENT_TYPE:
+            data = _parse_record(body)
+        else:
+            data = _parse_observation(body)
+
+    earliest_timestamp = repo.earliest_accepted_timestamp()
+    if data.timestamp < earliest_timestamp:
+        error = too_old_error(earliest_timestamp)
+        error['loc'] = ['body', *error['loc']]
+        _count_rejected([error])
+        raise HTTPException(status_code=422, detail=[error])
+
+    if observation_stream is not None:
+        await observation_stream.add((data,))
+        return
+
+    if observation_buffer is not None:
+        observation_buffer.add((data,))
+        return
+
+    await repo.add_observation(data)
+    await _invalidate_summaries((repo.bucket_start_of(data.timestamp),))
+
+
+def _content_type(request: Request) -> str:
+    return request.headers.get('content-type', '').split(';')[0].strip()
+
+
+def _parse_observation(body: bytes) -> Observation:
+    try:
+        return Observation.parse_obj(json.loads(body))
+    except json.JSONDecodeError as e:
+        raise RequestValidationError([ErrorWrapper(e, loc=('body', e.pos))])
+    except ValidationError as e:
+        raise RequestValidationError([ErrorWrapper(e, loc=('body',))])
+
+
+def _parse_record(body: bytes) -> ObservationRecord:
+    try:
+        valid, rejected = decode_records(body)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    if rejected:
+        errors = [{**error, 'loc': ['body', *error['loc']]} for error in rejected[0].errors]
+        _count_rejected(errors)
+        raise HTTPException(status_code=422, detail=errors)
+    if len(valid) != 1:
+        raise HTTPException(status_code=422, detail='request body must contain exactly one record')
+
+    return valid[0]
+
+
+@app.post('/observations', response_model=BatchResult)
+async def observations(
+        request: Request,
+        repo: Repository = Depends(_get_repository)) -> BatchResult:
+    """
+    Adds a batch of observations, given either as a JSON array, as newline-delimited JSON
+    (Content-Type: application/x-ndjson) or as concatenated binary records
+    (Content-Type: application/vnd.humtemp.observation). Invalid items are reported back, while all valid items
+    are stored.
+    """
+    body = await request.body()
+    content_type = _content_type(request)
+
+    if content_type == RECORD_CONTENT_TYPE:
+        try:
+            with VALIDATION_DURATION.time('observations'):
+                valid, rejected = decode_records(body, repo.earliest_accepted_timestamp())
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        return await _add_batch(valid, rejected, repo)
+
+    if content_type in NDJSON_CONTENT_TYPES:
+        items = _parse_ndjson(body)
+    else:
+        items = _parse_json_array(body)
+
+    valid = []
+    rejected = []
+    earliest_timestamp = repo.earliest_accepted_timestamp()
+    with VALIDATION_DURATION.time('observations'):
+        for index, item in enumerate(items):
+            if isinstance(item, BatchError):
+                rejected.append(item)
+                continue
+
+            try:
+                observation = Observation.parse_obj(item)
+            except ValidationError as e:
+                rejected.append(BatchError(index=index, errors=e.errors()))
+                continue
+
+            if observation.timestamp < earliest_timestamp:
+                rejected.append(BatchError(index=index, errors=[too_old_error(earliest_timestamp)]))
+            else:
+                valid.append(observation)
+
+    return await _add_batch(valid, rejected, repo)
+
+
+async def _add_batch(valid: Sequence[Union[Observation, ObservationRecord]],
+                     rejected: List[BatchError],
+                     repo: Repository) -> BatchResult:
+    for error in rejected:
+        _count_rejected(error.errors)
+
+    if observation_stream is not None:
+        await observation_stream.add(valid)
+    elif observation_buffer is not None:
+        observation_buffer.add(valid)
+    else:
+        await repo.add_observations(valid)
+        await _invalidate_summaries({repo.bucket_start_of(observation.timestamp) for observation in valid})
 
+    return BatchResult(accepted=len(valid), rejected=rejected)
 
-@app.get('/summary', response_model=List[Summary])
+
+async def _invalidate_summaries(bucket_starts: Iterable[int]) -> None:
+    if summary_cache is not None:
+        await summary_cache.invalidate(bucket_starts)
+
+
+def _count_rejected(errors: Sequence[Dict[str, Any]]) -> None:
+    """
+    Counts a rejected observation once per failed field, e.g. with the reason "lab_id:value_error".
+    """
+    for error in errors:
+        field = error['loc'][-1] if error['loc'] else 'body'
+        OBSERVATIONS_REJECTED.inc(f'{field}:{error["type"]}')
+
+
+def _parse_json_array(body: bytes) -> List[Any]:
+    try:
+        items = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=422, detail='request body is not valid JSON')
+
+    if not isinstance(items, list):
+        raise HTTPException(status_code=422, detail='request body must be a JSON array of observations')
+
+    return items
+
+
+def _parse_ndjson(body: bytes) -> List[Any]:
+    items = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(BatchError(index=len(items), errors=[
+                {'loc': ['body'], 'msg': 'invalid JSON', 'type': 'value_error.jsondecode'}
+            ]))
+
+    return items
+
+
+# the summaries carry their "bucket_start" with "series=true"
+@app.get('/summary', response_model=Union[List[Summary], List[BucketSummary]])
 async def summary(
+        request: Request,
         offset: int = -1,
-        repo: BucketRepository = Depends(_get_repository)) -> List[Summary]:
-    result = []
-    for key in repo.find_in_bucket(offset=offset):
-        entity = repo.get(key)
-        if entity is None:
-            continue
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        from_offset: Optional[int] = Query(None, alias='from'),
+        to_offset: Optional[int] = Query(None, alias='to'),
+        lab_id: Optional[str] = Query(None, max_length=LABID_MAX_LENGTH, regex=LABID_REGEX),
+        series: bool = False,
+        repo: Repository = Depends(_get_repository)) -> Response:
+    """
+    Summary of all labs within a bucket. Summaries of completed buckets are cached until the bucket expires, the
+    summaries of the current bucket and of buckets still accepting late observations for "humtemp_summary_cache_ttl"
+    seconds.
+
+    With "Accept: application/x-ndjson", the summaries are streamed as newline-delimited JSON while the bucket is
+    scanned. With "limit", only a page of roughly "limit" summaries is returned, and the cursor to fetch the next page
+    with is given in the "X-Next-Cursor" response header (which is missing on the last page).
+
+    With "from" and/or "to" (bucket offsets, inclusive, both default to "offset") and/or "lab_id", the buckets of the
+    range are merged into one summary per lab, or returned per bucket with "series=true".
+    """
+    if from_offset is not None or to_offset is not None or lab_id is not None:
+        if limit is not None or cursor is not None:
+            raise HTTPException(status_code=400, detail='range queries don\'t support "limit" and "cursor"')
+
+        return await _range_summary(
+            repo,
+            offset if from_offset is None else from_offset,
+            offset if to_offset is None else to_offset,
+            lab_id,
+            series
+        )
+
+    ndjson = request.headers.get('accept', '').split(';')[0].strip() in NDJSON_CONTENT_TYPES
+
+    if limit is None and cursor is None and not ndjson:
+        return _cached_response(request, await _cached_summary(repo, offset))
+
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail='"limit" must be positive')
+
+    try:
+        if limit is not None:
+            next_cursor, keys = await _scan_page(repo, offset, cursor, limit)
+            remaining_cursor = None
+        else:
+            next_cursor = None
+            remaining_cursor, keys = await repo.scan_bucket(offset, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {'X-Next-Cursor': next_cursor} if next_cursor is not None else {}
+    return StreamingResponse(
+        _stream_summaries(repo, offset, keys, remaining_cursor, ndjson),
+        media_type=NDJSON_CONTENT_TYPES[0] if ndjson else 'application/json',
+        headers=headers
+    )
+
+
+async def _range_summary(repo: Repository,
+                         from_offset: int,
+                         to_offset: int,
+                         lab_id: Optional[LabId],
+                         series: bool) -> Response:
+    """
+    Reads all buckets of the range with one pipelined read of the bucket indexes (skipped for a single lab),
+    followed by one pipelined read per "humtemp_fetch_chunk_size" buckets.
+    """
+    if from_offset > to_offset:
+        raise HTTPException(status_code=400, detail='"from" must not be greater than "to"')
+
+    keys = await repo.find_in_buckets(from_offset, to_offset, lab_id)
+    entities = repo.get_many(keys)
+
+    if series:
+        result = [dict(_summary_of(entity), bucket_start=entity.bucket_start) async for entity in entities]
+        result.sort(key=lambda summary: (summary['bucket_start'], summary['lab_id']))
+    else:
+        merged = await _merge_by_lab(entities)
+        await _count_sensors(repo, merged, keys, BucketEntity)
+        result = [_summary_of(entity) for entity in merged.values()]
+
+    return Response(content=orjson.dumps(result), media_type='application/json')
+
+
+async def _merge_by_lab(entities: AsyncIterator[BucketEntity]) -> Dict[LabId, BucketEntity]:
+    merged: Dict[LabId, BucketEntity] = {}
+    async for entity in entities:
+        existing = merged.get(entity.lab_id)
+        if existing is None:
+            merged[entity.lab_id] = entity
+        else:
+            existing.merge(entity)
+
+    return merged
+
+
+async def _count_sensors(repo: Repository,
+                         merged: Dict[LabId, BucketEntity],
+                         keys: List[BucketKey],
+                         entity_type: Type[BucketEntity]) -> None:
+    """
+    Counts the distinct sensors of the merged entities over the union of their buckets.
+    """
+    # with as many keys as labs, nothing has been merged and the buckets have been counted when reading them
+    if not get_settings().humtemp_sketches_enabled or len(keys) == len(merged):
+        return
+
+    for lab_id, num_sensors in (await repo.count_sensors(keys, entity_type)).items():
+        if lab_id in merged:
+            merged[lab_id].num_sensors = num_sensors
+
+
+async def _cached_summary(repo: Repository, offset: int) -> CachedSummary:
+    bucket_start = repo.bucket_start_for_offset(offset)
+
+    cached = await summary_cache.get(bucket_start) if summary_cache is not None else None
+    if cached is not None:
+        return cached
+
+    body = await _render_summary(repo, offset)
+
+    expires_at = time.time() + get_settings().humtemp_summary_cache_ttl
+    # late observations can still change the summary of a completed bucket until they are rejected. Other workers
+    # don't notice when they are written, so their entries must expire soon enough.
+    if repo.bucket_start_for_offset(offset + 1) <= repo.earliest_accepted_timestamp():
+        expires_at = repo.bucket_expiry(bucket_start)
+
+    if summary_cache is not None:
+        return await summary_cache.set(bucket_start, body, expires_at)
+
+    return CachedSummary.create(body, expires_at)
+
+
+async def _render_summary(repo: Repository, offset: int) -> bytes:
+    return orjson.dumps([_summary_of(entity) async for entity in repo.get_many(await repo.find_in_bucket(offset))])
+
+
+async def _scan_page(repo: Repository,
+                     offset: int,
+                     cursor: Optional[str],
+                     limit: int) -> Tuple[Optional[str], List[BucketKey]]:
+    """
+    Scans the bucket until at least "limit" keys are found. SSCAN may return more keys than requested,
+    so the page can be slightly larger.
+    """
+    keys: List[BucketKey] = []
+    while True:
+        cursor, page = await repo.scan_bucket(offset, cursor, limit - len(keys))
+        keys.extend(page)
+
+        if cursor is None or len(keys) >= limit:
+            return cursor, keys
+
+
+async def _stream_summaries(repo: Repository,
+                            offset: int,
+                            keys: List[BucketKey],
+                            cursor: Optional[str],
+                            ndjson: bool) -> AsyncIterator[bytes]:
+    """
+    Encodes the summaries of the given keys, followed by the keys scanned from "cursor" on (if given).
+    Every scanned page is fetched and sent as a single chunk, so the memory usage is bounded by the page size.
+    """
+    separator = b'\n' if ndjson else b','
+    first = True
+
+    if not ndjson:
+        yield b'['
+
+    while True:
+        encoded = [orjson.dumps(_summary_of(entity)) async for entity in repo.get_many(keys)]
+        if encoded:
+            chunk = separator.join(encoded)
+            if ndjson:
+                chunk += b'\n'
+            elif not first:
+                chunk = b',' + chunk
+
+            first = False
+            yield chunk
+
+        if cursor is None:
+            break
+
+        cursor, keys = await repo.scan_bucket(offset, cursor)
+
+    if not ndjson:
+        yield b']'
+
+
+@app.get('/summary/rollups', response_model=List[Summary])
+async def summary_rollups(
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        window: Optional[int] = None,
+        repo: Repository = Depends(_get_repository)) -> Response:
+    """
+    Summary of all labs within the time range [start, end), merged from the precomputed sub-bucket aggregates
+    ("rollups"). The range is widened to the boundaries of the sub-buckets and limited to the retained buckets.
+
+    Instead of "start" and "end", a sliding "window" of the last seconds can be given. It spans whole sub-buckets,
+    i.e. it may start up to "humtemp_rollup_duration" seconds earlier.
+    """
+    if not get_settings().humtemp_rollup_duration:
+        raise HTTPException(status_code=400, detail='rollups are not enabled (humtemp_rollup_duration)')
+
+    if window is not None:
+        if start is not None or end is not None or window <= 0:
+            raise HTTPException(status_code=400, detail='"window" must be positive and excludes "start" and "end"')
+
+        end = int(time.time()) + 1
+        start = end - window
+    elif start is None or end is None:
+        raise HTTPException(status_code=400, detail='either "start" and "end", or "window" are required')
+
+    keys = await repo.find_in_rollups(start, end)
+    merged = await _merge_by_lab(repo.get_many(keys, RollupEntity))
+    await _count_sensors(repo, merged, keys, RollupEntity)
+    return Response(content=orjson.dumps([_summary_of(entity) for entity in merged.values()]),
+                    media_type='application/json')
+
+
+@app.get('/archive/summary', response_model=List[Summary])
+async def archive_summary(offset: int = -1, repo: Repository = Depends(_get_repository)) -> Response:
+    """
+    Summary of all labs within an archived bucket, also after the bucket has expired.
+    """
+    archive_path = get_settings().humtemp_archive_path
+    if not archive_path:
+        raise HTTPException(status_code=400, detail='the archive is not enabled (humtemp_archive_path)')
+
+    bucket_start = repo.bucket_start_for_offset(offset)
+    bucket = Archive(archive_path).read(bucket_start)
+    if bucket is None:
+        raise HTTPException(status_code=404, detail='bucket has not been archived')
+
+    result = [
+        _summary_of(bucket.entity(BucketEntity.construct_key(lab_id, bucket_start), BucketEntity, lab_id))
+        for lab_id in bucket.lab_ids
+    ]
+    return Response(content=orjson.dumps(result), media_type='application/json')
+
+
+def _summary_of(entity: BucketEntity) -> Dict[str, Any]:
+    """
+    The fields of a Summary, as a plain dict. Building (and validating) the pydantic model for every lab
+    would dominate the time needed to encode large summaries - Summary only documents the response schema.
+    """
+    summary = {
+        'lab_id': entity.lab_id,
+        'avg_temp': float(entity.avg_temp),
+        'avg_humidity': float(entity.avg_humidity),
+        'std_temp': float(entity.std_temp),
+        'std_humidity': float(entity.std_humidity),
+        'num_late': entity.num_late,
+        'min_temp': entity.min_temp,
+        'max_temp': entity.max_temp,
+        'min_humidity': entity.min_humidity,
+        'max_humidity': entity.max_humidity,
+    }
+
+    settings = get_settings()
+    if settings.humtemp_sketches_enabled:
+        mapping = sketch.get_mapping(settings.humtemp_sketch_relative_accuracy)
+        summary['median_temp'] = mapping.quantile(entity.temp_sketch, 0.5)
+        summary['p95_temp'] = mapping.quantile(entity.temp_sketch, 0.95)
+        summary['num_sensors'] = entity.num_sensors
+
+    return summary
+
+
+def _cached_response(request: Request, cached: CachedSummary) -> Response:
+    headers = {'ETag': cached.etag, 'Cache-Control': f'max-age={cached.max_age}'}
 
-        result.append(Summary(
-            lab_id=entity.lab_id,
-            avg_temp=entity.avg_temp,
-            avg_humidity=entity.avg_humidity
-        ))
+    if request.headers.get('if-none-match') == cached.etag:
+        return Response(status_code=304, headers=headers)
 
-    return result
+    return Response(content=cached.body, media_type='application/json', headers=headers)
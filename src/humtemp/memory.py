@@ -0,0 +1,352 @@
+"""
+In-process storage backend for single-node deployments without Redis (see "humtemp_storage").
+
+Every bucket is stored column-wise: one array per aggregate field, with one row per lab. Writes and reads are
+plain array accesses without any network round trips. Expired buckets are dropped by a periodic sweep, and the
+whole store can optionally be snapshotted to a file, which is memory-mapped again on startup.
+
+As the data lives in the process, the memory backend only supports a single worker process.
+"""
+import asyncio
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from array import array
+from typing import *
+
+from humtemp.database import _BucketRepositoryBase
+from humtemp.dto.observation import LabId, Observation
+from humtemp.entities import BucketEntity, BucketKey, RollupEntity
+
+logger = logging.getLogger(__name__)
+
+INT_FIELDS = ('num_observations', 'num_late')
+SUM_FIELDS = ('sum_temp', 'sum_humidity', 'sumsq_temp', 'sumsq_humidity')
+EXTREME_FIELDS = (('min_temp', min), ('max_temp', max), ('min_humidity', min), ('max_humidity', max))
+
+SNAPSHOT_MAGIC = b'HUMTEMP1'
+# entity key prefix, bucket start, expiry timestamp
+SNAPSHOT_BUCKET_HEADER = struct.Struct('<16sqq')
+# number of rows, length of the encoded lab ids
+COLUMNS_HEADER = struct.Struct('<II')
+
+store: Optional['MemoryStore'] = None
+
+
+class MemoryBucket:
+    """
+    Aggregates of all labs within a single bucket (or rollup), stored as one array per field.
+    Minimum and maximum values are NaN as long as they are unknown.
+    """
+    __slots__ = ('expires_at', 'rows', 'lab_ids', 'counts', 'sums', 'extremes')
+
+    def __init__(self, expires_at: int):
+        self.expires_at = expires_at
+        self.rows: Dict[LabId, int] = {}
+        self.lab_ids: List[LabId] = []
+        self.counts = [array('q') for _ in INT_FIELDS]
+        self.sums = [array('d') for _ in SUM_FIELDS]
+        self.extremes = [array('d') for _ in EXTREME_FIELDS]
+
+    def __len__(self) -> int:
+        return len(self.lab_ids)
+
+    @property
+    def columns(self) -> List[array]:
+        return self.counts + self.sums + self.extremes
+
+    def add(self, lab_id: LabId, entity: BucketEntity) -> None:
+        row = self.rows.get(lab_id)
+        if row is None:
+            row = self.rows[lab_id] = len(self.lab_ids)
+            self.lab_ids.append(lab_id)
+            for column in self.counts:
+                column.append(0)
+            for column in self.sums:
+                column.append(0.0)
+            for column in self.extremes:
+                column.append(math.nan)
+
+        for field, column in zip(INT_FIELDS, self.counts):
+            column[row] += getattr(entity, field)
+        for field, column in zip(SUM_FIELDS, self.sums):
+            column[row] += getattr(entity, field)
+
+        for (field, func), column in zip(EXTREME_FIELDS, self.extremes):
+            value = getattr(entity, field)
+            if value is not None:
+                current = column[row]
+                column[row] = value if math.isnan(current) else func(current, value)
+
+    def entity(self, key: BucketKey, entity_type: Type[BucketEntity], lab_id: LabId) -> Optional[BucketEntity]:
+        row = self.rows.get(lab_id)
+        if row is None:
+            return
+
+        fields = {field: column[row] for field, column in zip(INT_FIELDS + SUM_FIELDS, self.counts + self.sums)}
+        for (field, _), column in zip(EXTREME_FIELDS, self.extremes):
+            value = column[row]
+            fields[field] = None if math.isnan(value) else value
+
+        # the columns only contain values that have been validated before
+        return entity_type.construct(key=key, **fields)
+
+    def write(self, f: BinaryIO) -> None:
+        """
+        Writes the lab ids and all columns (in native byte order), to be read again with read().
+        """
+        lab_ids = '\n'.join(self.lab_ids).encode('utf8')
+        f.write(COLUMNS_HEADER.pack(len(self), len(lab_ids)))
+        f.write(lab_ids)
+        for column in self.columns:
+            column.tofile(f)
+
+    @classmethod
+    def read(cls, data: Union[bytes, mmap.mmap], offset: int, expires_at: int) -> Tuple['MemoryBucket', int]:
+        """
+        Reads a bucket written by write() from "data" at "offset". Returns the bucket and the offset after it.
+        """
+        num_rows, lab_ids_length = COLUMNS_HEADER.unpack_from(data, offset)
+        offset += COLUMNS_HEADER.size
+
+        bucket = cls(expires_at)
+        if num_rows:
+            lab_ids = data[offset:offset + lab_ids_length].decode('utf8').split('\n')
+            bucket.lab_ids = [LabId(lab_id) for lab_id in lab_ids]
+            bucket.rows = {lab_id: row for row, lab_id in enumerate(bucket.lab_ids)}
+        offset += lab_ids_length
+
+        for column in bucket.columns:
+            column.frombytes(data[offset:offset + num_rows * column.itemsize])
+            offset += num_rows * column.itemsize
+
+        return bucket, offset
+
+
+class MemoryStore:
+    """
+    All buckets and rollups, keyed by their entity key prefix and bucket start.
+    """
+    def __init__(self):
+        self.buckets: Dict[Tuple[str, int], MemoryBucket] = {}
+
+    def bucket(self, prefix: str, bucket_start: int, now: Optional[float] = None) -> Optional[MemoryBucket]:
+        """
+        The bucket, unless it doesn't exist or has already expired.
+        """
+        bucket = self.buckets.get((prefix, bucket_start))
+        if bucket is None or bucket.expires_at <= (time.time() if now is None else now):
+            return
+
+        return bucket
+
+    def add(self, entity: BucketEntity, expires_at: int) -> None:
+        lab_id, bucket_start = type(entity).deconstruct_key(entity.key)
+
+        bucket = self.buckets.get((entity.KEY_PREFIX, bucket_start))
+        if bucket is None:
+            bucket = self.buckets[(entity.KEY_PREFIX, bucket_start)] = MemoryBucket(expires_at)
+
+        bucket.add(lab_id, entity)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """
+        Drops all expired buckets. Returns the number of dropped buckets.
+        """
+        if now is None:
+            now = time.time()
+
+        expired = [key for key, bucket in self.buckets.items() if bucket.expires_at <= now]
+        for key in expired:
+            del self.buckets[key]
+
+        return len(expired)
+
+    def save(self, path: str) -> None:
+        """
+        Writes a snapshot of all buckets. The snapshot is written to a temporary file first and then renamed,
+        so a crash while saving leaves the previous snapshot intact.
+        """
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+
+            for (prefix, bucket_start), bucket in list(self.buckets.items()):
+                f.write(SNAPSHOT_BUCKET_HEADER.pack(prefix.encode('utf8'), bucket_start, bucket.expires_at))
+                bucket.write(f)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'MemoryStore':
+        """
+        Restores a snapshot written by save(). Expired buckets are skipped.
+        """
+        memory_store = cls()
+        now = time.time()
+
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError(f'{path} is not a humtemp snapshot')
+
+            offset = len(SNAPSHOT_MAGIC)
+            while offset < len(data):
+                prefix, bucket_start, expires_at = SNAPSHOT_BUCKET_HEADER.unpack_from(data, offset)
+                bucket, offset = MemoryBucket.read(data, offset + SNAPSHOT_BUCKET_HEADER.size, expires_at)
+
+                if expires_at > now:
+                    memory_store.buckets[(prefix.rstrip(b'\0').decode('utf8'), bucket_start)] = bucket
+
+        return memory_store
+
+
+class MemoryMaintenance:
+    """
+    Periodically sweeps expired buckets from the store and, if "snapshot_path" is given, writes a snapshot.
+    """
+    def __init__(self, memory_store: MemoryStore, interval: float = 60.0, snapshot_path: Optional[str] = None):
+        self.store = memory_store
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+
+        self._task: Optional[asyncio.Task] = None
+
+    def run_once(self) -> None:
+        self.store.sweep()
+        if self.snapshot_path:
+            self.store.save(self.snapshot_path)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic maintenance and writes a final snapshot.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        self.run_once()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('maintenance of the memory store failed, retrying with the next interval')
+
+
+class MemoryBucketRepository(_BucketRepositoryBase):
+    """
+    Repository storing the buckets in a MemoryStore instead of Redis. Offers the same (asyncio) interface as
+    AsyncBucketRepository, but never has to wait for anything.
+    """
+    connection: MemoryStore
+
+    def __init__(self, memory_store: Optional[MemoryStore] = None, **kwargs):
+        # the columns only hold the sums, sketches aren't supported
+        kwargs['sketches'] = False
+        super().__init__(redis=memory_store, **kwargs)
+
+    @staticmethod
+    def _default_connection() -> Optional[MemoryStore]:
+        return store
+
+    async def add_observation(self, observation: Observation) -> None:
+        await self.add_observations((observation,))
+
+    async def add_observations(self, observations: Iterable[Observation]) -> int:
+        return await self.add_aggregates(self.aggregate(observations).values())
+
+    async def add_aggregates(self, aggregates: Collection[BucketEntity]) -> int:
+        for entity in aggregates:
+            # rollups expire together with the bucket they are part of
+            expires_at = self.bucket_expiry(self._get_bucket_start(entity.bucket_start))
+            self.connection.add(entity, expires_at)
+
+        self._count_ingested(aggregates)
+        return len(aggregates)
+
+    async def find_in_bucket(self, offset: int = 0) -> Iterable[BucketKey]:
+        return self._keys_of(BucketEntity, self.bucket_start_for_offset(offset))
+
+    async def find_in_buckets(self,
+                              from_offset: int,
+                              to_offset: int,
+                              lab_id: Optional[LabId] = None) -> List[BucketKey]:
+        bucket_starts = self._bucket_starts(from_offset, to_offset)
+        if lab_id is not None:
+            return [BucketEntity.construct_key(lab_id, bucket_start) for bucket_start in bucket_starts]
+
+        return [key for bucket_start in bucket_starts for key in self._keys_of(BucketEntity, bucket_start)]
+
+    async def find_in_rollups(self, start: int, end: int) -> List[BucketKey]:
+        return [
+            key
+            for rollup_start in self._rollup_starts(start, end)
+            for key in self._keys_of(RollupEntity, rollup_start)
+        ]
+
+    async def scan_bucket(self,
+                          offset: int = 0,
+                          cursor: Optional[str] = None,
+                          count: Optional[int] = None) -> Tuple[Optional[str], List[BucketKey]]:
+        """
+        Unlike SSCAN, the cursor is the row of the next lab, so every page contains exactly "count" keys.
+        """
+        bucket_start = self.bucket_start_for_offset(offset)
+        bucket = self.connection.bucket(BucketEntity.KEY_PREFIX, bucket_start)
+        lab_ids = bucket.lab_ids if bucket is not None else []
+
+        start = self._parse_cursor(cursor)
+        end = start + (count or self.fetch_chunk_size)
+
+        keys = [BucketEntity.construct_key(lab_id, bucket_start) for lab_id in lab_ids[start:end]]
+        return str(end) if end < len(lab_ids) else None, keys
+
+    async def get(self, key: BucketKey) -> Optional[BucketEntity]:
+        return self._get(key, BucketEntity)
+
+    async def get_many(self,
+                       keys: Iterable[BucketKey],
+                       entity_type: Type[BucketEntity] = BucketEntity) -> AsyncIterator[BucketEntity]:
+        for key in keys:
+            entity = self._get(key, entity_type)
+            if entity is not None:
+                yield entity
+
+    async def count_sensors(self,
+                            keys: Iterable[BucketKey],
+                            entity_type: Type[BucketEntity] = BucketEntity) -> Dict[LabId, int]:
+        return {}
+
+    def _get(self, key: BucketKey, entity_type: Type[BucketEntity]) -> Optional[BucketEntity]:
+        lab_id, bucket_start = entity_type.deconstruct_key(key)
+
+        bucket = self.connection.bucket(entity_type.KEY_PREFIX, bucket_start)
+        if bucket is None:
+            return
+
+        return bucket.entity(key, entity_type, lab_id)
+
+    def _keys_of(self, entity_type: Type[BucketEntity], bucket_start: int) -> List[BucketKey]:
+        bucket = self.connection.bucket(entity_type.KEY_PREFIX, bucket_start)
+        if bucket is None:
+            return []
+
+        return [entity_type.construct_key(lab_id, bucket_start) for lab_id in bucket.lab_ids]
+
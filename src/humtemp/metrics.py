@@ -0,0 +1,225 @@
+"""
+Minimal, dependency-free Prometheus metrics.
+
+Metrics are plain per-worker counters without any locking: all updates happen on the event loop thread
+(or are simple enough to be safe under the GIL), and the samples are only aggregated when /metrics is scraped.
+With multiple workers, every worker reports its own values - Prometheus sums them up across the scraped instances.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import *
+
+from starlette.routing import Match
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry: List['_Metric'] = []
+
+
+class _Metric:
+    type_: ClassVar[str]
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+        registry.append(self)
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type_}'
+
+    def _labels(self, values: LabelValues, extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, values)]
+        if extra:
+            pairs.append(extra)
+
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(_Metric):
+    type_ = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: Any, amount: float = 1) -> None:
+        key = tuple(map(str, label_values))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *label_values: Any) -> float:
+        return self._values.get(tuple(map(str, label_values)), 0)
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        for label_values, value in list(self._values.items()):
+            yield f'{self.name}{self._labels(label_values)} {value}'
+
+
+class Gauge(_Metric):
+    type_ = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, *label_values: Any) -> None:
+        self._values[tuple(map(str, label_values))] = value
+
+    def value(self, *label_values: Any) -> float:
+        return self._values.get(tuple(map(str, label_values)), 0)
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        for label_values, value in list(self._values.items()):
+            yield f'{self.name}{self._labels(label_values)} {value}'
+
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+        # per label values: [count per bucket (non-cumulative, last one is +Inf), sum]
+        self._values: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        key = tuple(map(str, label_values))
+
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    @contextmanager
+    def time(self, *label_values: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values: Any) -> int:
+        state = self._values.get(tuple(map(str, label_values)))
+        return sum(state[0]) if state is not None else 0
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        for label_values, (counts, sum_) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = self._labels(label_values, f'le="{le}"')
+                yield f'{self.name}_bucket{bucket_labels} {cumulative}'
+
+            yield f'{self.name}_sum{self._labels(label_values)} {sum_}'
+            yield f'{self.name}_count{self._labels(label_values)} {cumulative}'
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware measuring the duration of every HTTP request. Requests are labelled with the path template of
+    their route (e.g. also requests rejected before reaching it), and paths without a route as "unmatched", to keep
+    the number of label values bounded.
+    """
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_DURATION.observe(time.perf_counter() - start, scope['method'], self._route_path(scope), status)
+
+    @staticmethod
+    def _route_path(scope: Dict[str, Any]) -> str:
+        # like the router: the first full match, otherwise the first partial one (the method doesn't match).
+        # the application sets itself into the scope before calling its middleware.
+        partial = None
+        for route in getattr(scope.get('app'), 'routes', ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+            if match == Match.PARTIAL and partial is None:
+                partial = route.path
+
+        return partial or 'unmatched'
+
+
+REQUEST_DURATION = Histogram(
+    'humtemp_request_duration_seconds', 'Duration of HTTP request handling', ['method', 'path', 'status']
+)
+VALIDATION_DURATION = Histogram(
+    'humtemp_validation_duration_seconds', 'Duration of validating the observations of a request', ['endpoint']
+)
+REDIS_DURATION = Histogram(
+    'humtemp_redis_duration_seconds', 'Duration of redis round trips by repository operation', ['operation']
+)
+OBSERVATIONS_INGESTED = Counter(
+    'humtemp_observations_ingested_total', 'Number of observations written to redis', ['bucket_start']
+)
+OBSERVATIONS_LATE = Counter(
+    'humtemp_observations_late_total', 'Number of observations written into already completed buckets'
+)
+OBSERVATIONS_REJECTED = Counter(
+    'humtemp_observations_rejected_total', 'Number of rejected observations by validation reason', ['reason']
+)
+OBSERVATIONS_DROPPED = Counter(
+    'humtemp_observations_dropped_total', 'Number of buffered observations dropped because redis rejected them'
+)
+OBSERVATIONS_QUEUED = Counter(
+    'humtemp_observations_queued_total', 'Number of observations added to the ingestion stream'
+)
+STREAM_LENGTH = Gauge(
+    'humtemp_stream_length', 'Number of entries in the ingestion stream which have not been applied yet'
+)
+STREAM_PENDING = Gauge(
+    'humtemp_stream_pending', 'Number of entries of the ingestion stream which are being applied by a consumer'
+)
+BUCKET_KEYS_EXAMINED = Counter(
+    'humtemp_bucket_keys_examined_total', 'Number of bucket keys read from the bucket indexes'
+)
+REQUESTS_SHED = Counter(
+    'humtemp_requests_shed_total', 'Number of requests rejected by admission control', ['reason']
+)
+ADMISSION_ACTIVE = Gauge(
+    'humtemp_admission_active', 'Number of requests being handled, as counted by admission control'
+)
+ADMISSION_QUEUED = Gauge(
+    'humtemp_admission_queued', 'Number of requests waiting to be admitted'
+)
@@ -0,0 +1,25 @@
+"""
+Moves the buckets of the original layout into the compact layout (see "humtemp_redis_compact_layout").
+
+Deploy the application with HUMTEMP_REDIS_COMPACT_LAYOUT=true first, then run "python -m humtemp.migrate" with
+the same settings. Until the migration has finished, summaries may miss the labs which haven't been moved yet.
+"""
+from redis import Redis
+
+from humtemp.configuration import get_settings
+from humtemp.database import BucketRepository
+
+
+def main() -> None:
+    settings = get_settings()
+
+    nodes = settings.humtemp_redis_shards or [f'{settings.humtemp_redis_host}:{settings.humtemp_redis_port}']
+    for node in nodes:
+        host, _, port = node.rpartition(':')
+        repo = BucketRepository(redis=Redis(host=host, port=int(port or 6379), db=settings.humtemp_redis_db))
+
+        print(f'{node}: moved {repo.migrate_to_compact_layout()} buckets to the compact layout')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+from bisect import bisect
+from collections import defaultdict
+from typing import *
+
+from redis.asyncio import Redis as AsyncRedis, BlockingConnectionPool
+
+from humtemp.database import AggregatesNotWritten, AsyncBucketRepository
+from humtemp.dto.observation import LabId, Observation
+from humtemp.entities import BucketEntity, BucketKey
+
+shard_connections: Dict[str, AsyncRedis] = {}
+ring: Optional['HashRing'] = None
+
+
+def connect_shards(nodes: Sequence[str], db: int = 0, pool_size: int = 50) -> None:
+    """
+    Creates one asyncio connection pool per shard. Every node is given as "host:port".
+    Like connect_async(), this must be called from within the event loop that will use the connections.
+    """
+    global ring
+
+    shard_connections.clear()
+    for node in nodes:
+        host, _, port = node.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f'redis shard "{node}" must be given as "host:port"')
+
+        pool = BlockingConnectionPool(host=host, port=int(port), db=db, encoding='utf8', max_connections=pool_size)
+        shard_connections[node] = AsyncRedis(connection_pool=pool)
+
+    ring = HashRing(nodes)
+
+
+async def disconnect_shards() -> None:
+    for redis in shard_connections.values():
+        await redis.close()
+        await redis.connection_pool.disconnect()
+
+    shard_connections.clear()
+
+
+class HashRing:
+    """
+    Consistent hash ring. Every node is placed on the ring "replicas" times, so adding or removing a node
+    only moves about 1/N of the lab ids to a different node.
+    """
+    def __init__(self, nodes: Sequence[str], replicas: int = 100):
+        if not nodes:
+            raise ValueError('a hash ring requires at least one node')
+
+        points = sorted(
+            (self._hash(f'{node}#{replica}'), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+
+        self.nodes = list(nodes)
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def get_node(self, key: str) -> str:
+        index = bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf8')).digest()[:8], 'big')
+
+
+class ShardedBucketRepository:
+    """
+    Distributes the buckets of every lab to one of several independent Redis instances.
+
+    All buckets (and bucket index entries) of a lab live on the same shard, so writes only ever touch a single shard.
+    Reads spanning all labs are fanned out to all shards concurrently.
+    """
+    def __init__(self, repositories: Dict[str, AsyncBucketRepository], ring: Optional[HashRing] = None):
+        if ring is None:
+            ring = HashRing(list(repositories))
+
+        self.repositories = repositories
+        self.ring = ring
+
+    def shard_for(self, lab_id: LabId) -> AsyncBucketRepository:
+        return self.repositories[self.ring.get_node(lab_id)]
+
+    @property
+    def _any_shard(self) -> AsyncBucketRepository:
+        # bucket boundaries are identical on all shards
+        return next(iter(self.repositories.values()))
+
+    def bucket_start_of(self, timestamp: int) -> int:
+        return self._any_shard.bucket_start_of(timestamp)
+
+    def bucket_start_for_offset(self, offset: int = 0) -> int:
+        return self._any_shard.bucket_start_for_offset(offset)
+
+    def bucket_expiry(self, bucket_start: int) -> int:
+        return self._any_shard.bucket_expiry(bucket_start)
+
+    def earliest_accepted_timestamp(self) -> int:
+        return self._any_shard.earliest_accepted_timestamp()
+
+    async def add_observation(self, observation: Observation) -> None:
+        await self.shard_for(observation.lab_id).add_observation(observation)
+
+    async def add_observations(self, observations: Iterable[Observation]) -> int:
+        return await self.add_aggregates(self.aggregate(observations).values())
+
+    def aggregate(self,
+                  observations: Iterable[Observation],
+                  aggregates: Optional[Dict[BucketKey, BucketEntity]] = None,
+                  ingested_at: Optional[int] = None) -> Dict[BucketKey, BucketEntity]:
+        return self._any_shard.aggregate(observations, aggregates, ingested_at)
+
+    async def add_aggregates(self, aggregates: Collection[BucketEntity]) -> int:
+        by_shard: Dict[str, List[BucketEntity]] = defaultdict(list)
+        for entity in aggregates:
+            by_shard[self.ring.get_node(entity.lab_id)].append(entity)
+
+        results = await asyncio.gather(*(
+            self.repositories[node].add_aggregates(shard_aggregates)
+            for node, shard_aggregates in by_shard.items()
+        ), return_exceptions=True)
+
+        # the other shards have been written even if one failed, so only the aggregates of the failed ones are reported
+        written, retryable, rejected = 0, [], []
+        cause = None
+        for shard_aggregates, result in zip(by_shard.values(), results):
+            if isinstance(result, AggregatesNotWritten):
+                retryable += result.retryable
+                rejected += result.rejected
+                cause = result.cause
+            elif isinstance(result, BaseException):
+                retryable += shard_aggregates
+                cause = result
+            else:
+                written += result
+
+        if retryable or rejected:
+            raise AggregatesNotWritten(retryable, rejected, cause)
+
+        return written
+
+    async def find_in_bucket(self, offset: int = 0) -> Iterable[BucketKey]:
+        results = await asyncio.gather(*(
+            repository.find_in_bucket(offset) for repository in self.repositories.values()
+        ))
+        return [key for keys in results for key in keys]
+
+    async def scan_bucket(self,
+                          offset: int = 0,
+                          cursor: Optional[str] = None,
+                          count: Optional[int] = None) -> Tuple[Optional[str], List[BucketKey]]:
+        """
+        Scans the shards one after the other. The cursor is "<shard index>:<cursor within the shard>".
+        """
+        shard, shard_cursor = self._parse_cursor(cursor)
+        nodes = list(self.repositories)
+
+        next_cursor, keys = await self.repositories[nodes[shard]].scan_bucket(offset, shard_cursor, count)
+        if next_cursor is None:
+            shard += 1
+            if shard == len(nodes):
+                return None, keys
+
+        return f'{shard}:{next_cursor or 0}', keys
+
+    def _parse_cursor(self, cursor: Optional[str]) -> Tuple[int, Optional[str]]:
+        if cursor is None:
+            return 0, None
+
+        shard, _, shard_cursor = cursor.partition(':')
+        if not shard.isdigit() or int(shard) >= len(self.repositories):
+            raise ValueError(f'invalid cursor "{cursor}"')
+
+        return int(shard), shard_cursor
+
+    async def find_in_buckets(self,
+                              from_offset: int,
+                              to_offset: int,
+                              lab_id: Optional[LabId] = None) -> List[BucketKey]:
+        if lab_id is not None:
+            return await self.shard_for(lab_id).find_in_buckets(from_offset, to_offset, lab_id)
+
+        results = await asyncio.gather(*(
+            repository.find_in_buckets(from_offset, to_offset) for repository in self.repositories.values()
+        ))
+        return [key for keys in results for key in keys]
+
+    async def find_in_rollups(self, start: int, end: int) -> List[BucketKey]:
+        results = await asyncio.gather(*(
+            repository.find_in_rollups(start, end) for repository in self.repositories.values()
+        ))
+        return [key for keys in results for key in keys]
+
+    async def get(self, key: BucketKey) -> Optional[BucketEntity]:
+        lab_id, _ = BucketEntity.deconstruct_key(key)
+        return await self.shard_for(lab_id).get(key)
+
+    async def get_many(self,
+                       keys: Iterable[BucketKey],
+                       entity_type: Type[BucketEntity] = BucketEntity) -> AsyncIterator[BucketEntity]:
+        by_shard: Dict[str, List[BucketKey]] = defaultdict(list)
+        for key in keys:
+            lab_id, _ = entity_type.deconstruct_key(key)
+            by_shard[self.ring.get_node(lab_id)].append(key)
+
+        results = await asyncio.gather(*(
+            self._collect(self.repositories[node].get_many(shard_keys, entity_type))
+            for node, shard_keys in by_shard.items()
+        ))
+
+        for entities in results:
+            for entity in entities:
+                yield entity
+
+    async def count_sensors(self,
+                            keys: Iterable[BucketKey],
+                            entity_type: Type[BucketEntity] = BucketEntity) -> Dict[LabId, int]:
+        # all buckets of a lab live on the same shard, so the counts of the shards don't overlap
+        by_shard: Dict[str, List[BucketKey]] = defaultdict(list)
+        for key in keys:
+            lab_id, _ = entity_type.deconstruct_key(key)
+            by_shard[self.ring.get_node(lab_id)].append(key)
+
+        results = await asyncio.gather(*(
+            self.repositories[node].count_sensors(shard_keys, entity_type)
+            for node, shard_keys in by_shard.items()
+        ))
+        return {lab_id: count for counts in results for lab_id, count in counts.items()}
+
+    @staticmethod
+    async def _collect(entities: AsyncIterator[BucketEntity]) -> List[BucketEntity]:
+        return [entity async for entity in entities]
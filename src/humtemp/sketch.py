@@ -0,0 +1,79 @@
+"""
+Mergeable quantile sketches of the temperature (see "humtemp_sketches_enabled").
+
+The sketch of a lab and bucket is a DDSketch: every value is counted in a logarithmically sized sub-range
+("key"), so that every quantile is estimated with a relative error of at most "relative_accuracy". Sketches
+are merged by adding up the counts of equal keys, which maps to HINCRBY on a redis hash.
+
+Values closer than "min_value" to zero are counted as zero. This bounds the number of keys per sketch by
+the range of the values, e.g. to at most ~900 keys for temperatures within +-60 degrees and 1% accuracy -
+typically only a few dozen of them are used.
+"""
+import math
+from functools import lru_cache
+from typing import *
+
+ZERO_KEY = 'z'
+
+
+class DDSketchMapping:
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('"relative_accuracy" must be between 0 and 1')
+
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+    def key(self, value: float) -> str:
+        """
+        The key counting the value: "p<index>" for positive, "n<index>" for negative values.
+        """
+        magnitude = abs(value)
+        if magnitude < self.min_value:
+            return ZERO_KEY
+
+        index = math.ceil(math.log(magnitude) / self._log_gamma)
+        return f'p{index}' if value > 0 else f'n{index}'
+
+    def value(self, key: str) -> float:
+        """
+        The value representing all values counted by the key, within "relative_accuracy" of each of them.
+        """
+        if key == ZERO_KEY:
+            return 0.0
+
+        magnitude = 2 * self.gamma ** int(key[1:]) / (self.gamma + 1)
+        return magnitude if key[0] == 'p' else -magnitude
+
+    def quantile(self, sketch: Dict[str, int], q: float) -> Optional[float]:
+        """
+        Estimates the "q" quantile (0 <= q <= 1) of the values counted in the sketch, None if it is empty.
+        """
+        total = sum(sketch.values())
+        if not total:
+            return
+
+        rank = q * (total - 1)
+        cumulative = 0
+        for key in sorted(sketch, key=self.value):
+            cumulative += sketch[key]
+            if cumulative > rank:
+                return self.value(key)
+
+        return self.value(max(sketch, key=self.value))
+
+
+@lru_cache()
+def get_mapping(relative_accuracy: float) -> DDSketchMapping:
+    return DDSketchMapping(relative_accuracy)
+
+
+def merge(a: Dict[str, int], b: Dict[str, int]) -> Dict[str, int]:
+    merged = dict(a)
+    for key, count in b.items():
+        merged[key] = merged.get(key, 0) + count
+
+    return merged
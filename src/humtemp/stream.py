@@ -0,0 +1,198 @@
+"""
+Asynchronous ingestion through a Redis stream (see "humtemp_stream_enabled").
+
+The API only appends the validated observations of every request to the stream, as a single entry of binary
+records, and returns right away. Consumers ("python -m humtemp.consumer") read the stream within a consumer
+group in large batches, sum up all observations of a batch per bucket and write them with one pipeline.
+
+Applied entries are acknowledged and deleted, so the length of the stream is the backlog of the consumers.
+Observations are applied at least once: if a consumer dies after writing a batch but before acknowledging it,
+the batch is claimed by another consumer after "claim_idle" seconds and applied again.
+
+Every entry carries the time it was added at, so observations are tagged as late by the time they were received,
+not by the time they are applied. Observations which are too old by the time they are applied (e.g. their bucket has
+expired in the meantime) are dropped. The binary records don't carry sensor ids, so entries with sensor ids carry
+them in a field of their own, one line per record.
+"""
+import asyncio
+import logging
+import time
+from typing import *
+
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import ResponseError
+
+from humtemp.dto.observation import Observation
+from humtemp.dto.record import encode_records, unpack_records
+from humtemp.metrics import OBSERVATIONS_QUEUED, STREAM_LENGTH, STREAM_PENDING
+
+logger = logging.getLogger(__name__)
+
+RECORDS_FIELD = b'records'
+INGESTED_AT_FIELD = b'ingested_at'
+SENSOR_IDS_FIELD = b'sensor_ids'
+
+
+class ObservationStream:
+    """
+    Producer side of the stream, used by the API workers.
+    """
+    def __init__(self,
+                 redis: AsyncRedis,
+                 stream: str = 'observation-stream',
+                 group: str = 'humtemp',
+                 max_length: int = 0):
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        # the oldest entries are trimmed beyond roughly this many entries, even if they haven't been applied yet.
+        # 0 doesn't bound the stream.
+        self.max_length = max_length
+
+    async def add(self, observations: Collection[Observation]) -> None:
+        if not observations:
+            return
+
+        records = encode_records(
+            (observation.lab_id, observation.timestamp, observation.temp, observation.humidity)
+            for observation in observations
+        )
+        fields = {RECORDS_FIELD: records, INGESTED_AT_FIELD: int(time.time())}
+        if any(observation.sensor_id for observation in observations):
+            # sensor ids can't contain line breaks, observations without one get an empty line
+            fields[SENSOR_IDS_FIELD] = '\n'.join(observation.sensor_id or '' for observation in observations)
+
+        await self.redis.xadd(self.stream, fields, maxlen=self.max_length or None, approximate=True)
+        OBSERVATIONS_QUEUED.inc(amount=len(observations))
+
+    async def update_metrics(self) -> None:
+        """
+        Reads the backlog of the consumer group into the stream metrics.
+        """
+        length = await self.redis.xlen(self.stream)
+        STREAM_LENGTH.set(length)
+
+        pending = 0
+        if length:
+            for group in await self.redis.xinfo_groups(self.stream):
+                if group['name'].decode('utf8') == self.group:
+                    pending = group['pending']
+        STREAM_PENDING.set(pending)
+
+
+class StreamConsumer:
+    """
+    Applies the entries of the stream to the repository. Any number of consumers (with different names) can
+    share the work within the same consumer group.
+    """
+    def __init__(self,
+                 redis: AsyncRedis,
+                 repository: Any,
+                 name: str,
+                 stream: str = 'observation-stream',
+                 group: str = 'humtemp',
+                 batch_size: int = 1000,
+                 block: float = 1.0,
+                 claim_idle: float = 60.0):
+        self.redis = redis
+        self.repository = repository
+        self.name = name
+        self.stream = stream
+        self.group = group
+        # maximum number of stream entries (i.e. requests) applied at once
+        self.batch_size = batch_size
+        # seconds to wait for new entries if the stream is empty
+        self.block = block
+        # entries which were delivered to a consumer this many seconds ago without being acknowledged are claimed
+        self.claim_idle = claim_idle
+
+        self._last_claim = 0.0
+        self._stopped = False
+
+    async def create_group(self) -> None:
+        """
+        Creates the consumer group (and the stream), unless it already exists. A new group starts with the
+        first entry of the stream.
+        """
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    async def consume(self) -> int:
+        """
+        Applies one batch of entries: entries abandoned by other consumers if there are any, new entries otherwise.
+        Returns the number of applied observations.
+        """
+        entries = await self._claim()
+        if not entries:
+            response = await self.redis.xreadgroup(
+                self.group, self.name, {self.stream: '>'}, count=self.batch_size, block=int(self.block * 1000)
+            )
+            entries = response[0][1] if response else []
+
+        if not entries:
+            return 0
+
+        earliest_timestamp = self.repository.earliest_accepted_timestamp()
+        aggregates = {}
+        applied = dropped = 0
+        for _, fields in entries:
+            if not fields:
+                continue
+
+            records = unpack_records(fields[RECORDS_FIELD])
+            if SENSOR_IDS_FIELD in fields:
+                sensor_ids = fields[SENSOR_IDS_FIELD].decode('ascii').split('\n')
+                records = [
+                    record._replace(sensor_id=sensor_id or None) for record, sensor_id in zip(records, sensor_ids)
+                ]
+
+            observations = [record for record in records if record.timestamp >= earliest_timestamp]
+            dropped += len(records) - len(observations)
+            applied += len(observations)
+
+            # entries added by older versions don't carry the time they were added at
+            ingested_at = int(fields[INGESTED_AT_FIELD]) if INGESTED_AT_FIELD in fields else None
+            self.repository.aggregate(observations, aggregates, ingested_at)
+
+        if dropped:
+            logger.warning('dropped %d observations which are too old to be applied', dropped)
+
+        await self.repository.add_aggregates(aggregates.values())
+
+        ids = [entry_id for entry_id, _ in entries]
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xack(self.stream, self.group, *ids)
+        pipe.xdel(self.stream, *ids)
+        await pipe.execute()
+
+        return applied
+
+    async def _claim(self) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        now = time.monotonic()
+        if now - self._last_claim < self.claim_idle:
+            return []
+        self._last_claim = now
+
+        _, entries, *_ = await self.redis.xautoclaim(
+            self.stream, self.group, self.name, min_idle_time=int(self.claim_idle * 1000), count=self.batch_size
+        )
+        return entries
+
+    async def run(self) -> None:
+        """
+        Consumes batches until stop() is called. The batch being applied at that moment is completed.
+        """
+        await self.create_group()
+
+        while not self._stopped:
+            try:
+                await self.consume()
+            except Exception:
+                logger.exception('applying observations from the stream failed, retrying')
+                await asyncio.sleep(self.block)
+
+    def stop(self) -> None:
+        self._stopped = True
@@ -0,0 +1,17 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    """
+    A fresh current event loop for every test. The TestClient of starlette < 0.15 runs the application on the
+    current event loop, which asyncio.run() unsets.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+
+    asyncio.set_event_loop(None)
+    loop.close()
@@ -1,19 +1,41 @@
+import json
 from datetime import datetime, timezone, date, time, timedelta
+from unittest.mock import patch
 
+import pytest
 from fastapi.testclient import TestClient
 
+from humtemp import database
+from humtemp.configuration import get_settings
 from humtemp.main import app
-from humtemp.database import connection, connect
 
-client = TestClient(app)
 
+EXPECTED_SUMMARY = [{
+    'lab_id': 'lab01',
+    'avg_temp': 5.5,
+    'avg_humidity': 15.5,
+    'std_temp': pytest.approx(2.8722813),
+    'std_humidity': pytest.approx(2.8722813),
+    # all observations are written into yesterday's bucket
+    'num_late': 10,
+    'min_temp': 1.0,
+    'max_temp': 10.0,
+    'min_humidity': 11.0,
+    'max_humidity': 20.0,
+}]
 
-def setup_function():
-    connect(host='localhost')
-    connection.flushdb()
 
+@pytest.fixture(autouse=True)
+def client():
+    database.connect(host='localhost')
+    database.connection.flushdb()
 
-def test_calculation():
+    # entering the client runs the startup hooks, which create the redis connection pool
+    with TestClient(app) as client:
+        yield client
+
+
+def test_calculation(client):
     yesterday = datetime.combine(date.today() - timedelta(days=1), time.min, tzinfo=timezone.utc)
     yesterday_ts = int(yesterday.timestamp())
 
@@ -33,7 +55,7 @@ def test_calculation():
 
     response = client.get('/summary')
     assert response.status_code == 200
-    assert response.json() == [{'lab_id': 'lab01', 'avg_temp': 5.5, 'avg_humidity': 15.5}]
+    assert response.json() == EXPECTED_SUMMARY
 
     response = client.get('/summary', params={'offset': 0})
     assert response.status_code == 200
@@ -42,3 +64,58 @@ def test_calculation():
     response = client.get('/summary', params={'offset': -2})
     assert response.status_code == 200
     assert response.json() == []
+
+
+def test_batch_calculation(client):
+    yesterday = datetime.combine(date.today() - timedelta(days=1), time.min, tzinfo=timezone.utc)
+    yesterday_ts = int(yesterday.timestamp())
+
+    data = []
+    for i in range(10):
+        data.append({
+            "lab_id": "lab01",
+            "timestamp": yesterday_ts + i * 30,
+            "temp": i+1,
+            "humidity": 10+i+1
+        })
+    data.append({"lab_id": "", "timestamp": yesterday_ts, "temp": 1, "humidity": 1})
+
+    response = client.post('/observations', json=data)
+    assert response.status_code == 200
+    assert response.json()['accepted'] == 10
+    assert response.json()['rejected'][0]['index'] == 10
+
+    response = client.get('/summary')
+    assert response.status_code == 200
+    assert response.json() == EXPECTED_SUMMARY
+
+    response = client.get('/summary', headers={'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.text.splitlines()] == EXPECTED_SUMMARY
+
+    response = client.get('/summary', params={'limit': 10})
+    assert response.status_code == 200
+    assert response.json() == EXPECTED_SUMMARY
+    assert 'X-Next-Cursor' not in response.headers
+
+
+def test_sketches(client):
+    settings = get_settings()
+    yesterday_ts = int(datetime.combine(date.today() - timedelta(days=1), time.min, tzinfo=timezone.utc).timestamp())
+
+    with patch.object(settings, 'humtemp_sketches_enabled', True):
+        response = client.post('/observations', json=[
+            {'lab_id': 'lab01', 'timestamp': yesterday_ts + i, 'temp': float(i), 'humidity': 50.0,
+             'sensor_id': f'sensor{i % 4}'}
+            for i in range(1, 101)
+        ])
+        assert response.status_code == 200
+
+        summary, = client.get('/summary', params={'offset': -1}).json()
+        assert summary['median_temp'] == pytest.approx(50.0, rel=0.01)
+        assert summary['p95_temp'] == pytest.approx(95.0, rel=0.01)
+        assert summary['num_sensors'] == 4
+
+        merged, = client.get('/summary', params={'from': -1, 'to': 0}).json()
+        assert merged['median_temp'] == summary['median_temp']
+        assert merged['num_sensors'] == 4
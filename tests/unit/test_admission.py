@@ -0,0 +1,108 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+from humtemp import admission, main, memory
+from humtemp.admission import AdmissionController, Rejected
+from humtemp.configuration import get_settings
+from humtemp.metrics import REQUEST_DURATION, REQUESTS_SHED
+
+
+def test_controller():
+    controller = AdmissionController(3, max_queue=2, queue_timeout=0.05, reserved=1)
+
+    async def scenario():
+        await controller.acquire()
+        await controller.acquire()
+
+        # the last slot is reserved for summaries
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        await controller.acquire(priority=True)
+        assert controller.active == 3
+
+        queued = asyncio.ensure_future(controller.acquire(priority=True))
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as full:
+            await controller.acquire()
+        assert full.value.status_code == 429
+
+        # a freed slot is handed over to the oldest waiter which may use it
+        controller.release()
+        await queued
+        assert not waiting.done()
+
+        controller.release()
+        controller.release()
+        await waiting
+        assert controller.active == 2
+        await controller.acquire(priority=True)
+
+        with pytest.raises(Rejected) as timed_out:
+            await controller.acquire()
+        assert timed_out.value.status_code == 503
+        assert controller.active == 3
+
+    asyncio.run(scenario())
+
+    with pytest.raises(ValueError):
+        AdmissionController(2, reserved=2)
+
+
+def test_controller_timeout_after_handover():
+    controller = AdmissionController(1)
+
+    async def handover_then_timeout(future, timeout):
+        # the slot is handed over, but the timeout fires before the waiter resumes
+        controller.release()
+        assert future.done()
+        raise asyncio.TimeoutError
+
+    async def scenario():
+        await controller.acquire()
+        with patch('humtemp.admission.asyncio.wait_for', handover_then_timeout), pytest.raises(Rejected):
+            await controller.acquire()
+
+    asyncio.run(scenario())
+    # the rejected request gave the slot back
+    assert controller.active == 0
+
+
+def test_middleware():
+    settings = get_settings()
+
+    with patch.object(settings, 'humtemp_storage', 'memory'), \
+            patch.object(settings, 'humtemp_admission_max_concurrent', 2), \
+            patch.object(settings, 'humtemp_admission_max_queue', 0), \
+            patch.object(settings, 'humtemp_admission_summary_reserved', 1), \
+            patch.object(settings, 'humtemp_admission_retry_after', 5):
+        with TestClient(main.app) as client:
+            assert admission.controller is not None
+            observation = {"lab_id": "lab01", "timestamp": 1672531200, "temp": 23.4, "humidity": 50.1}
+
+            # a request occupying the only slot available to observations
+            admission.controller.active = 1
+            shed = REQUESTS_SHED.value('queue_full')
+
+            response = client.post('/observation', json=observation)
+            assert response.status_code == 429
+            assert response.headers['retry-after'] == '5'
+            assert REQUESTS_SHED.value('queue_full') == shed + 1
+
+            # shed requests are measured by the path template of their route, any other path as "unmatched"
+            matched = REQUEST_DURATION.count('POST', '/observation', 429)
+            unmatched = REQUEST_DURATION.count('POST', 'unmatched', 429)
+            assert client.post('/observation').status_code == 429
+            assert client.post('/observation/0123456789').status_code == 429
+            assert REQUEST_DURATION.count('POST', '/observation', 429) == matched + 1
+            assert REQUEST_DURATION.count('POST', 'unmatched', 429) == unmatched + 1
+
+            assert client.get('/summary').status_code == 200
+            assert client.get('/metrics').status_code == 200
+            assert admission.controller.active == 1
+
+        assert admission.controller is None
+
+    memory.store = None
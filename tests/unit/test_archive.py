@@ -0,0 +1,127 @@
+import asyncio
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+from fakeredis import FakeAsyncRedis
+from fastapi.testclient import TestClient
+
+from humtemp import main, memory
+from humtemp.archive import Archive, ArchiveCompactor
+from humtemp.configuration import get_settings
+from humtemp.dto.observation import Observation
+from humtemp.entities import BucketEntity
+from humtemp.memory import MemoryBucketRepository, MemoryStore
+
+
+def test_compaction(tmp_path):
+    repo = MemoryBucketRepository(MemoryStore(), bucket_retention=3)
+    archive = Archive(str(tmp_path))
+    compactor = ArchiveCompactor(repo, archive, max_lateness=1)
+
+    last_bucket = repo.bucket_start_for_offset(-1)
+
+    async def scenario():
+        await repo.add_observations([
+            Observation(lab_id='lab01', timestamp=int(time.time()), temp=20.0, humidity=40.0),
+            Observation(lab_id='lab01', timestamp=last_bucket, temp=20.0, humidity=40.0),
+            Observation(lab_id='lab01', timestamp=last_bucket + 1, temp=22.0, humidity=42.0),
+            Observation(lab_id='lab02', timestamp=last_bucket, temp=25.0, humidity=50.0),
+        ])
+        return await compactor.compact(), await compactor.compact()
+
+    first, second = asyncio.run(scenario())
+
+    # the current bucket is never archived, completed buckets only until they can't change anymore
+    assert first == [last_bucket, repo.bucket_start_for_offset(-2)]
+    assert second == []
+
+    bucket = archive.read(last_bucket)
+    assert bucket.lab_ids == ['lab01', 'lab02']
+
+    entity = bucket.entity(BucketEntity.construct_key('lab01', last_bucket), BucketEntity, 'lab01')
+    assert (entity.num_observations, entity.avg_temp, entity.max_humidity) == (2, 21.0, 42.0)
+
+    assert archive.read(repo.bucket_start_for_offset(-2)).lab_ids == []
+    assert archive.read(repo.bucket_start_for_offset(-3)) is None
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_compaction_lock(tmp_path):
+    redis = FakeAsyncRedis()
+    repo = MemoryBucketRepository(MemoryStore(), bucket_retention=3)
+    compactors = [ArchiveCompactor(repo, Archive(str(tmp_path / 'shared')), redis=redis) for _ in range(3)]
+    local = ArchiveCompactor(repo, Archive(str(tmp_path / 'local')), redis=redis)
+
+    async def scenario():
+        run_at = time.time()
+        archived = await asyncio.gather(*(compactor.compact(run_at) for compactor in compactors + [local]))
+        return archived, await compactors[0].compact(run_at)
+
+    # only one of the workers sharing a directory does a compaction, the others have directories of their own
+    archived, again = asyncio.run(scenario())
+    assert sorted(map(len, archived[:3])) == [0, 0, 2]
+    assert len(archived[3]) == 2
+    assert again == []
+
+    assert compactors[0].archive.identity() == Archive(str(tmp_path / 'shared')).identity()
+    assert compactors[0].archive.identity() != local.archive.identity()
+    assert not [name for name in os.listdir(tmp_path / 'shared') if name.endswith('.tmp')]
+
+
+def test_final_compaction(tmp_path):
+    day = 24 * 60 * 60
+    repo = MemoryBucketRepository(MemoryStore(), bucket_retention=3)
+    compactor = ArchiveCompactor(repo, Archive(str(tmp_path)), interval=day, max_lateness=60, delay=1)
+
+    # the last completed bucket stops accepting observations a minute after it completed
+    bucket_end = repo.bucket_start_for_offset(0)
+    assert compactor.next_run(bucket_end) == bucket_end + 61
+    assert compactor.next_run(bucket_end + 61) == bucket_end + day
+
+    # without an end of lateness, compactions only happen every interval
+    compactor.max_lateness = 0
+    assert compactor.next_run(bucket_end) == bucket_end + day
+
+
+def test_archive_summary(tmp_path, event_loop):
+    settings = get_settings()
+
+    with patch.object(settings, 'humtemp_storage', 'memory'), \
+            patch.object(settings, 'humtemp_bucket_retention', 3), \
+            patch.object(settings, 'humtemp_max_lateness', settings.humtemp_bucket_duration), \
+            patch.object(settings, 'humtemp_archive_path', str(tmp_path)):
+        with TestClient(main.app) as client:
+            # the compactor runs on startup, buckets which have expired before aren't archived
+            response = client.get('/archive/summary', params={'offset': -1})
+            assert response.json() == []
+            response = client.get('/archive/summary', params={'offset': -3})
+            assert response.status_code == 404
+
+            response = client.post('/observation', json={
+                "lab_id": "lab01", "timestamp": main.archive_compactor.repository.bucket_start_for_offset(0) - 1,
+                "temp": 23.4, "humidity": 50.1
+            })
+            assert response.status_code == 200
+
+            event_loop.run_until_complete(main.archive_compactor.compact())
+
+            response = client.get('/archive/summary', params={'offset': -1})
+            assert response.status_code == 200
+            assert [(summary['lab_id'], summary['avg_temp']) for summary in response.json()] == [('lab01', 23.4)]
+
+    memory.store = None
+
+
+def test_archive_requires_max_lateness(tmp_path):
+    settings = get_settings()
+
+    # buckets accepting observations until they expire are never final
+    with patch.object(settings, 'humtemp_storage', 'memory'), \
+            patch.object(settings, 'humtemp_max_lateness', 0), \
+            patch.object(settings, 'humtemp_archive_path', str(tmp_path)):
+        with pytest.raises(ValueError), TestClient(main.app):
+            pass
+
+    memory.store = None
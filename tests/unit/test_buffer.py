@@ -0,0 +1,138 @@
+import asyncio
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock
+
+import pytest
+from fakeredis import FakeAsyncRedis
+
+from humtemp.buffer import ObservationBuffer
+from humtemp.database import AggregatesNotWritten, AsyncBucketRepository
+from humtemp.dto.observation import Observation
+
+NOW_TS = int(datetime.now(timezone.utc).timestamp())
+
+
+def _observation(lab_id: str, temp: float) -> Observation:
+    return Observation(lab_id=lab_id, timestamp=NOW_TS, temp=temp, humidity=50.0)
+
+
+def test_flush():
+    repo = AsyncBucketRepository(redis=FakeAsyncRedis())
+
+    async def scenario():
+        buffer = ObservationBuffer(repo)
+        buffer.add([_observation('lab01', 20.0), _observation('lab01', 22.0)])
+        buffer.add([_observation('lab02', 25.0)])
+        assert len(buffer) == 2
+
+        assert await buffer.flush() == 2
+        assert len(buffer) == 0
+        assert await buffer.flush() == 0
+
+        return [entity async for entity in repo.get_many(await repo.find_in_bucket(0))]
+
+    entities = {entity.lab_id: entity for entity in asyncio.run(scenario())}
+    assert entities['lab01'].num_observations == 2
+    assert entities['lab01'].avg_temp == 21.0
+    assert entities['lab02'].num_observations == 1
+
+
+def test_flush_failure_keeps_observations():
+    repo = AsyncBucketRepository(redis=FakeAsyncRedis())
+    repo.add_aggregates = AsyncMock(side_effect=ConnectionError)
+
+    async def scenario():
+        buffer = ObservationBuffer(repo)
+        buffer.add([_observation('lab01', 20.0)])
+
+        with pytest.raises(ConnectionError):
+            await buffer.flush()
+
+        buffer.add([_observation('lab01', 22.0)])
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert len(buffer) == 1
+
+    pending = list(buffer._aggregates.values())[0]
+    assert pending.num_observations == 2
+    assert pending.sum_temp == 42.0
+
+
+def test_partial_flush_failure():
+    redis = FakeAsyncRedis()
+    repo = AsyncBucketRepository(redis=redis)
+    bucket_start = repo.bucket_start_for_offset(0)
+
+    async def scenario():
+        # redis rejects increments of a key holding a string
+        await redis.set(f'bucket:lab02:{bucket_start}', 'invalid')
+
+        buffer = ObservationBuffer(repo)
+        buffer.add([_observation('lab01', 20.0), _observation('lab02', 22.0)])
+
+        with pytest.raises(AggregatesNotWritten):
+            await buffer.flush()
+
+        # the written aggregate isn't sent again, the rejected one is dropped
+        assert len(buffer) == 0
+        assert await buffer.flush() == 0
+
+        return await repo.get(f'bucket:lab01:{bucket_start}')
+
+    assert asyncio.run(scenario()).num_observations == 1
+
+
+def test_partial_flush_failure_keeps_retryable():
+    repo = AsyncBucketRepository(redis=FakeAsyncRedis())
+    flushed = []
+
+    async def add_aggregates(aggregates):
+        aggregates = list(aggregates)
+        raise AggregatesNotWritten(retryable=[entity for entity in aggregates if entity.lab_id == 'lab02'])
+
+    repo.add_aggregates = add_aggregates
+
+    async def on_flush(bucket_starts):
+        flushed.append(bucket_starts)
+
+    async def scenario():
+        buffer = ObservationBuffer(repo, on_flush=on_flush)
+        buffer.add([_observation('lab01', 20.0), _observation('lab02', 22.0)])
+
+        with pytest.raises(AggregatesNotWritten):
+            await buffer.flush()
+
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert [entity.lab_id for entity in buffer._aggregates.values()] == ['lab02']
+    # the written bucket was still reported
+    assert flushed == [{list(buffer._aggregates.values())[0].bucket_start}]
+
+
+def test_periodic_flush_and_stop():
+    repo = AsyncBucketRepository(redis=FakeAsyncRedis())
+
+    async def scenario():
+        buffer = ObservationBuffer(repo, flush_interval=0.01, max_keys=2)
+        buffer.start()
+
+        buffer.add([_observation('lab01', 20.0)])
+        await asyncio.sleep(0.05)
+        assert len(buffer) == 0
+
+        # the size threshold triggers a flush long before the interval elapses
+        buffer.flush_interval = 60
+        await asyncio.sleep(0.02)
+        buffer.add([_observation('lab02', 20.0), _observation('lab03', 20.0)])
+        await asyncio.sleep(0.01)
+        assert len(buffer) == 0
+
+        buffer.add([_observation('lab04', 20.0)])
+        await buffer.stop()
+        assert len(buffer) == 0
+
+        return len(await repo.find_in_bucket(0))
+
+    assert asyncio.run(scenario()) == 4
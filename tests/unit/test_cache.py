@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+from fakeredis import FakeAsyncRedis
+
+from humtemp.cache import SummaryCache, SummaryMaterializer
+from humtemp.database import AsyncBucketRepository
+from humtemp.dto.observation import Observation
+
+
+def test_local_cache():
+    cache = SummaryCache(max_entries=2)
+
+    async def scenario():
+        assert await cache.get(100) is None
+
+        entry = await cache.set(100, b'[]', time.time() + 60)
+        assert await cache.get(100) == entry
+        assert 58 <= entry.max_age <= 60
+
+        await cache.set(200, b'[1]', time.time() - 1)
+        assert await cache.get(200) is None
+
+        # the expired entry is evicted first
+        await cache.set(300, b'[2]', time.time() + 60)
+        assert await cache.get(100) == entry
+        assert 200 not in cache._entries
+
+        await cache.invalidate([100])
+        assert await cache.get(100) is None
+
+    asyncio.run(scenario())
+
+
+def test_shared_cache():
+    redis = FakeAsyncRedis()
+    writer = SummaryCache(redis=redis)
+    reader = SummaryCache(redis=redis)
+
+    async def scenario():
+        entry = await writer.set(100, b'[]', time.time() + 60)
+
+        shared = await reader.get(100)
+        assert shared.body == entry.body
+        assert shared.etag == entry.etag
+
+        assert await reader.get(200) is None
+
+        # invalidating drops the shared entry as well, so it isn't fetched again
+        await writer.invalidate([100])
+        assert await writer.get(100) is None
+        assert await SummaryCache(redis=redis).get(100) is None
+
+    asyncio.run(scenario())
+
+
+def test_materializer():
+    redis = FakeAsyncRedis()
+    repo = AsyncBucketRepository(redis=redis)
+    rendered = []
+
+    async def render(offset: int) -> bytes:
+        rendered.append(offset)
+        return b'[{"lab_id": "lab01"}]'
+
+    workers = [SummaryMaterializer(repo, SummaryCache(redis=redis), render, max_lateness=1) for _ in range(3)]
+
+    async def scenario():
+        # a request cached an early summary of the bucket, which is replaced
+        await SummaryCache(redis=redis).set(repo.bucket_start_for_offset(-1), b'[]', time.time() + 3600)
+
+        # all workers try at the same time, only one of them materializes the summary
+        done = await asyncio.gather(*(worker.materialize() for worker in workers))
+
+        cached = await SummaryCache(redis=redis).get(repo.bucket_start_for_offset(-1))
+        return done, cached, await workers[0].materialize()
+
+    done, cached, done_again = asyncio.run(scenario())
+
+    assert sorted(done) == [False, False, True]
+    assert rendered == [-1]
+    assert cached.body == b'[{"lab_id": "lab01"}]'
+    # like the bucket itself, the materialized summary expires after the retention
+    assert abs(cached.expires_at - repo.bucket_expiry(repo.bucket_start_for_offset(-1))) < 2
+    assert not done_again
+
+
+def test_materializer_waits_until_final():
+    redis = FakeAsyncRedis()
+    day = 24 * 60 * 60
+    # the last completed bucket accepts late observations for 1.5 more days, but expires in 2
+    repo = AsyncBucketRepository(redis=redis, bucket_retention=3, max_lateness=day * 3 // 2)
+    last_bucket = repo.bucket_start_for_offset(-1)
+    late = repo.bucket_start_for_offset(0) - 1
+
+    async def render(offset: int) -> bytes:
+        keys = await repo.find_in_bucket(offset)
+        return ','.join(sorted(key.split(':')[1] for key in keys)).encode('utf8')
+
+    materializer = SummaryMaterializer(repo, SummaryCache(redis=redis), render, max_lateness=repo.max_lateness)
+
+    async def scenario():
+        await repo.add_observation(Observation(lab_id='lab01', timestamp=last_bucket, temp=20.0, humidity=40.0))
+        not_final = await materializer.materialize()
+
+        # a late observation, still accepted
+        assert repo.earliest_accepted_timestamp() <= late
+        await repo.add_observation(Observation(lab_id='lab02', timestamp=late, temp=20.0, humidity=40.0))
+
+        # the bucket becomes final: no more observations are accepted for it, and it's materialized
+        repo.max_lateness = materializer.max_lateness = 1
+        assert repo.earliest_accepted_timestamp() > late
+        done = await materializer.materialize()
+
+        return not_final, done, await SummaryCache(redis=redis).get(last_bucket)
+
+    not_final, done, cached = asyncio.run(scenario())
+
+    assert not not_final
+    assert done
+    assert cached.body == b'lab01,lab02'
+
+    # without an end of lateness, buckets are never final
+    assert SummaryMaterializer(repo, SummaryCache(), render).final_at(last_bucket, last_bucket + day) is None
+
+
+def test_materializer_retry():
+    redis = FakeAsyncRedis()
+    repo = AsyncBucketRepository(redis=redis)
+    attempts = []
+
+    async def render(offset: int) -> bytes:
+        attempts.append(offset)
+        if len(attempts) == 1:
+            raise ConnectionError
+        return b'[]'
+
+    materializer = SummaryMaterializer(repo, SummaryCache(redis=redis), render, max_lateness=1, retry_interval=0.01)
+
+    async def scenario():
+        materializer.start()
+        await asyncio.sleep(0.1)
+        await materializer.stop()
+        return await SummaryCache(redis=redis).get(repo.bucket_start_for_offset(-1))
+
+    # the failed attempt released the lock, and was retried right away
+    assert asyncio.run(scenario()).body == b'[]'
+    assert attempts == [-1, -1]
@@ -1,9 +1,16 @@
+import asyncio
+import statistics
 from datetime import datetime, timezone, timedelta
 from unittest.mock import Mock, patch
 
-from humtemp.database import connect, BucketRepository
+import pytest
+from fakeredis import FakeAsyncRedis, FakeRedis
+
+from humtemp.database import (
+    connect, AggregatesNotWritten, AsyncBucketRepository, BucketRepository, INCREMENT_SCRIPT_SHA
+)
 from humtemp.dto.observation import Observation
-from humtemp.entities import BucketKey
+from humtemp.entities import BucketEntity, BucketKey, RollupEntity
 
 
 @patch('humtemp.database.Redis')
@@ -30,15 +37,13 @@ def test_find_completed(dt):
     repo = BucketRepository(bucket_offset=bucket_offset, bucket_duration=bucket_duration, redis=redis)
 
     day_seconds = 60*60*24
-    redis.scan_iter = Mock(return_value=[
-        f'bucket:lab01:{bucket_offset_ts + day_seconds}'.encode('utf8'),
-        f'bucket:lab01:{bucket_offset_ts}'.encode('utf8'),
-        f'bucket:lab01:{bucket_offset_ts - day_seconds}'.encode('utf8'),
-        f'bucket:lab01:{bucket_offset_ts - 2*day_seconds}'.encode('utf8'),
-        f'bucket:lab02:{bucket_offset_ts - 2*day_seconds}'.encode('utf8'),
-        f'bucket:lab03:{bucket_offset_ts}'.encode('utf8'),
-        f'bucket:lab03:{bucket_offset_ts - day_seconds}'.encode('utf8'),
-    ])
+    index = {
+        f'bucket-index:{bucket_offset_ts + day_seconds}': {b'lab01'},
+        f'bucket-index:{bucket_offset_ts}': {b'lab01', b'lab03'},
+        f'bucket-index:{bucket_offset_ts - day_seconds}': {b'lab01', b'lab03'},
+        f'bucket-index:{bucket_offset_ts - 2*day_seconds}': {b'lab01', b'lab02'},
+    }
+    redis.smembers = Mock(side_effect=lambda key: index.get(key, set()))
 
     dt.now.return_value = datetime(2020, 1, 2, 2, 0, 0, tzinfo=timezone.utc)
 
@@ -54,6 +59,10 @@ def test_find_completed(dt):
     assert f'bucket:lab01:{bucket_offset_ts - day_seconds}' in result
     assert f'bucket:lab03:{bucket_offset_ts - day_seconds}' in result
 
+    result = list(repo.find_in_bucket(-3))
+    assert result == []
+    assert not redis.scan_iter.called
+
 
 def test_get():
     redis = Mock()
@@ -70,11 +79,50 @@ def test_get():
     assert repo.get(BucketKey('dummy')) is None
 
 
+def test_decode_entity():
+    entity = BucketRepository._decode_entity(BucketKey('bucket:lab01:0'), {
+        b'num_observations': b'2', b'num_late': b'1', b'sum_temp': b'41', b'min_temp': b'20.5', b'unknown': b'x'
+    })
+
+    assert (entity.num_observations, entity.num_late, entity.sum_temp, entity.min_temp) == (2, 1, 41.0, 20.5)
+    assert type(entity.num_observations) is int and type(entity.sum_temp) is float
+    assert (entity.sum_humidity, entity.max_temp) == (0.0, None)
+
+    entity = BucketRepository._decode_entity(BucketKey('bucket:lab01:0'), b'2,0,41,80,841,3200,20.5,20.5,,')
+    assert (entity.num_observations, entity.sum_temp, entity.min_temp, entity.max_humidity) == (2, 41.0, 20.5, None)
+
+
+def test_get_many():
+    redis = Mock()
+    repo = BucketRepository(redis=redis, fetch_chunk_size=2)
+
+    pipeline = redis.pipeline.return_value
+    pipeline.execute.side_effect = [
+        [{b'num_observations': b'1', b'sum_temp': b'22.8', b'sum_humidity': b'23'}, {}],
+        [{b'num_observations': b'2', b'sum_temp': b'40', b'sum_humidity': b'50.5'}],
+    ]
+
+    keys = [BucketKey('bucket:lab01:0'), BucketKey('bucket:lab02:0'), BucketKey('bucket:lab03:0')]
+    entities = list(repo.get_many(keys))
+
+    assert [entity.key for entity in entities] == ['bucket:lab01:0', 'bucket:lab03:0']
+    assert entities[1].num_observations == 2
+    assert entities[1].sum_humidity == 50.5
+
+    assert pipeline.hgetall.call_count == 3
+    assert pipeline.execute.call_count == 2
+
+    redis.reset_mock()
+    assert list(repo.get_many([])) == []
+    assert not redis.pipeline.called
+
+
 def test_add_observation():
     redis = Mock()
     repo = BucketRepository(redis=redis)
 
     pipeline = redis.pipeline.return_value
+    pipeline.execute.return_value = [None]
 
     observation_ts = int(datetime(2020, 1, 1, 3, 0, 30, tzinfo=timezone.utc).timestamp())
     repo.add_observation(Observation(
@@ -85,13 +133,144 @@ def test_add_observation():
     ))
 
     bucket_ts = int(datetime(2020, 1, 1, 0, 0, 0, tzinfo=timezone.utc).timestamp())
-
-    assert pipeline.hincrby.call_args.args == (f'bucket:lab01:{bucket_ts}', 'num_observations', 1)
-    assert pipeline.hincrbyfloat.called
-    assert pipeline.expireat.called
+    expiry_ts = bucket_ts + 2 * 60*60*24
+
+    assert pipeline.evalsha.call_args.args == (
+        INCREMENT_SCRIPT_SHA, 2, f'bucket:lab01:{bucket_ts}', f'bucket-index:{bucket_ts}',
+        'lab01', expiry_ts, 1, 23.1, 40.2, 23.1 * 23.1, 40.2 * 40.2, 23.1, 23.1, 40.2, 40.2,
+        # the bucket has long been completed, so the observation is late
+        1
+    )
     assert pipeline.execute.called
 
 
+def test_add_observations():
+    redis = Mock()
+    repo = BucketRepository(redis=redis)
+
+    pipeline = redis.pipeline.return_value
+    pipeline.execute.return_value = [None, None]
+
+    observation_ts = int(datetime(2020, 1, 1, 3, 0, 30, tzinfo=timezone.utc).timestamp())
+    observations = [
+        Observation(lab_id='lab01', timestamp=observation_ts, temp=20.0, humidity=40.0),
+        Observation(lab_id='lab01', timestamp=observation_ts + 30, temp=22.0, humidity=42.0),
+        Observation(lab_id='lab02', timestamp=observation_ts, temp=25.0, humidity=50.0),
+    ]
+
+    assert repo.add_observations(observations) == 2
+
+    bucket_ts = int(datetime(2020, 1, 1, 0, 0, 0, tzinfo=timezone.utc).timestamp())
+
+    evalsha_calls = [call.args[2:] for call in pipeline.evalsha.call_args_list]
+    assert [args[:3] for args in evalsha_calls] == [
+        (f'bucket:lab01:{bucket_ts}', f'bucket-index:{bucket_ts}', 'lab01'),
+        (f'bucket:lab02:{bucket_ts}', f'bucket-index:{bucket_ts}', 'lab02'),
+    ]
+    assert evalsha_calls[0][4:] == (2, 42.0, 82.0, 884.0, 3364.0, 20.0, 22.0, 40.0, 42.0, 2)
+    assert evalsha_calls[1][4:] == (1, 25.0, 50.0, 625.0, 2500.0, 25.0, 25.0, 50.0, 50.0, 1)
+
+    assert pipeline.execute.call_count == 1
+
+    redis.reset_mock()
+    assert repo.add_observations([]) == 0
+    assert not redis.pipeline.called
+
+
+def test_add_observations_script():
+    redis = FakeRedis()
+    repo = BucketRepository(redis=redis)
+
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    observations = [
+        Observation(lab_id='lab01', timestamp=now_ts, temp=20.0, humidity=40.0),
+        Observation(lab_id='lab01', timestamp=now_ts, temp=22.0, humidity=42.0),
+    ]
+
+    # the first call falls back to the script body, as redis doesn't know the script yet
+    repo.add_observations(observations)
+    assert redis.script_exists(INCREMENT_SCRIPT_SHA) == [True]
+
+    repo.add_observations(observations)
+
+    repo.add_observations([Observation(lab_id='lab01', timestamp=now_ts, temp=18.0, humidity=44.0)])
+
+    entity = list(repo.get_many(repo.find_in_bucket(0)))[0]
+    assert entity.num_observations == 5
+    assert entity.sum_temp == 102.0
+    assert entity.sum_humidity == 208.0
+    assert entity.min_temp == 18.0
+    assert entity.max_temp == 22.0
+    assert entity.min_humidity == 40.0
+    assert entity.max_humidity == 44.0
+    assert abs(entity.std_temp - statistics.pstdev([20.0, 22.0, 20.0, 22.0, 18.0])) < 1e-9
+
+    assert redis.ttl(entity.key) > 0
+    assert redis.ttl(BucketEntity.construct_index_key(entity.bucket_start)) > 0
+
+
+def test_add_aggregates_script_failure():
+    redis = FakeRedis()
+    repo = BucketRepository(redis=redis)
+    bucket_start = repo.bucket_start_for_offset(0)
+
+    # the squared temperature is infinite, so HINCRBYFLOAT fails halfway through the script
+    entity = BucketEntity(key=BucketEntity.construct_key('lab01', bucket_start))
+    entity.add(1e200, 50.0)
+    with pytest.raises(AggregatesNotWritten) as e:
+        repo.add_aggregates([entity])
+    assert e.value.rejected == [entity]
+
+    # what has been written expires with the bucket and can be found
+    assert redis.ttl(entity.key) > 0
+    assert redis.ttl(BucketEntity.construct_index_key(bucket_start)) > 0
+    assert list(repo.find_in_bucket(0)) == [entity.key]
+
+
+def test_scan_bucket():
+    repo = BucketRepository(redis=FakeRedis())
+
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    repo.add_observations([
+        Observation(lab_id=f'lab{i:0>3}', timestamp=now_ts, temp=20.0, humidity=40.0) for i in range(250)
+    ])
+
+    keys, cursor = [], None
+    while True:
+        cursor, page = repo.scan_bucket(0, cursor, count=50)
+        keys.extend(page)
+        if cursor is None:
+            break
+
+    assert sorted(keys) == sorted(repo.find_in_bucket(0))
+    assert len(set(keys)) == 250
+
+    with pytest.raises(ValueError):
+        repo.scan_bucket(0, 'abc')
+
+
+def test_find_in_buckets():
+    repo = BucketRepository(redis=FakeRedis(), bucket_retention=3)
+
+    observations = [
+        Observation(lab_id=lab_id, timestamp=repo.bucket_start_for_offset(offset), temp=20.0, humidity=40.0)
+        for offset in [-3, -2, -1, 0]
+        for lab_id in ['lab01', 'lab02']
+    ]
+    repo.add_observations(observations)
+
+    keys = repo.find_in_buckets(-5, 5)
+    assert len(keys) == 6
+    assert {BucketEntity.deconstruct_key(key)[1] for key in keys} == {
+        repo.bucket_start_for_offset(offset) for offset in [-2, -1, 0]
+    }
+
+    assert repo.find_in_buckets(-1, -1, lab_id='lab02') == [
+        BucketEntity.construct_key('lab02', repo.bucket_start_for_offset(-1))
+    ]
+    assert repo.find_in_buckets(0, -1) == []
+
+
 def test__get_bucket_start():
     bucket_offset = datetime(2020, 1, 1, 23, 0, 0, tzinfo=timezone.utc)
     bucket_offset_ts = int(bucket_offset.timestamp())
@@ -130,3 +309,194 @@ def test__timestamp_is_in_bucket(dt):
     assert repo._timestamp_is_in_bucket(bucket_offset_ts + 1)
     assert not repo._timestamp_is_in_bucket(bucket_offset_ts + bucket_duration_seconds)
     assert not repo._timestamp_is_in_bucket(bucket_offset_ts - 1)
+
+
+def test_async_repository():
+    redis = FakeAsyncRedis()
+    repo = AsyncBucketRepository(redis=redis, fetch_chunk_size=1)
+
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+
+    async def scenario():
+        await repo.add_observation(Observation(lab_id='lab01', timestamp=now_ts, temp=20.0, humidity=40.0))
+        await repo.add_observations([
+            Observation(lab_id='lab01', timestamp=now_ts, temp=22.0, humidity=42.0),
+            Observation(lab_id='lab02', timestamp=now_ts, temp=25.0, humidity=50.0),
+        ])
+
+        keys = await repo.find_in_bucket(0)
+        entities = [entity async for entity in repo.get_many(keys)]
+        single = await repo.get(BucketEntity.construct_key('lab01', repo._get_bucket_start(now_ts)))
+
+        return entities, single
+
+    entities, single = asyncio.run(scenario())
+
+    entities = {entity.lab_id: entity for entity in entities}
+    assert entities['lab01'].num_observations == 2
+    assert entities['lab01'].avg_temp == 21.0
+    assert entities['lab02'].avg_humidity == 50.0
+
+    assert single == entities['lab01']
+
+
+def test_rollups():
+    redis = FakeRedis()
+    bucket_offset = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    repo = BucketRepository(bucket_offset=bucket_offset, rollup_duration=timedelta(hours=1), redis=redis)
+
+    bucket_start = repo.bucket_start_for_offset(-1)
+    repo.add_observations([
+        Observation(lab_id='lab01', timestamp=bucket_start + 10, temp=20.0, humidity=40.0),
+        Observation(lab_id='lab01', timestamp=bucket_start + 3600 + 10, temp=22.0, humidity=42.0),
+        Observation(lab_id='lab01', timestamp=bucket_start + 3600 + 20, temp=24.0, humidity=44.0),
+        Observation(lab_id='lab02', timestamp=bucket_start + 3600 + 20, temp=30.0, humidity=50.0),
+    ])
+
+    # buckets are written as usual
+    assert len(repo.find_in_bucket(-1)) == 2
+
+    keys = repo.find_in_rollups(bucket_start + 3600, bucket_start + 7200)
+    assert sorted(keys) == [f'rollup:lab01:{bucket_start + 3600}', f'rollup:lab02:{bucket_start + 3600}']
+
+    keys = repo.find_in_rollups(bucket_start, bucket_start + 7200)
+    rollups = list(repo.get_many(keys, RollupEntity))
+    assert len(rollups) == 3
+    assert all(isinstance(rollup, RollupEntity) for rollup in rollups)
+
+    merged = RollupEntity(key=RollupEntity.construct_key('lab01', bucket_start))
+    for rollup in rollups:
+        if rollup.lab_id == 'lab01':
+            merged.merge(rollup)
+
+    assert merged.num_observations == 3
+    assert merged.avg_temp == 22.0
+    assert merged.min_temp == 20.0
+    assert merged.max_humidity == 44.0
+
+    assert redis.ttl(f'rollup:lab01:{bucket_start}') == redis.ttl(f'bucket:lab01:{bucket_start}')
+
+    with pytest.raises(ValueError):
+        BucketRepository(bucket_offset=bucket_offset, rollup_duration=timedelta(hours=7), redis=redis)
+
+
+def test_late_observations():
+    redis = FakeRedis()
+    repo = BucketRepository(redis=redis, bucket_retention=2)
+
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    earliest = repo.earliest_accepted_timestamp()
+    assert earliest == repo.bucket_start_for_offset(-1)
+
+    repo.add_observations([
+        Observation(lab_id='lab01', timestamp=now_ts, temp=20.0, humidity=40.0),
+        Observation(lab_id='lab01', timestamp=earliest, temp=20.0, humidity=40.0),
+        Observation(lab_id='lab01', timestamp=earliest + 1, temp=20.0, humidity=40.0),
+    ])
+
+    current = repo.get(BucketEntity.construct_key('lab01', repo.bucket_start_for_offset(0)))
+    previous = repo.get(BucketEntity.construct_key('lab01', repo.bucket_start_for_offset(-1)))
+    assert (current.num_observations, current.num_late) == (1, 0)
+    assert (previous.num_observations, previous.num_late) == (2, 2)
+
+    repo = BucketRepository(redis=redis, bucket_retention=2, max_lateness=60)
+    assert now_ts - 60 <= repo.earliest_accepted_timestamp() <= now_ts - 59
+
+
+def test_compact_layout():
+    redis = FakeRedis()
+    repo = BucketRepository(redis=redis, compact_layout=True, rollup_duration=timedelta(hours=1))
+
+    bucket_start = repo.bucket_start_for_offset(-1)
+    repo.add_observations([
+        Observation(lab_id='lab01', timestamp=bucket_start + 10, temp=20.1, humidity=40.0),
+        Observation(lab_id='lab02', timestamp=bucket_start + 10, temp=30.0, humidity=50.0),
+    ])
+    repo.add_observation(Observation(lab_id='lab01', timestamp=bucket_start + 3610, temp=22.3, humidity=42.0))
+
+    # a single hash per bucket, without separate index
+    assert sorted(redis.keys('bucket*')) == [f'bucket-compact:{bucket_start}'.encode('utf8')]
+    assert redis.ttl(f'bucket-compact:{bucket_start}') == redis.ttl(f'rollup-compact:{bucket_start}')
+
+    keys = repo.find_in_bucket(-1)
+    assert sorted(keys) == [f'bucket:lab01:{bucket_start}', f'bucket:lab02:{bucket_start}']
+    assert sorted(repo.scan_bucket(-1)[1]) == sorted(keys)
+
+    entity = repo.get(BucketKey(f'bucket:lab01:{bucket_start}'))
+    assert entity.num_observations == 2
+    assert entity.num_late == 2
+    assert entity.sum_temp == 20.1 + 22.3
+    assert (entity.min_temp, entity.max_temp, entity.min_humidity, entity.max_humidity) == (20.1, 22.3, 40.0, 42.0)
+    assert repo.get(BucketKey(f'bucket:lab03:{bucket_start}')) is None
+
+    rollups = list(repo.get_many(repo.find_in_rollups(bucket_start, bucket_start + 7200), RollupEntity))
+    assert sorted((rollup.lab_id, rollup.num_observations) for rollup in rollups) == [
+        ('lab01', 1), ('lab01', 1), ('lab02', 1)
+    ]
+
+
+def test_migrate_to_compact_layout():
+    redis = FakeRedis()
+    original = BucketRepository(redis=redis, rollup_duration=timedelta(hours=1))
+    compact = BucketRepository(redis=redis, compact_layout=True, rollup_duration=timedelta(hours=1))
+
+    bucket_start = original.bucket_start_for_offset(-1)
+    original.add_observations([
+        Observation(lab_id='lab01', timestamp=bucket_start + 10, temp=20.0, humidity=40.0),
+        Observation(lab_id='lab02', timestamp=bucket_start + 10, temp=30.0, humidity=50.0),
+    ])
+    # buckets written before minimum and maximum values were introduced
+    redis.hset(f'bucket:lab03:{bucket_start}', mapping={'num_observations': 1, 'sum_temp': 5.0, 'sum_humidity': 6.0})
+    redis.sadd(f'bucket-index:{bucket_start}', 'lab03')
+    # written after switching to the compact layout
+    compact.add_observation(Observation(lab_id='lab01', timestamp=bucket_start + 20, temp=22.0, humidity=38.0))
+
+    assert compact.migrate_to_compact_layout() == 5
+    assert compact.migrate_to_compact_layout() == 0
+    assert not redis.keys('bucket:*') and not redis.keys('rollup:*')
+
+    entities = {entity.lab_id: entity for entity in compact.get_many(compact.find_in_bucket(-1))}
+    assert entities['lab01'].num_observations == 2
+    assert (entities['lab01'].min_temp, entities['lab01'].max_temp) == (20.0, 22.0)
+    assert entities['lab01'].min_humidity == 38.0
+    assert entities['lab02'].avg_temp == 30.0
+    assert (entities['lab03'].avg_humidity, entities['lab03'].min_temp) == (6.0, None)
+
+    rollups = list(compact.get_many(compact.find_in_rollups(bucket_start, bucket_start + 3600), RollupEntity))
+    assert sorted(rollup.lab_id for rollup in rollups) == ['lab01', 'lab02']
+
+
+def test_sketches():
+    redis = FakeRedis()
+    repo = BucketRepository(redis=redis, sketches=True, rollup_duration=timedelta(hours=1))
+
+    bucket_start = repo.bucket_start_for_offset(-1)
+    repo.add_observations([
+        Observation(lab_id='lab01', timestamp=bucket_start + 10, temp=temp, humidity=40.0, sensor_id=f's{temp % 3}')
+        for temp in range(1, 21)
+    ])
+    repo.add_observation(Observation(lab_id='lab01', timestamp=bucket_start + 3610, temp=30.0, humidity=40.0,
+                                     sensor_id='s9'))
+
+    entity, = repo.get_many([BucketEntity.construct_key('lab01', bucket_start)])
+    assert sum(entity.temp_sketch.values()) == 21
+    assert entity.num_sensors == 4
+    assert repo.sketch_mapping.quantile(entity.temp_sketch, 0.5) == pytest.approx(11.0, rel=0.01)
+    assert redis.ttl(f'bucket-sketch:lab01:{bucket_start}') == redis.ttl(f'bucket:lab01:{bucket_start}')
+
+    # the sketches of rollups are merged, the distinct sensors counted over their union
+    keys = repo.find_in_rollups(bucket_start, bucket_start + 7200)
+    merged = RollupEntity(key=RollupEntity.construct_key('lab01', bucket_start))
+    for rollup in repo.get_many(keys, RollupEntity):
+        merged.merge(rollup)
+
+    assert merged.temp_sketch == entity.temp_sketch
+    assert merged.num_sensors is None
+    assert repo.count_sensors(keys, RollupEntity) == {'lab01': 4}
+
+    # without sketches, nothing else is written
+    plain = FakeRedis()
+    BucketRepository(redis=plain, sketches=False).add_observation(
+        Observation(lab_id='lab01', timestamp=bucket_start, temp=20.0, humidity=40.0, sensor_id='s1')
+    )
+    assert not plain.keys('bucket-s*')
@@ -0,0 +1,20 @@
+from humtemp.__main__ import HumtempApplication
+from humtemp.configuration import Settings
+from humtemp.main import app
+
+
+def test_workers():
+    assert Settings(humtemp_workers=3).workers == 3
+    assert Settings(humtemp_workers=0).workers >= 1
+
+
+def test_application():
+    application = HumtempApplication({
+        'bind': '127.0.0.1:9000',
+        'workers': 3,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+    })
+
+    assert application.cfg.workers == 3
+    assert application.cfg.bind == ['127.0.0.1:9000']
+    assert application.load() is app
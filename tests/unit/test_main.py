@@ -1,11 +1,17 @@
+import json
+import time
 from datetime import datetime, timezone, timedelta
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock, patch
 
 from fastapi.testclient import TestClient
 
-from humtemp import database
-from humtemp.entities import BucketEntity, BucketKey
+from humtemp import database, main
+from humtemp.cache import SummaryCache
+from humtemp.configuration import get_settings
+from humtemp.dto.record import RECORD_CONTENT_TYPE, encode_records
+from humtemp.entities import BucketEntity, BucketKey, RollupEntity
 from humtemp.main import app, _get_repository
+from humtemp.metrics import OBSERVATIONS_REJECTED, REQUEST_DURATION
 
 database.connection = Mock()
 
@@ -14,10 +20,12 @@ mock_bucket_repo = None
 
 
 class MockBucketRepository:
-    add_observation: Mock
+    add_observation: AsyncMock
+    add_observations: AsyncMock
 
     def __init__(self):
-        self.add_observation = Mock()
+        self.add_observation = AsyncMock()
+        self.add_observations = AsyncMock()
         self.buckets = {
             0: [
                 BucketEntity(key=BucketKey('bucket:lab01:111111')),
@@ -30,19 +38,68 @@ class MockBucketRepository:
                 BucketEntity(key=BucketKey('bucket:lab03:111110')),
             ],
         }
+        self.rollups = [
+            RollupEntity(key=BucketKey('rollup:lab01:3600'), num_observations=1, sum_temp=20.0, min_temp=20.0),
+            RollupEntity(key=BucketKey('rollup:lab01:7200'), num_observations=3, sum_temp=72.0, min_temp=22.0),
+            RollupEntity(key=BucketKey('rollup:lab02:7200'), num_observations=1, sum_temp=30.0, min_temp=30.0),
+        ]
 
-    def find_in_bucket(self, offset: int = 0):
+    def bucket_start_of(self, timestamp: int) -> int:
+        return 111111
+
+    def bucket_start_for_offset(self, offset: int = 0) -> int:
+        return 111111 + offset
+
+    def bucket_expiry(self, bucket_start: int) -> int:
+        return int(time.time()) + 3600
+
+    def earliest_accepted_timestamp(self) -> int:
+        return 1500000000
+
+    async def find_in_bucket(self, offset: int = 0):
         if offset not in self.buckets:
             return []
 
         return list([entity.key for entity in self.buckets[offset]])
 
-    def get(self, key: BucketKey):
+    async def find_in_buckets(self, from_offset: int, to_offset: int, lab_id=None):
+        return [
+            entity.key
+            for offset in range(from_offset, to_offset + 1)
+            for entity in self.buckets.get(offset, [])
+            if lab_id is None or entity.lab_id == lab_id
+        ]
+
+    async def scan_bucket(self, offset: int = 0, cursor=None, count=None):
+        keys = await self.find_in_bucket(offset)
+        start = int(cursor or 0)
+        end = start + (count or 2)
+
+        return (str(end) if end < len(keys) else None), keys[start:end]
+
+    async def find_in_rollups(self, start: int, end: int):
+        return [rollup.key for rollup in self.rollups if start <= rollup.bucket_start < end]
+
+    def _get(self, key: BucketKey):
+        for rollup in self.rollups:
+            if rollup.key == key:
+                return rollup
+
         for bucket_list in self.buckets.values():
             for entity in bucket_list:
                 if entity.key == key:
                     return entity
 
+    async def get(self, key: BucketKey):
+        return self._get(key)
+
+    async def get_many(self, keys, entity_type=BucketEntity):
+        for key in keys:
+            entity = self._get(key)
+            if entity is not None:
+                # like redis, return a fresh entity on every read
+                yield entity.copy()
+
 
 class TestObservationPost:
     def setup_method(self):
@@ -90,6 +147,36 @@ class TestObservationPost:
         })
         assert response.status_code == 422
 
+    def test_observation_post_record(self):
+        timestamp = int(datetime(2020, 2, 1, 0, 30, 30, tzinfo=timezone.utc).timestamp())
+        headers = {'Content-Type': RECORD_CONTENT_TYPE}
+
+        response = client.post('/observation', data=encode_records([('validlab', timestamp, 23.4, 50.1)]),
+                               headers=headers)
+        assert response.status_code == 200
+
+        stored = self.mock_bucket_repo.add_observation.call_args.args[0]
+        assert (stored.lab_id, stored.timestamp, stored.temp) == ('validlab', timestamp, 23.4)
+
+        response = client.post('/observation', data=encode_records([('my:lab', timestamp, 23.4, 50.1)]),
+                               headers=headers)
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['loc'] == ['body', 'lab_id']
+
+        response = client.post('/observation', data=b'\0' * 10, headers=headers)
+        assert response.status_code == 422
+
+    def test_observation_post_too_old(self):
+        response = client.post('/observation', json={
+            "lab_id": "validlab",
+            "timestamp": 1400000000,
+            "temp": 23.4,
+            "humidity": 50.1
+        })
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['type'] == 'value_error.too_old'
+        assert not self.mock_bucket_repo.add_observation.called
+
     def test_observation_post_valid(self):
         response = client.post('/observation', json={
             "lab_id": "validlab",
@@ -101,6 +188,90 @@ class TestObservationPost:
         assert self.mock_bucket_repo.add_observation.called
 
 
+class TestObservationsPost:
+    def setup_method(self):
+        self.client = TestClient(app)
+        self.mock_bucket_repo = MockBucketRepository()
+
+        app.dependency_overrides[_get_repository] = lambda: self.mock_bucket_repo
+
+    def teardown_method(self):
+        app.dependency_overrides = {}
+
+    def test_observations_post_json(self):
+        timestamp = int(datetime(2020, 2, 1, 0, 30, 30, tzinfo=timezone.utc).timestamp())
+
+        response = self.client.post('/observations', json=[
+            {"lab_id": "lab01", "timestamp": timestamp, "temp": 23.4, "humidity": 50.1},
+            {"lab_id": "", "timestamp": timestamp, "temp": 23.4, "humidity": 50.1},
+            {"lab_id": "lab02", "timestamp": timestamp, "temp": 21.0, "humidity": 45.0},
+        ])
+        assert response.status_code == 200
+
+        result = response.json()
+        assert result['accepted'] == 2
+        assert len(result['rejected']) == 1
+        assert result['rejected'][0]['index'] == 1
+        assert result['rejected'][0]['errors'][0]['loc'] == ['lab_id']
+
+        stored = self.mock_bucket_repo.add_observations.call_args.args[0]
+        assert [observation.lab_id for observation in stored] == ['lab01', 'lab02']
+
+    def test_observations_post_ndjson(self):
+        timestamp = int(datetime(2020, 2, 1, 0, 30, 30, tzinfo=timezone.utc).timestamp())
+
+        body = '\n'.join([
+            json.dumps({"lab_id": "lab01", "timestamp": timestamp, "temp": 23.4, "humidity": 50.1}),
+            '{"lab_id": "broken',
+            json.dumps({"lab_id": "lab02", "timestamp": timestamp, "temp": 21.0, "humidity": 45.0}),
+            '',
+        ])
+        response = self.client.post('/observations', data=body, headers={'Content-Type': 'application/x-ndjson'})
+        assert response.status_code == 200
+
+        result = response.json()
+        assert result['accepted'] == 2
+        assert [error['index'] for error in result['rejected']] == [1]
+
+    def test_observations_post_records(self):
+        timestamp = int(datetime(2020, 2, 1, 0, 30, 30, tzinfo=timezone.utc).timestamp())
+
+        body = encode_records([
+            ('lab01', timestamp, 23.4, 50.1),
+            ('', timestamp, 1.0, 1.0),
+            ('lab02', timestamp, 21.0, 45.0),
+        ])
+        response = self.client.post('/observations', data=body, headers={'Content-Type': RECORD_CONTENT_TYPE})
+        assert response.status_code == 200
+
+        result = response.json()
+        assert result['accepted'] == 2
+        assert [error['index'] for error in result['rejected']] == [1]
+
+        stored = self.mock_bucket_repo.add_observations.call_args.args[0]
+        assert [observation.lab_id for observation in stored] == ['lab01', 'lab02']
+
+    def test_observations_post_too_old(self):
+        response = self.client.post('/observations', json=[
+            {"lab_id": "lab01", "timestamp": 1400000000, "temp": 23.4, "humidity": 50.1},
+            {"lab_id": "lab02", "timestamp": 1600000000, "temp": 21.0, "humidity": 45.0},
+        ])
+
+        result = response.json()
+        assert result['accepted'] == 1
+        assert result['rejected'][0]['index'] == 0
+        assert result['rejected'][0]['errors'][0]['type'] == 'value_error.too_old'
+
+    def test_observations_post_invalid(self):
+        response = self.client.post('/observations', data='not json')
+        assert response.status_code == 422
+
+        response = self.client.post('/observations', json={"lab_id": "lab01"})
+        assert response.status_code == 422
+
+        assert not self.mock_bucket_repo.add_observations.called
+
+
 class TestSummaryGet:
     def setup_method(self):
         self.client = TestClient(app)
@@ -125,3 +296,163 @@ class TestSummaryGet:
         assert response.status_code == 200
         assert len(response.json()) == 0
 
+    def test_summary_cached(self):
+        main.summary_cache = SummaryCache()
+        try:
+            response = self.client.get('/summary')
+            assert response.status_code == 200
+            assert response.headers['Cache-Control'].startswith('max-age=')
+            etag = response.headers['ETag']
+
+            self.mock_bucket_repo.buckets[-1].pop()
+            response = self.client.get('/summary')
+            assert len(response.json()) == 3
+            assert response.headers['ETag'] == etag
+
+            response = self.client.get('/summary', headers={'If-None-Match': etag})
+            assert response.status_code == 304
+            assert response.content == b''
+
+            # writes into a bucket invalidate its cached summary
+            response = self.client.get('/summary', params={'offset': 0})
+            assert len(response.json()) == 3
+
+            self.mock_bucket_repo.buckets[0].pop()
+            self.client.post('/observation', json={
+                "lab_id": "validlab",
+                "timestamp": int(datetime(2020, 2, 1, 0, 30, 30, tzinfo=timezone.utc).timestamp()),
+                "temp": 23.4,
+                "humidity": 50.1
+            })
+
+            response = self.client.get('/summary', params={'offset': 0})
+            assert len(response.json()) == 2
+        finally:
+            main.summary_cache = None
+
+    def test_summary_cached_while_late_accepted(self):
+        main.summary_cache = SummaryCache()
+        # the completed bucket still accepts late observations, so its summary is only cached briefly
+        self.mock_bucket_repo.earliest_accepted_timestamp = lambda: 0
+        try:
+            response = self.client.get('/summary', params={'offset': -1})
+            assert int(response.headers['Cache-Control'][len('max-age='):]) <= get_settings().humtemp_summary_cache_ttl
+        finally:
+            main.summary_cache = None
+
+    def test_summary_streaming(self):
+        response = self.client.get('/summary', headers={'Accept': 'application/x-ndjson'})
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('application/x-ndjson')
+
+        lines = response.text.splitlines()
+        assert [json.loads(line)['lab_id'] for line in lines] == ['lab01', 'lab02', 'lab03']
+
+    def test_summary_pagination(self):
+        response = self.client.get('/summary', params={'limit': 2})
+        assert response.status_code == 200
+        assert [summary['lab_id'] for summary in response.json()] == ['lab01', 'lab02']
+        cursor = response.headers['X-Next-Cursor']
+
+        response = self.client.get('/summary', params={'limit': 2, 'cursor': cursor})
+        assert [summary['lab_id'] for summary in response.json()] == ['lab03']
+        assert 'X-Next-Cursor' not in response.headers
+
+        response = self.client.get('/summary', params={'limit': 0})
+        assert response.status_code == 400
+
+        response = self.client.get('/summary', params={'offset': -2, 'limit': 2})
+        assert response.json() == []
+
+    def test_summary_range(self):
+        self.mock_bucket_repo.buckets[0][0].num_observations = 2
+        self.mock_bucket_repo.buckets[0][0].sum_temp = 44.0
+
+        response = self.client.get('/summary', params={'from': -1, 'to': 0})
+        assert response.status_code == 200
+        summaries = {summary['lab_id']: summary for summary in response.json()}
+        assert len(summaries) == 3
+        assert summaries['lab01']['avg_temp'] == 21.0
+
+        response = self.client.get('/summary', params={'from': -1, 'to': 0, 'lab_id': 'lab01', 'series': True})
+        assert response.status_code == 200
+        assert [(s['bucket_start'], s['avg_temp']) for s in response.json()] == [(111110, 20.0), (111111, 22.0)]
+
+        # both shapes are documented
+        schema = self.client.get('/openapi.json').json()['paths']['/summary']['get']['responses']['200']
+        items = [option['items']['$ref'] for option in schema['content']['application/json']['schema']['anyOf']]
+        assert items == ['#/components/schemas/Summary', '#/components/schemas/BucketSummary']
+
+        # "to" defaults to "offset"
+        response = self.client.get('/summary', params={'from': -3, 'lab_id': 'lab02'})
+        assert [summary['lab_id'] for summary in response.json()] == ['lab02']
+
+        response = self.client.get('/summary', params={'from': 0, 'to': -1})
+        assert response.status_code == 400
+
+        # lab ids are checked like the lab ids of observations
+        for lab_id in ['', 'a:b', 'x' * 51]:
+            response = self.client.get('/summary', params={'lab_id': lab_id})
+            assert response.status_code == 422
+            assert response.json()['detail'][0]['loc'] == ['query', 'lab_id']
+
+        response = self.client.get('/summary', params={'from': -1, 'limit': 10})
+        assert response.status_code == 400
+
+    def test_summary_rollups(self):
+        response = self.client.get('/summary/rollups', params={'start': 0, 'end': 10800})
+        assert response.status_code == 400
+
+        with patch.object(get_settings(), 'humtemp_rollup_duration', 3600):
+            response = self.client.get('/summary/rollups', params={'start': 0, 'end': 10800})
+            assert response.status_code == 200
+
+            summaries = {summary['lab_id']: summary for summary in response.json()}
+            assert summaries['lab01']['avg_temp'] == 23.0
+            assert summaries['lab01']['min_temp'] == 20.0
+            assert summaries['lab02']['avg_temp'] == 30.0
+
+            response = self.client.get('/summary/rollups', params={'start': 7200, 'end': 10800})
+            summaries = {summary['lab_id']: summary for summary in response.json()}
+            assert summaries['lab01']['avg_temp'] == 24.0
+
+            response = self.client.get('/summary/rollups', params={'window': 3600})
+            assert response.status_code == 200
+
+            response = self.client.get('/summary/rollups', params={'window': 3600, 'start': 0})
+            assert response.status_code == 400
+
+            response = self.client.get('/summary/rollups')
+            assert response.status_code == 400
+
+
+class TestMetricsGet:
+    def setup_method(self):
+        self.client = TestClient(app)
+        self.mock_bucket_repo = MockBucketRepository()
+
+        app.dependency_overrides[_get_repository] = lambda: self.mock_bucket_repo
+
+    def teardown_method(self):
+        app.dependency_overrides = {}
+
+    def test_metrics(self):
+        rejected_before = OBSERVATIONS_REJECTED.value('lab_id:value_error')
+        summaries_before = REQUEST_DURATION.count('GET', '/summary', 200)
+
+        self.client.get('/summary')
+        self.client.get('/does-not-exist')
+        self.client.get('/observation')
+        self.client.post('/observation', json={"lab_id": "", "timestamp": 0, "temp": 23.4, "humidity": 50.1})
+        self.client.post('/observations', json=[{"lab_id": "", "timestamp": 0, "temp": 23.4, "humidity": 50.1}])
+
+        assert OBSERVATIONS_REJECTED.value('lab_id:value_error') == rejected_before + 2
+        assert REQUEST_DURATION.count('GET', '/summary', 200) == summaries_before + 1
+
+        response = self.client.get('/metrics')
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/plain')
+        assert 'humtemp_request_duration_seconds_count{method="GET",path="unmatched",status="404"}' in response.text
+        assert 'humtemp_request_duration_seconds_count{method="GET",path="/observation",status="405"}' in response.text
+        assert 'humtemp_validation_duration_seconds_bucket{endpoint="observation",le="+Inf"}' in response.text
+        assert 'humtemp_validation_duration_seconds_bucket{endpoint="observations",le="+Inf"}' in response.text
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from datetime import datetime, timezone, timedelta
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+
+from humtemp import main, memory
+from humtemp.configuration import get_settings
+from humtemp.dto.observation import Observation
+from humtemp.entities import BucketEntity, RollupEntity
+from humtemp.memory import MemoryBucketRepository, MemoryStore
+
+
+def test_memory_repository():
+    repo = MemoryBucketRepository(MemoryStore(), rollup_duration=timedelta(hours=1))
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+
+    async def scenario():
+        await repo.add_observation(Observation(lab_id='lab01', timestamp=now_ts, temp=20.0, humidity=40.0))
+        await repo.add_observations([
+            Observation(lab_id='lab01', timestamp=now_ts, temp=22.0, humidity=42.0),
+            Observation(lab_id='lab02', timestamp=now_ts, temp=25.0, humidity=50.0),
+            Observation(lab_id='lab03', timestamp=repo.bucket_start_for_offset(-1), temp=25.0, humidity=50.0),
+        ])
+
+        keys = await repo.find_in_bucket(0)
+        entities = {entity.lab_id: entity async for entity in repo.get_many(keys)}
+
+        cursor, page = await repo.scan_bucket(0, count=1)
+        rest = (await repo.scan_bucket(0, cursor, count=10))[1]
+
+        rollups = [rollup async for rollup in repo.get_many(
+            await repo.find_in_rollups(now_ts - 3600, now_ts + 1), RollupEntity
+        )]
+
+        return entities, page + rest, rollups, await repo.find_in_buckets(-1, 0)
+
+    entities, scanned, rollups, range_keys = asyncio.run(scenario())
+
+    assert entities['lab01'].num_observations == 2
+    assert entities['lab01'].avg_temp == 21.0
+    assert entities['lab01'].min_temp == 20.0
+    assert entities['lab01'].max_humidity == 42.0
+    assert entities['lab02'].std_temp == 0.0
+
+    assert sorted(scanned) == sorted(entity.key for entity in entities.values())
+    assert {rollup.lab_id for rollup in rollups} == {'lab01', 'lab02'}
+    assert len(range_keys) == 3
+
+
+def test_sweep_and_snapshot(tmp_path):
+    memory_store = MemoryStore()
+    memory_store.add(BucketEntity(key=BucketEntity.construct_key('lab01', 100), num_observations=1), expires_at=1)
+    memory_store.add(
+        BucketEntity(key=BucketEntity.construct_key('lab01', 200), num_observations=2, sum_temp=3.5, min_temp=1.5),
+        expires_at=int(time.time()) + 60
+    )
+    memory_store.add(RollupEntity(key=RollupEntity.construct_key('lab02', 200), num_late=1), expires_at=2 ** 40)
+
+    # expired buckets aren't returned, even before they are swept
+    assert memory_store.bucket('bucket', 100) is None
+
+    path = str(tmp_path / 'snapshot')
+    memory_store.save(path)
+    restored = MemoryStore.load(path)
+    assert set(restored.buckets) == {('bucket', 200), ('rollup', 200)}
+
+    entity = restored.bucket('bucket', 200).entity(BucketEntity.construct_key('lab01', 200), BucketEntity, 'lab01')
+    assert (entity.num_observations, entity.sum_temp, entity.min_temp, entity.max_temp) == (2, 3.5, 1.5, None)
+
+    assert memory_store.sweep() == 1
+    assert ('bucket', 100) not in memory_store.buckets
+
+
+def test_memory_storage_app(tmp_path):
+    settings = get_settings()
+    path = str(tmp_path / 'snapshot')
+
+    with patch.object(settings, 'humtemp_storage', 'memory'), patch.object(settings, 'humtemp_snapshot_path', path):
+        with TestClient(main.app) as client:
+            response = client.post('/observation', json={
+                "lab_id": "lab01", "timestamp": int(time.time()), "temp": 23.4, "humidity": 50.1
+            })
+            assert response.status_code == 200
+
+            response = client.get('/summary', params={'offset': 0})
+            assert [summary['lab_id'] for summary in response.json()] == ['lab01']
+
+        # the snapshot written on shutdown is restored on the next startup
+        with TestClient(main.app) as client:
+            response = client.get('/summary', params={'offset': 0})
+            assert [summary['lab_id'] for summary in response.json()] == ['lab01']
+
+    memory.store = None
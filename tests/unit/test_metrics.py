@@ -0,0 +1,41 @@
+from humtemp.metrics import Counter, Histogram, registry, render
+
+
+def test_counter():
+    counter = Counter('test_counter_total', 'A test counter', ['reason'])
+    try:
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        counter.inc('b"\n')
+
+        assert counter.value('a') == 3
+        assert counter.value('c') == 0
+
+        output = render()
+        assert '# TYPE test_counter_total counter' in output
+        assert 'test_counter_total{reason="a"} 3' in output
+        assert 'test_counter_total{reason="b\\"\\n"} 1' in output
+    finally:
+        registry.remove(counter)
+
+
+def test_histogram():
+    histogram = Histogram('test_duration_seconds', 'A test histogram', ['operation'], buckets=(0.1, 1.0))
+    try:
+        histogram.observe(0.05, 'get')
+        histogram.observe(0.5, 'get')
+        histogram.observe(5, 'get')
+        with histogram.time('set'):
+            pass
+
+        assert histogram.count('get') == 3
+        assert histogram.count('set') == 1
+
+        lines = list(histogram.render())
+        assert 'test_duration_seconds_bucket{operation="get",le="0.1"} 1' in lines
+        assert 'test_duration_seconds_bucket{operation="get",le="1.0"} 2' in lines
+        assert 'test_duration_seconds_bucket{operation="get",le="+Inf"} 3' in lines
+        assert 'test_duration_seconds_sum{operation="get"} 5.55' in lines
+        assert 'test_duration_seconds_count{operation="get"} 3' in lines
+    finally:
+        registry.remove(histogram)
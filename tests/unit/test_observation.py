@@ -0,0 +1,37 @@
+import time
+
+import pytest
+from pydantic import ValidationError
+
+from humtemp.dto.observation import MAX_MEASUREMENT, MIN_TIMESTAMP, Observation
+
+
+def test_lab_id_valid():
+    for lab_id in ['lab01', 'a/b.c-d_e', 'x' * 50]:
+        assert Observation(lab_id=lab_id, timestamp=0, temp=1.0, humidity=1.0).lab_id == lab_id
+
+    for lab_id in ['', 'x' * 51, 'my:lab', 'lab 01', 'läb']:
+        with pytest.raises(ValidationError):
+            Observation(lab_id=lab_id, timestamp=0, temp=1.0, humidity=1.0)
+
+
+def test_timestamp_valid():
+    now = int(time.time())
+    for timestamp in [MIN_TIMESTAMP, 0, now, now + 59]:
+        assert Observation(lab_id='lab01', timestamp=timestamp, temp=1.0, humidity=1.0).timestamp == timestamp
+
+    for timestamp in [MIN_TIMESTAMP - 1, now + 120, 2 ** 63]:
+        with pytest.raises(ValidationError):
+            Observation(lab_id='lab01', timestamp=timestamp, temp=1.0, humidity=1.0)
+
+
+def test_measurements_valid():
+    for value in [0.0, -40.5, MAX_MEASUREMENT, -MAX_MEASUREMENT]:
+        observation = Observation(lab_id='lab01', timestamp=0, temp=value, humidity=value)
+        assert (observation.temp, observation.humidity) == (value, value)
+
+    for value in [float('nan'), float('inf'), float('-inf'), 1e200, -MAX_MEASUREMENT * 2]:
+        with pytest.raises(ValidationError):
+            Observation(lab_id='lab01', timestamp=0, temp=value, humidity=1.0)
+        with pytest.raises(ValidationError):
+            Observation(lab_id='lab01', timestamp=0, temp=1.0, humidity=value)
@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+from humtemp.dto.record import RECORD, ObservationRecord, decode_records, encode_records
+
+
+def test_decode_records():
+    now = int(time.time())
+    body = encode_records([('lab01', now, 23.5, 50.0), ('lab.02/a_b-c', now - 3600, -5.0, 99.5)])
+    assert len(body) == 2 * RECORD.size
+
+    valid, rejected = decode_records(body)
+    assert rejected == []
+    assert valid == [
+        ObservationRecord('lab01', now, 23.5, 50.0),
+        ObservationRecord('lab.02/a_b-c', now - 3600, -5.0, 99.5),
+    ]
+
+    assert decode_records(b'') == ([], [])
+
+
+def test_decode_records_invalid():
+    now = int(time.time())
+    body = encode_records([
+        ('lab01', now, 23.5, 50.0),
+        ('', now, 23.5, 50.0),
+        ('myroom:1', now, 23.5, 50.0),
+        ('lab02', now + 3600, 23.5, 50.0),
+        ('lab03', now, 21.0, 40.0),
+    ])
+
+    valid, rejected = decode_records(body)
+    assert [record.lab_id for record in valid] == ['lab01', 'lab03']
+    assert [error.index for error in rejected] == [1, 2, 3]
+    assert rejected[0].errors[0]['loc'] == ['lab_id']
+    assert rejected[2].errors[0]['loc'] == ['timestamp']
+
+    with pytest.raises(ValueError):
+        decode_records(body[:-1])
+
+    with pytest.raises(ValueError):
+        encode_records([('a' * 51, now, 1.0, 1.0)])
+
+
+def test_decode_records_too_old():
+    now = int(time.time())
+    body = encode_records([('lab01', now - 100, 23.5, 50.0), ('lab02', now, 23.5, 50.0)])
+
+    valid, rejected = decode_records(body, earliest_timestamp=now - 10)
+    assert [record.lab_id for record in valid] == ['lab02']
+    assert rejected[0].index == 0
+    assert rejected[0].errors[0]['type'] == 'value_error.too_old'
+
+
+def test_decode_records_non_finite():
+    now = int(time.time())
+    for value in [float('nan'), float('inf'), float('-inf'), 1e200]:
+        # min() and max() don't notice a NaN following other values
+        body = encode_records([('lab01', now, 23.5, 50.0), ('lab02', now, value, 50.0), ('lab03', now, 21.0, value)])
+
+        valid, rejected = decode_records(body)
+        assert [record.lab_id for record in valid] == ['lab01']
+        assert [(error.index, error.errors[0]['loc']) for error in rejected] == [(1, ['temp']), (2, ['humidity'])]
@@ -0,0 +1,110 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, timezone
+
+import pytest
+from fakeredis import FakeAsyncRedis
+
+from humtemp.database import AggregatesNotWritten, AsyncBucketRepository
+from humtemp.dto.observation import Observation
+from humtemp.sharding import HashRing, ShardedBucketRepository, connect_shards
+
+
+def test_hash_ring():
+    lab_ids = [f'lab{i:0>5}' for i in range(10000)]
+
+    ring = HashRing(['redis1:6379', 'redis2:6379', 'redis3:6379'])
+    assignment = {lab_id: ring.get_node(lab_id) for lab_id in lab_ids}
+
+    # every node gets a fair share of the labs
+    for node, count in Counter(assignment.values()).items():
+        assert 2500 < count < 4200
+
+    # adding a node only moves labs to the new node
+    ring = HashRing(['redis1:6379', 'redis2:6379', 'redis3:6379', 'redis4:6379'])
+    moved = [lab_id for lab_id in lab_ids if ring.get_node(lab_id) != assignment[lab_id]]
+
+    assert 1500 < len(moved) < 3500
+    assert all(ring.get_node(lab_id) == 'redis4:6379' for lab_id in moved)
+
+    with pytest.raises(ValueError):
+        HashRing([])
+
+
+def test_connect_shards():
+    with pytest.raises(ValueError):
+        connect_shards(['localhost'])
+
+
+def test_sharded_repository():
+    shards = {node: FakeAsyncRedis() for node in ['redis1:6379', 'redis2:6379', 'redis3:6379']}
+    repo = ShardedBucketRepository({node: AsyncBucketRepository(redis=redis) for node, redis in shards.items()})
+
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    observations = [
+        Observation(lab_id=f'lab{i:0>2}', timestamp=now_ts, temp=float(i), humidity=float(i))
+        for i in range(30)
+    ]
+
+    async def scenario():
+        assert await repo.add_observations(observations) == 30
+        await repo.add_observation(observations[0])
+
+        keys = await repo.find_in_bucket(0)
+        entities = [entity async for entity in repo.get_many(keys)]
+
+        populated = [len(await redis.keys('bucket:*')) for redis in shards.values()]
+
+        scanned, cursor = [], None
+        while True:
+            cursor, page = await repo.scan_bucket(0, cursor, count=4)
+            scanned.extend(page)
+            if cursor is None:
+                break
+
+        assert sorted(await repo.find_in_buckets(-1, 0)) == sorted(keys)
+        assert len(await repo.find_in_buckets(-1, 0, lab_id='lab05')) == 2
+
+        return entities, populated, await repo.get(keys[0]), scanned
+
+    entities, populated, single, scanned = asyncio.run(scenario())
+
+    assert len(entities) == 30
+    assert {entity.lab_id: entity.num_observations for entity in entities}['lab00'] == 2
+    assert sum(populated) == 30
+    assert all(count > 0 for count in populated)
+
+    assert single is not None
+    assert single.key in {entity.key for entity in entities}
+
+    assert sorted(scanned) == sorted(entity.key for entity in entities)
+
+    with pytest.raises(ValueError):
+        asyncio.run(repo.scan_bucket(0, '5:0'))
+
+
+def test_sharded_partial_failure():
+    shards = {node: FakeAsyncRedis() for node in ['redis1:6379', 'redis2:6379']}
+    repo = ShardedBucketRepository({node: AsyncBucketRepository(redis=redis) for node, redis in shards.items()})
+
+    async def unavailable(aggregates):
+        raise ConnectionError
+
+    failing_node = repo.ring.get_node('lab00')
+    repo.repositories[failing_node].add_aggregates = unavailable
+
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    observations = [
+        Observation(lab_id=f'lab{i:0>2}', timestamp=now_ts, temp=20.0, humidity=50.0)
+        for i in range(10)
+    ]
+
+    with pytest.raises(AggregatesNotWritten) as e:
+        asyncio.run(repo.add_observations(observations))
+
+    # only the aggregates of the failed shard are reported
+    assert {entity.lab_id for entity in e.value.retryable} == {
+        observation.lab_id for observation in observations if repo.ring.get_node(observation.lab_id) == failing_node
+    }
+    assert 0 < len(e.value.retryable) < 10
+    assert not e.value.rejected
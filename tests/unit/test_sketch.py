@@ -0,0 +1,44 @@
+import random
+import statistics
+
+import pytest
+
+from humtemp.sketch import DDSketchMapping, merge
+
+
+def test_quantile():
+    mapping = DDSketchMapping(relative_accuracy=0.01)
+    values = [random.uniform(-20.0, 45.0) for _ in range(10000)]
+
+    sketch = {}
+    for value in values:
+        key = mapping.key(value)
+        sketch[key] = sketch.get(key, 0) + 1
+
+    # a few hundred keys for thousands of values
+    assert len(sketch) < 700
+
+    ordered = sorted(values)
+    for q in (0.0, 0.5, 0.95, 1.0):
+        exact = ordered[int(q * (len(ordered) - 1))]
+        assert mapping.quantile(sketch, q) == pytest.approx(exact, rel=0.01, abs=0.01)
+
+    assert mapping.quantile(sketch, 0.5) == pytest.approx(statistics.median(values), rel=0.02, abs=0.1)
+    assert mapping.quantile({}, 0.5) is None
+
+
+def test_merge():
+    mapping = DDSketchMapping()
+
+    a = {mapping.key(20.0): 2, mapping.key(0.0): 1}
+    b = {mapping.key(20.0): 1, mapping.key(-5.0): 3}
+
+    merged = merge(a, b)
+    assert merged[mapping.key(20.0)] == 3
+    assert mapping.quantile(merged, 0.0) == pytest.approx(-5.0, rel=0.01)
+    assert mapping.quantile(merged, 1.0) == pytest.approx(20.0, rel=0.01)
+    # the inputs are left untouched
+    assert a[mapping.key(20.0)] == 2
+
+    with pytest.raises(ValueError):
+        DDSketchMapping(relative_accuracy=1.5)
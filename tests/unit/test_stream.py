@@ -0,0 +1,176 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, patch
+
+from fakeredis import FakeAsyncRedis, FakeRedis, FakeServer
+from fastapi.testclient import TestClient
+
+from humtemp import main
+from humtemp.database import AsyncBucketRepository, load_scripts
+from humtemp.dto.observation import Observation
+from humtemp.dto.record import encode_records
+from humtemp.metrics import STREAM_LENGTH, STREAM_PENDING
+from humtemp.stream import INGESTED_AT_FIELD, RECORDS_FIELD, ObservationStream, StreamConsumer
+
+
+def test_stream():
+    redis = FakeAsyncRedis()
+    repo = AsyncBucketRepository(redis=redis)
+    stream = ObservationStream(redis)
+    now = int(time.time())
+
+    async def scenario():
+        await load_scripts(redis)
+
+        consumer = StreamConsumer(redis, repo, name='consumer1', block=0.01)
+        await consumer.create_group()
+        # creating an existing group is fine
+        await consumer.create_group()
+
+        await stream.add([
+            Observation(lab_id='lab01', timestamp=now, temp=20.0, humidity=40.0),
+            Observation(lab_id='lab02', timestamp=now, temp=30.0, humidity=50.0),
+        ])
+        await stream.add([Observation(lab_id='lab01', timestamp=now, temp=22.0, humidity=42.0)])
+        await stream.add([])
+        await stream.update_metrics()
+        queued = STREAM_LENGTH.value()
+
+        applied = await consumer.consume()
+        entities = {entity.lab_id: entity async for entity in repo.get_many(await repo.find_in_bucket(0))}
+        await stream.update_metrics()
+
+        return queued, applied, entities, await consumer.consume()
+
+    queued, applied, entities, applied_again = asyncio.run(scenario())
+
+    assert queued == 2
+    assert applied == 3
+    assert entities['lab01'].num_observations == 2
+    assert entities['lab01'].avg_temp == 21.0
+    assert entities['lab02'].num_observations == 1
+
+    # applied entries are deleted, the stream is empty
+    assert (STREAM_LENGTH.value(), STREAM_PENDING.value()) == (0, 0)
+    assert applied_again == 0
+
+
+def test_stream_late_and_expired():
+    redis = FakeAsyncRedis()
+    repo = AsyncBucketRepository(redis=redis, bucket_retention=2)
+    last_bucket = repo.bucket_start_for_offset(-1)
+    expired_bucket = repo.bucket_start_for_offset(-2)
+
+    async def scenario():
+        await load_scripts(redis)
+
+        consumer = StreamConsumer(redis, repo, name='consumer1', block=0.01)
+        await consumer.create_group()
+
+        # received while the last bucket was still the current one, but applied only now
+        await redis.xadd('observation-stream', {
+            RECORDS_FIELD: encode_records([('lab01', last_bucket, 20.0, 40.0), ('lab02', expired_bucket, 20.0, 40.0)]),
+            INGESTED_AT_FIELD: last_bucket + 1,
+        })
+        applied = await consumer.consume()
+
+        return applied, await repo.get(f'bucket:lab01:{last_bucket}'), await redis.keys('bucket:lab02:*')
+
+    applied, entity, expired_keys = asyncio.run(scenario())
+
+    # the expired bucket isn't recreated
+    assert applied == 1
+    assert expired_keys == []
+    # the observation was in time when it was received
+    assert (entity.num_observations, entity.num_late) == (1, 0)
+
+
+def test_stream_sensor_ids():
+    redis = FakeAsyncRedis()
+    repo = AsyncBucketRepository(redis=redis, sketches=True)
+    stream = ObservationStream(redis)
+    now = int(time.time())
+
+    async def scenario():
+        await load_scripts(redis)
+
+        consumer = StreamConsumer(redis, repo, name='consumer1', block=0.01)
+        await consumer.create_group()
+
+        await stream.add([
+            Observation(lab_id='lab01', timestamp=now, temp=20.0, humidity=40.0, sensor_id='s1'),
+            Observation(lab_id='lab01', timestamp=now, temp=21.0, humidity=40.0),
+            Observation(lab_id='lab01', timestamp=now, temp=22.0, humidity=40.0, sensor_id='s2'),
+        ])
+        await consumer.consume()
+
+        return [entity async for entity in repo.get_many(await repo.find_in_bucket(0))]
+
+    entity, = asyncio.run(scenario())
+
+    # the sensor ids are carried next to the binary records
+    assert entity.num_observations == 3
+    assert entity.num_sensors == 2
+
+
+def test_stream_max_length():
+    redis = AsyncMock()
+    stream = ObservationStream(redis, max_length=1000)
+
+    asyncio.run(stream.add([Observation(lab_id='lab01', timestamp=int(time.time()), temp=20.0, humidity=40.0)]))
+
+    assert redis.xadd.call_args.kwargs == {'maxlen': 1000, 'approximate': True}
+    assert abs(int(redis.xadd.call_args.args[1][INGESTED_AT_FIELD]) - time.time()) < 5
+
+
+def test_stream_claim():
+    redis = FakeAsyncRedis()
+    repo = AsyncBucketRepository(redis=redis)
+    stream = ObservationStream(redis)
+
+    async def scenario():
+        await load_scripts(redis)
+
+        crashed = StreamConsumer(redis, repo, name='crashed', block=0.01, claim_idle=3600)
+        await crashed.create_group()
+        await stream.add([Observation(lab_id='lab01', timestamp=int(time.time()), temp=20.0, humidity=40.0)])
+
+        # the entry is delivered, but never applied
+        await redis.xreadgroup('humtemp', 'crashed', {'observation-stream': '>'})
+        await stream.update_metrics()
+        pending = STREAM_PENDING.value()
+
+        consumer = StreamConsumer(redis, repo, name='consumer2', block=0.01, claim_idle=0)
+        return pending, await consumer.consume()
+
+    pending, applied = asyncio.run(scenario())
+    assert pending == 1
+    assert applied == 1
+
+
+def test_stream_ingest_api():
+    server = FakeServer()
+    redis = FakeAsyncRedis(server=server)
+
+    with patch.object(main, 'observation_stream', ObservationStream(redis)), \
+            patch.object(main, 'observation_buffer', None):
+        main.app.dependency_overrides[main._get_repository] = lambda: AsyncBucketRepository(redis=redis)
+        try:
+            client = TestClient(main.app)
+            response = client.post('/observation', json={
+                "lab_id": "lab01", "timestamp": int(time.time()), "temp": 23.4, "humidity": 50.1
+            })
+            assert response.status_code == 200
+
+            response = client.post('/observations', json=[
+                {"lab_id": "lab02", "timestamp": int(time.time()), "temp": 21.0, "humidity": 45.0},
+            ])
+            assert response.json()['accepted'] == 1
+
+            response = client.get('/metrics')
+            assert 'humtemp_stream_length 2' in response.text
+        finally:
+            main.app.dependency_overrides = {}
+
+    # nothing has been written to the buckets yet
+    assert FakeRedis(server=server).keys('bucket*') == []
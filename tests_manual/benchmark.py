@@ -0,0 +1,421 @@
+"""
+Reproducible benchmark suite for humtemp.
+
+By default, the application is benchmarked in-process against fakeredis, which requires nothing but the dev
+dependencies. Use "--redis" to benchmark against a real redis-server instead, or "--url" to benchmark an already
+running deployment over HTTP. Results are written as JSON, so they can be compared across releases. Progress is
+reported on stderr, so stdout only carries the JSON results.
+
+Examples:
+    poetry run python tests_manual/benchmark.py --output results.json
+    poetry run python tests_manual/benchmark.py --redis localhost:6379 --labs 10,100,1000,10000,100000
+    poetry run python tests_manual/benchmark.py --url http://localhost:8000 --skip-micro
+    poetry run python tests_manual/benchmark.py --redis localhost:6379 --scale-workers 1,2,4,8
+    poetry run python tests_manual/benchmark.py --memory
+    poetry run python tests_manual/benchmark.py --redis localhost:6379 --skip-micro --layout-memory 10000,100000
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import *
+
+import httpx
+import orjson
+from fakeredis import FakeAsyncRedis, FakeRedis, FakeServer
+from redis import Redis
+
+from humtemp import database, main, memory
+from humtemp.cache import SummaryCache
+from humtemp.configuration import get_settings
+from humtemp.database import BucketRepository
+from humtemp.dto import Observation
+from humtemp.dto.record import RECORD_CONTENT_TYPE, decode_records, encode_records
+
+
+def latency_stats(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+
+    return {
+        'count': len(latencies),
+        'throughput_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentiles[49] * 1000,
+        'p99_ms': percentiles[98] * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def random_observation(lab_id: str, timestamp: int) -> Dict[str, Any]:
+    return {
+        'lab_id': lab_id,
+        'timestamp': timestamp,
+        'temp': 20 + random.random() * 10,
+        'humidity': 40 + random.random() * 20,
+    }
+
+
+async def run_concurrently(requests: Iterable[Callable[[], Awaitable[httpx.Response]]],
+                           concurrency: int) -> Dict[str, float]:
+    requests = iter(requests)
+    latencies = []
+
+    async def worker():
+        for request in requests:
+            start = time.perf_counter()
+            response = await request()
+            latencies.append(time.perf_counter() - start)
+
+            if response.status_code != 200:
+                raise Exception(f'unexpected response {response.status_code}: {response.text}')
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latency_stats(latencies, time.perf_counter() - start)
+
+
+class Target:
+    """
+    The system under test: either the in-process app (against fakeredis, a real redis or the memory storage),
+    or a remote deployment.
+    """
+    def __init__(self, url: Optional[str], redis: Optional[str], memory_storage: bool = False):
+        self.url = url
+        self.redis = redis
+        self.memory_storage = memory_storage
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def __aenter__(self) -> 'Target':
+        if self.url is not None:
+            self.client = httpx.AsyncClient(base_url=self.url, timeout=60)
+            return self
+
+        if self.memory_storage:
+            get_settings().humtemp_storage = 'memory'
+            memory.store = memory.MemoryStore()
+        else:
+            if self.redis is not None:
+                host, _, port = self.redis.partition(':')
+                database.connect_async(host=host, port=int(port or 6379), pool_size=100)
+            else:
+                database.async_connection = FakeAsyncRedis()
+            await database.load_scripts(database.async_connection)
+
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://humtemp')
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.client.aclose()
+        if self.url is None:
+            await database.disconnect_async()
+
+    async def reset(self) -> None:
+        if self.url is None:
+            if self.memory_storage:
+                memory.store.buckets.clear()
+            else:
+                await database.async_connection.flushdb()
+            main.summary_cache = None
+
+    async def populate(self, num_labs: int, bucket_offset: int = -1) -> None:
+        """
+        Writes one observation per lab into the given bucket, bypassing the HTTP API for speed.
+        """
+        repo = await main._get_repository()
+        timestamp = repo.bucket_start_for_offset(bucket_offset)
+
+        for chunk_start in range(0, num_labs, 10000):
+            await repo.add_observations([
+                Observation(**random_observation(f'lab{i:0>6}', timestamp))
+                for i in range(chunk_start, min(num_labs, chunk_start + 10000))
+            ])
+
+
+async def benchmark_ingest(target: Target, num_requests: int, concurrency: int, num_labs: int) -> Dict[str, float]:
+    timestamp = int(datetime.now(timezone.utc).timestamp()) - 3600
+
+    def requests():
+        for i in range(num_requests):
+            data = random_observation(f'lab{i % num_labs:0>6}', timestamp)
+            yield lambda data=data: target.client.post('/observation', json=data)
+
+    return await run_concurrently(requests(), concurrency)
+
+
+async def benchmark_batch_ingest(target: Target,
+                                 num_batches: int,
+                                 batch_size: int,
+                                 concurrency: int,
+                                 num_labs: int,
+                                 binary: bool = False) -> Dict[str, float]:
+    timestamp = int(datetime.now(timezone.utc).timestamp()) - 3600
+    headers = {'Content-Type': RECORD_CONTENT_TYPE}
+
+    def requests():
+        for i in range(num_batches):
+            data = [random_observation(f'lab{(i * batch_size + j) % num_labs:0>6}', timestamp)
+                    for j in range(batch_size)]
+            if binary:
+                body = encode_records(tuple(item.values()) for item in data)
+                yield lambda body=body: target.client.post('/observations', content=body, headers=headers)
+            else:
+                yield lambda data=data: target.client.post('/observations', json=data)
+
+    result = await run_concurrently(requests(), concurrency)
+    result['observations_per_sec'] = result['throughput_per_sec'] * batch_size
+    return result
+
+
+async def benchmark_summary(target: Target, labs: List[int], repetitions: int) -> Dict[str, Any]:
+    results = {}
+
+    for num_labs in labs:
+        if target.url is None:
+            await target.reset()
+            await target.populate(num_labs)
+
+        uncached = await run_concurrently(
+            (lambda: target.client.get('/summary') for _ in range(repetitions)), concurrency=1
+        )
+
+        if target.url is None:
+            main.summary_cache = SummaryCache()
+        cached = await run_concurrently(
+            (lambda: target.client.get('/summary') for _ in range(repetitions)), concurrency=1
+        )
+
+        results[str(num_labs)] = {'uncached': uncached, 'cached': cached}
+        progress(f'/summary with {num_labs} labs: {uncached["p50_ms"]:.2f}ms (cached: {cached["p50_ms"]:.2f}ms)')
+
+    return results
+
+
+def benchmark_micro(redis: Optional[str], iterations: int) -> Dict[str, Any]:
+    if redis is not None:
+        host, _, port = redis.partition(':')
+        connection = Redis(host=host, port=int(port or 6379))
+    else:
+        connection = FakeRedis(server=FakeServer())
+    connection.flushdb()
+
+    repo = BucketRepository(redis=connection)
+    timestamp = int(datetime.now(timezone.utc).timestamp()) - 3600
+    raw = [random_observation(f'lab{i % 100:0>6}', timestamp) for i in range(iterations)]
+
+    def measure(func: Callable[[], Any], count: int) -> Dict[str, float]:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        return {'count': count, 'per_sec': count / elapsed, 'us_per_op': elapsed / count * 1e6}
+
+    observations = [Observation(**data) for data in raw]
+    records = encode_records(tuple(data.values()) for data in raw)
+
+    results = {
+        'observation_validation': measure(lambda: [Observation.parse_obj(data) for data in raw], iterations),
+        'record_decoding': measure(lambda: decode_records(records), iterations),
+        'repository_add_observation': measure(lambda: [repo.add_observation(o) for o in observations], iterations),
+        'repository_add_observations': measure(lambda: repo.add_observations(observations), iterations),
+        'repository_find_in_bucket': measure(lambda: [repo.find_in_bucket(0) for _ in range(100)], 100),
+    }
+
+    keys = repo.find_in_bucket(0)
+    results['repository_get'] = measure(lambda: [repo.get(key) for key in keys], len(keys))
+    results['repository_get_many'] = measure(lambda: list(repo.get_many(keys)), len(keys))
+
+    entities = list(repo.get_many(keys))
+    results['summary_encoding'] = measure(
+        lambda: orjson.dumps([main._summary_of(entity) for entity in entities]), len(entities)
+    )
+
+    return results
+
+
+async def benchmark_workers(redis: str,
+                            worker_counts: List[int],
+                            num_requests: int,
+                            concurrency: int) -> Dict[str, Any]:
+    """
+    Starts "python -m humtemp" with a growing number of worker processes and measures the ingest throughput.
+    """
+    host, _, port = redis.partition(':')
+    results = {}
+
+    for workers in worker_counts:
+        env = dict(
+            os.environ,
+            HUMTEMP_WORKERS=str(workers),
+            HUMTEMP_BIND='127.0.0.1:8765',
+            HUMTEMP_REDIS_HOST=host,
+            HUMTEMP_REDIS_PORT=port or '6379',
+        )
+        server = subprocess.Popen([sys.executable, '-m', 'humtemp'], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            async with Target('http://127.0.0.1:8765', None) as target:
+                await wait_until_ready(target)
+                results[str(workers)] = await benchmark_ingest(target, num_requests, concurrency, 1000)
+        finally:
+            server.terminate()
+            server.wait()
+
+        progress(f'POST /observation with {workers} workers: {results[str(workers)]["throughput_per_sec"]:.0f} req/s')
+
+    return results
+
+
+def benchmark_layout_memory(redis: str, labs: List[int]) -> Dict[str, Any]:
+    """
+    Compares the redis memory usage of the original and the compact layout, with one observation per lab
+    in each of the retained buckets. Requires a real redis-server, fakeredis doesn't report its memory usage.
+    """
+    host, _, port = redis.partition(':')
+    connection = Redis(host=host, port=int(port or 6379))
+    results = {}
+
+    for num_labs in labs:
+        for layout, compact_layout in (('original', False), ('compact', True)):
+            connection.flushdb()
+            baseline = connection.info('memory')['used_memory']
+
+            repo = BucketRepository(redis=connection, compact_layout=compact_layout)
+            for offset in range(1 - repo.bucket_retention, 1):
+                timestamp = repo.bucket_start_for_offset(offset)
+                for chunk_start in range(0, num_labs, 10000):
+                    repo.add_observations([
+                        Observation(**random_observation(f'lab{i:0>6}', timestamp))
+                        for i in range(chunk_start, min(num_labs, chunk_start + 10000))
+                    ])
+
+            used = connection.info('memory')['used_memory'] - baseline
+            results.setdefault(str(num_labs), {})[layout] = {
+                'used_memory_bytes': used,
+                'bytes_per_lab_and_bucket': used / (num_labs * repo.bucket_retention),
+            }
+
+        progress(f'redis memory with {num_labs} labs: ' + ', '.join(
+            f'{layout} {result["bytes_per_lab_and_bucket"]:.0f} bytes/bucket'
+            for layout, result in results[str(num_labs)].items()
+        ))
+
+    connection.flushdb()
+    return results
+
+
+def progress(message: str) -> None:
+    print(message, file=sys.stderr)
+
+
+async def wait_until_ready(target: Target, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await target.client.get('/metrics')
+            return
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+
+            await asyncio.sleep(0.2)
+
+
+def metadata(args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'platform': platform.platform(),
+        'target': args.url or ('memory' if args.memory else f'redis://{args.redis}' if args.redis else 'fakeredis'),
+        'arguments': vars(args),
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    results: Dict[str, Any] = {'meta': metadata(args)}
+    labs = [int(num_labs) for num_labs in args.labs.split(',')]
+
+    async with Target(args.url, args.redis, args.memory) as target:
+        await target.reset()
+
+        results['ingest'] = await benchmark_ingest(target, args.requests, args.concurrency, max(labs))
+        progress(f'POST /observation: {results["ingest"]["throughput_per_sec"]:.0f} req/s')
+
+        results['batch_ingest'] = await benchmark_batch_ingest(
+            target, max(1, args.requests // args.batch_size), args.batch_size, args.concurrency, max(labs)
+        )
+        progress(f'POST /observations: {results["batch_ingest"]["observations_per_sec"]:.0f} observations/s')
+
+        results['batch_ingest_binary'] = await benchmark_batch_ingest(
+            target, max(1, args.requests // args.batch_size), args.batch_size, args.concurrency, max(labs), binary=True
+        )
+        progress(f'POST /observations (binary): '
+                 f'{results["batch_ingest_binary"]["observations_per_sec"]:.0f} observations/s')
+
+        results['summary'] = await benchmark_summary(target, labs, args.summary_repetitions)
+
+    if args.scale_workers:
+        if args.redis is None:
+            raise SystemExit('--scale-workers requires --redis, as the worker processes need a shared redis-server')
+
+        results['workers'] = await benchmark_workers(
+            args.redis, [int(workers) for workers in args.scale_workers.split(',')], args.requests, args.concurrency
+        )
+
+    if args.layout_memory:
+        if args.redis is None:
+            raise SystemExit('--layout-memory requires --redis, as fakeredis doesn\'t report its memory usage')
+
+        results['layout_memory'] = benchmark_layout_memory(
+            args.redis, [int(num_labs) for num_labs in args.layout_memory.split(',')]
+        )
+
+    if not args.skip_micro:
+        results['micro'] = benchmark_micro(args.redis, args.micro_iterations)
+
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='benchmark a running deployment instead of the in-process app')
+    parser.add_argument('--redis', help='host:port of a redis-server to use instead of fakeredis')
+    parser.add_argument('--memory', action='store_true', help='use the in-process memory storage instead of redis')
+    parser.add_argument('--requests', type=int, default=2000, help='number of observations to ingest')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--labs', default='10,100,1000,10000', help='comma-separated lab counts for /summary')
+    parser.add_argument('--summary-repetitions', type=int, default=20)
+    parser.add_argument('--micro-iterations', type=int, default=5000)
+    parser.add_argument('--scale-workers', help='comma-separated worker counts to start "python -m humtemp" with')
+    parser.add_argument('--layout-memory', help='comma-separated lab counts to compare the redis memory layouts with')
+    parser.add_argument('--skip-micro', action='store_true', help='skip the in-process microbenchmarks')
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    args = parser.parse_args()
+
+    # the in-process application prints its settings on startup
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main_cli()